@@ -0,0 +1,356 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Benchmark CONKAT-seq computational stages on synthetic libraries
+
+Parameters:
+    stage (str): stage to benchmark (occurrences, fisher, chunked, graph, flag, cluster)
+    nwells (int): number of library subpools (wells), default = 2304
+    nseeds (int): number of domain variants (seeds), default = 5000
+    mean_wells (float): mean number of wells per seed, default = 8
+    min_shared_occurances (int): only count domain pairs with co-occurances >= min_shared_occurances, default = 3
+    memory_budget (float): memory budget in MB of the chunked engine, default = 64
+    workers (int): number of processes for the parallel occurrences and flag runs, default = 1
+    nedges (int): number of significant pairs of the graph and flag stages, default = 1000000
+    ncomponents (int): number of networks of the cluster stage, default = 1000
+    cluster_id (float): identity threshold of the cluster stage, default = 0.9
+    repeats (int): number of timed repeats per engine, default = 1
+    random_seed (int): random seed for the synthetic library, default = 0
+
+"""
+
+import argparse
+import time
+import tracemalloc
+import numpy as np
+import pandas as pd
+import networkx as nx
+
+from helpers import log
+from helpers import calc_fisher
+from helpers import fisher_exact_batch
+
+from conkat_utils import calc_domain_occurances
+from conkat_utils import seed_well_incidence
+from conkat_utils import count_pairs_sparse
+from conkat_utils import pair_wells_sparse
+from conkat_utils import _count_pairs_loop
+from conkat_utils import build_graph
+from conkat_utils import node_attribute_table
+from conkat_utils import flag_barcode_swap_edges
+from conkat_utils import _vsearch_clusters
+from conkat_utils import _cluster_merges
+from sequence_clustering import cluster_fast
+from compact_graph import copy_graph
+from compact_graph import connected_components
+
+
+def synthetic_clustering_table(nwells=2304, nseeds=5000, mean_wells=8, random_seed=0):
+
+    """Generate a random filtered clustering table
+
+    Parameters:
+        nwells (int): number of library subpools
+        nseeds (int): number of domain variants
+        mean_wells (float): mean number of wells per seed (poisson, min 3)
+        random_seed (int): random seed
+
+    Returns:
+        df (pd.DataFrame) : clustering table with seed, well, type, seq, clusterSize and domain columns
+
+    """
+
+    rng = np.random.RandomState(random_seed)
+    sizes = np.maximum(rng.poisson(mean_wells, nseeds), 3)
+    seed_idx = np.repeat(np.arange(nseeds), sizes)
+    wells = np.concatenate([rng.choice(nwells, k, replace=False) + 1 for k in sizes])
+    first = np.r_[0, np.cumsum(sizes)[:-1]]
+
+    df = pd.DataFrame()
+    df['seed'] = ['seed%07d;size=%d' % (i, sizes[i]) for i in seed_idx]
+    df['well'] = wells
+    df['type'] = 'H'
+    df.loc[first, 'type'] = 'S'
+    bases = np.array(list('ACGT'))
+    df.loc[first, 'seq'] = [''.join(bases[rng.randint(0, 4, 210)]) for i in range(nseeds)]
+    df.loc[first, 'clusterSize'] = sizes
+    df.loc[first, 'domain'] = 'AD'
+
+    return df
+
+def synthetic_occurrences_table(table, nedges=1000000, random_seed=0):
+
+    """Generate random significant seed pairs of a clustering table
+
+    Parameters:
+        table (pd.DataFrame): clustering table from synthetic_clustering_table
+        nedges (int): number of distinct pairs
+        random_seed (int): random seed
+
+    Returns:
+        df (pd.DataFrame) : occurrences table with V1, V2 and pvalue columns
+
+    """
+
+    rng = np.random.RandomState(random_seed)
+    seeds = np.unique(table['seed'].values.astype(str)).astype(object)
+    n = len(seeds)
+    if nedges > n * (n - 1) // 2:
+        raise ValueError('Cannot draw %s pairs from %s seeds' % (nedges, n))
+
+    #oversample encoded pairs i < j, then keep the first nedges distinct ones
+    keys = np.zeros(0, dtype=np.int64)
+    while len(keys) < nedges:
+        i = rng.randint(0, n, 2 * nedges)
+        j = rng.randint(0, n, 2 * nedges)
+        (i, j) = (np.minimum(i, j)[i != j], np.maximum(i, j)[i != j])
+        keys = np.unique(np.r_[keys, i.astype(np.int64) * n + j])
+    keys = rng.permutation(keys)[:nedges]
+
+    df = pd.DataFrame()
+    df['V1'] = seeds[keys // n]
+    df['V2'] = seeds[keys % n]
+    df['pvalue'] = 10.0 ** -rng.uniform(4, 30, nedges)
+
+    return df
+
+def synthetic_components(ncomponents=1000, length=210, indels=0.2, random_seed=0):
+
+    """Generate networks of domain variants, point and indel mutants of one to three parent sequences
+
+    Parameters:
+        ncomponents (int): number of networks (3 to 20 variants each)
+        length (int): sequence length
+        indels (float): fraction of variants with an insertion and a deletion, keeping the length
+        random_seed (int): random seed
+
+    Returns:
+        components (list) : (headers, seqs) of every network, headers carry ';size=N' abundances
+
+    """
+
+    rng = np.random.RandomState(random_seed)
+    bases = np.array(list('ACGT'))
+    components = []
+    for c in range(ncomponents):
+        parents = [rng.randint(0, 4, length) for k in range(rng.randint(1, 4))]
+        (headers, seqs) = ([], [])
+        for j in range(rng.randint(3, 21)):
+            seq = parents[rng.randint(len(parents))].copy()
+            #substitution rates around the usual identity thresholds
+            sites = rng.choice(length, rng.poisson(length * rng.choice([0.01, 0.05, 0.1, 0.15])), replace=False)
+            seq[sites] = (seq[sites] + rng.randint(1, 4, len(sites))) % 4
+            if rng.rand() < indels:
+                (start, end) = np.sort(rng.choice(length, 2, replace=False))
+                seq = np.r_[seq[:start], rng.randint(0, 4), seq[start:end], seq[end + 1:]]
+            headers.append('c%06d_%02d;size=%d' % (c, j, rng.geometric(0.1)))
+            seqs.append(''.join(bases[seq]))
+        components.append((headers, seqs))
+
+    return components
+
+def timeit(func, repeats=1):
+
+    """Return the best wall time of repeats calls and the last result"""
+
+    best = None
+    for i in range(repeats):
+        t0 = time.time()
+        res = func()
+        t = time.time() - t0
+        best = t if best is None else min(best, t)
+    return (best, res)
+
+def bench_occurrences(table, min_pair_count=3, repeats=1, workers=1):
+
+    """Time the calc_domain_occurances pair counting engines and check they agree"""
+
+    Nwells = table['well'].nunique()
+
+    (t, pairs_dict) = timeit(lambda: _count_pairs_loop(table, Nwells, min_pair_count), repeats)
+    log('occurrences counting engine=loop pairs=%s time=%.2fs' % (len(pairs_dict), t))
+
+    def count_sparse():
+        (seeds, wells, X) = seed_well_incidence(table)
+        (rows, cols, counts) = count_pairs_sparse(X, min_pair_count)
+        (offsets, flat) = pair_wells_sparse(X, rows, cols)
+        return (seeds, wells, rows, cols, offsets, flat)
+
+    (t, (seeds, wells, rows, cols, offsets, flat)) = timeit(count_sparse, repeats)
+    log('occurrences counting engine=sparse pairs=%s time=%.2fs' % (len(rows), t))
+
+    sparse_dict = dict(((seeds[i], seeds[j]), wells[flat[offsets[k]:offsets[k+1]]].tolist())
+                       for k,(i,j) in enumerate(zip(rows, cols)))
+    same = (dict((k, sorted(v)) for k,v in pairs_dict.items()) == sparse_dict)
+    log('engines agree --> %s' % same)
+
+    (t, df) = timeit(lambda: calc_domain_occurances(table, min_pair_count), repeats)
+    log('occurrences table (counting + fisher) pairs=%s time=%.2fs' % (len(df), t))
+
+    if workers > 1:
+        (t, par) = timeit(lambda: calc_domain_occurances(table, min_pair_count, workers=workers), repeats)
+        log('occurrences table (counting + fisher) workers=%s pairs=%s time=%.2fs' % (workers, len(par), t))
+        log('parallel table identical --> %s' % df.equals(par))
+
+def bench_chunked(table, min_pair_count=3, memory_budget=64):
+
+    """Compare peak traced memory of the sparse and chunked counting engines"""
+
+    for (engine, budget) in [('sparse', None), ('chunked', memory_budget)]:
+        tracemalloc.start()
+        t0 = time.time()
+        df = calc_domain_occurances(table, min_pair_count, engine=engine, memory_budget=budget)
+        t = time.time() - t0
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        log('occurrences engine=%s budget=%sMB pairs=%s time=%.2fs peak=%.1fMB' % (engine, budget, len(df), t, peak / 2.0**20))
+
+def bench_fisher(table, min_pair_count=3, repeats=1, max_rows=20000):
+
+    """Time the batched Fisher engine against row-wise stats.fisher_exact"""
+
+    df = calc_domain_occurances(table, min_pair_count)
+    Nwells = table['well'].nunique()
+    sub = df.iloc[:max_rows]
+
+    (t, ref) = timeit(lambda: sub.apply(lambda row: calc_fisher(row['a'],row['b'],row['c'],row['d']),axis=1), repeats)
+    log('fisher row-wise pairs=%s time=%.2fs' % (len(sub), t))
+
+    (t, (odds, pvals)) = timeit(lambda: fisher_exact_batch(sub['a'].values, sub['Ov1'].values, sub['Ov2'].values, Nwells), repeats)
+    log('fisher batched pairs=%s time=%.2fs' % (len(sub), t))
+
+    cache = {}
+    fisher_exact_batch(df['a'].values, df['Ov1'].values, df['Ov2'].values, Nwells, cache=cache)
+    (t, res) = timeit(lambda: fisher_exact_batch(df['a'].values, df['Ov1'].values, df['Ov2'].values, Nwells, cache=cache), repeats)
+    log('fisher batched (cached) pairs=%s unique tables=%s time=%.2fs' % (len(df), len(cache), t))
+
+    refp = np.array([x[1] for x in ref.values])
+    ok = refp > 0
+    log('max relative p-value difference --> %.3g' % (np.abs(pvals - refp)[ok] / refp[ok]).max())
+
+def bench_graph(table, nedges=1000000, repeats=1, random_seed=0):
+
+    """Time edge list construction and node annotation of build_graph"""
+
+    df = synthetic_occurrences_table(table, nedges, random_seed)
+
+    (t, attrs) = timeit(lambda: node_attribute_table(table), repeats)
+    log('node annotation nodes=%s time=%.2fs' % (len(attrs), t))
+
+    for method in ['pvalue', 'fdr_bh']:
+        (t, G) = timeit(lambda: build_graph(df, table, 0.05, method), repeats)
+        log('build_graph method=%s nodes=%s edges=%s time=%.2fs' % (method, len(G.nodes()), len(G.edges), t))
+
+    for backend in ['networkx', 'compact']:
+        tracemalloc.start()
+        (t, G) = timeit(lambda: build_graph(df, table, 0.05, 'pvalue', backend=backend), repeats)
+        size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        log('build_graph backend=%s time=%.2fs graph=%.1fMB' % (backend, t, size / 2.0**20))
+        (t, P) = timeit(lambda: copy_graph(G), repeats)
+        log('copy backend=%s time=%.2fs' % (backend, t))
+        if backend == 'compact':
+            (t, comps) = timeit(lambda: connected_components(G), repeats)
+        else:
+            (t, comps) = timeit(lambda: sorted(nx.connected_components(G), key=len, reverse=True), repeats)
+        log('components backend=%s components=%s time=%.2fs' % (backend, len(comps), t))
+
+def bench_flag(table, nedges=1000000, repeats=1, workers=1, random_seed=0):
+
+    """Time edge flagging with one and several workers and check they agree"""
+
+    df = synthetic_occurrences_table(table, nedges, random_seed)
+    G = build_graph(df, table, 0.05, 'pvalue', backend='compact')
+
+    (t, (G1, P1, flag)) = timeit(lambda: flag_barcode_swap_edges(copy_graph(G), random_seed=random_seed, exact_max=0), repeats)
+    log('flag workers=1 edges=%s flagged=%s time=%.2fs' % (len(G['src']), len(flag), t))
+
+    if workers > 1:
+        (t, (G2, P2, par)) = timeit(lambda: flag_barcode_swap_edges(copy_graph(G), random_seed=random_seed, exact_max=0,
+                                                                     workers=workers), repeats)
+        log('flag workers=%s edges=%s flagged=%s time=%.2fs' % (workers, len(G['src']), len(par), t))
+        log('parallel flags identical --> %s' % flag.equals(par))
+
+def bench_cluster(components, cluster_id=0.9, repeats=1):
+
+    """Time in process and vsearch clustering of networks and check they agree (needs vsearch)"""
+
+    (t, local) = timeit(lambda: [cluster_fast(headers, seqs, cluster_id) for headers,seqs in components], repeats)
+    gapped = [i for i,m in enumerate(local) if m is None]
+    log('cluster backend=inprocess networks=%s merges=%s left to vsearch=%s time=%.2fs' %
+        (len(components), sum(len(m) for m in local if m is not None), len(gapped), t))
+
+    def run_vsearch():
+        merges = []
+        for (headers, seqs) in components:
+            otuDF = _vsearch_clusters(headers, seqs, cluster_id, 1)
+            merges.append([] if otuDF is None else _cluster_merges(otuDF))
+        return merges
+
+    (t, ref) = timeit(run_vsearch, repeats)
+    log('cluster backend=vsearch networks=%s merges=%s time=%.2fs' % (len(components), sum(len(m) for m in ref), t))
+
+    agree = sum(sorted(a) == sorted(b) for a,b in zip(local, ref) if a is not None)
+    log('in process clusters identical to vsearch --> %s of %s networks' % (agree, len(components) - len(gapped)))
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="benchmark script")
+
+    parser.add_argument('-s', '--stage', help='stage to benchmark',
+                        required=False, type=str, default='occurrences',
+                        choices=['occurrences','fisher','chunked','graph','flag','cluster'])
+
+    parser.add_argument('--nwells', help='number of library subpools (wells), default = 2304',
+                        required=False, type=int, default=2304)
+
+    parser.add_argument('--nseeds', help='number of domain variants (seeds), default = 5000',
+                        required=False, type=int, default=5000)
+
+    parser.add_argument('--mean_wells', help='mean number of wells per seed, default = 8',
+                        required=False, type=float, default=8)
+
+    parser.add_argument('-m', '--min_shared_occurances',
+                        help='only count domain pairs with co-occurances >= min_shared_occurances, default = 3',
+                        required=False, type=int, default=3)
+
+    parser.add_argument('--memory_budget', help='memory budget in MB of the chunked engine, default = 64',
+                        required=False, type=float, default=64)
+
+    parser.add_argument('--workers', help='number of processes for the parallel occurrences and flag runs, default = 1',
+                        required=False, type=int, default=1)
+
+    parser.add_argument('--nedges', help='number of significant pairs of the graph and flag stages, default = 1000000',
+                        required=False, type=int, default=1000000)
+
+    parser.add_argument('--ncomponents', help='number of networks of the cluster stage, default = 1000',
+                        required=False, type=int, default=1000)
+
+    parser.add_argument('--cluster_id', help='identity threshold of the cluster stage, default = 0.9',
+                        required=False, type=float, default=0.9)
+
+    parser.add_argument('--repeats', help='number of timed repeats per engine, default = 1',
+                        required=False, type=int, default=1)
+
+    parser.add_argument('--random_seed', help='random seed for the synthetic library, default = 0',
+                        required=False, type=int, default=0)
+
+    args = parser.parse_args()
+
+    log('Generating synthetic library (%s wells, %s seeds)...' % (args.nwells, args.nseeds))
+    table = synthetic_clustering_table(args.nwells, args.nseeds, args.mean_wells, args.random_seed)
+
+    if args.stage == 'occurrences':
+        bench_occurrences(table, args.min_shared_occurances, repeats=args.repeats, workers=args.workers)
+    elif args.stage == 'chunked':
+        bench_chunked(table, args.min_shared_occurances, args.memory_budget)
+    elif args.stage == 'fisher':
+        bench_fisher(table, args.min_shared_occurances, repeats=args.repeats)
+    elif args.stage == 'graph':
+        bench_graph(table, args.nedges, repeats=args.repeats, random_seed=args.random_seed)
+    elif args.stage == 'flag':
+        bench_flag(table, args.nedges, repeats=args.repeats, workers=args.workers, random_seed=args.random_seed)
+    elif args.stage == 'cluster':
+        bench_cluster(synthetic_components(args.ncomponents, random_seed=args.random_seed), args.cluster_id,
+                      repeats=args.repeats)
@@ -6,11 +6,14 @@ import os
 import subprocess
 import sys
 import shutil
+import time
+from glob import glob
 
 from conkat_utils import clean_host_reads
 from helpers import ensure_dir
-from helpers import execute
+from helpers import configure_commands
 from helpers import log 
+from helpers import run_command
 
 if __name__ == "__main__":
     
@@ -28,6 +31,7 @@ if __name__ == "__main__":
         cluster_id (float) : identity threshold for amplicon clustering, default = 0.95
         host_ref_fullpath (str): path to host refrence fasta file if read filtering is required, default = None
         threads (int): number of threads to use by vsearch, default = 1
+        command_timeout (float) : seconds before an external command is killed, default = None (no limit)
         remove_files (bool) : do not keep processed read files, default = False
         verbose (bool) : increase output verbosity, default = False
     """
@@ -64,6 +68,9 @@ if __name__ == "__main__":
     parser.add_argument('--threads', help='number of threads to use by vsearch, default = 1',
                         type=int, default=1, required=False)
     
+    parser.add_argument('--command_timeout', help='seconds before an external command is killed, default = None (no limit)',
+                        type=float, default=None, required=False)
+    
     parser.add_argument('--verbose', help='increase output verbosity',
                         action='store_true',required=False)
     
@@ -81,6 +88,7 @@ if __name__ == "__main__":
     cluster_id = args.cluster_id
     host_path = args.host_path
     threads = args.threads
+    command_timeout = args.command_timeout
     verbose = args.verbose
     remove_files = args.remove_files
     ###
@@ -95,6 +103,10 @@ if __name__ == "__main__":
     for dirname in output_subfolders:
             ensure_dir(OUTPATH + dirname)
 
+    #wall time, cpu time and memory of every external command
+    performance_log = OUTPATH + 'PERFORMANCE_' + time.strftime('%Y%m%d-%H%M%S') + '.tsv'
+    configure_commands(perf_log=performance_log, timeout=command_timeout)
+
     demux_files = [f for f in os.listdir(INPATH) if os.path.isfile(os.path.join(INPATH, f))]
     log('%s files found...' % len(demux_files))
     
@@ -122,7 +134,7 @@ if __name__ == "__main__":
             log('\n')
             log(cmd)
 
-        execute(cmd,screen=verbose)
+        run_command(cmd,screen=verbose)
 
         #dereplicate
         input_file = output_full_path
@@ -143,18 +155,22 @@ if __name__ == "__main__":
             log('\n')
             log(cmd)
 
-        execute(cmd,screen=verbose)
+        run_command(cmd,screen=verbose)
 
     ### merge and process all subpools 
     #merge 
     log('Merging de-replicated reads -> %s...' % merged_output_file)
-    cmd = 'cat %s/derep/* > %s' %(OUTPATH,merged_output_file)
+    derep_files = sorted(glob(OUTPATH + 'derep/*'))
+    if not derep_files:
+        #cat without files would wait on stdin
+        raise IOError('No de-replicated reads to merge -> %sderep/' % OUTPATH)
+    cmd = ['cat'] + derep_files
     if verbose:
         log('\n')
-        log(cmd)
+        log('cat %s/derep/* > %s' %(OUTPATH,merged_output_file))
 
     
-    execute(cmd,screen=verbose)
+    run_command(cmd,screen=verbose,stdout_path=merged_output_file)
     
     if host_path:
         merged_output_host_clean_file = merged_output_file.replace('.fna','_HOST_CLEAN.fna')
@@ -187,7 +203,7 @@ if __name__ == "__main__":
     
 
     log(cmd)
-    execute(cmd,screen=verbose)
+    run_command(cmd,screen=verbose)
     
     centroids_filename = OUTPATH + sample_name + '_OTU.fna'
     table_filename = OUTPATH + sample_name + '_OTU.txt'
@@ -214,8 +230,9 @@ if __name__ == "__main__":
 
 
     log(cmd)
-    execute(cmd,screen=True)
+    run_command(cmd,screen=True)
     
     log('Amplicon domain clustering table saved -> %s...' % table_filename)
     log('Amplicon domain centroid sequences saved -> %s...' % centroids_filename)
+    log('External command performance saved -> %s...' % performance_log)
             
@@ -0,0 +1,98 @@
+import os
+import json
+import time
+import shutil
+import numpy as np
+
+from helpers import log
+
+CHECKPOINT_FORMAT = 'conkat-checkpoint'
+CHECKPOINT_VERSION = 1
+
+#seconds between two checkpoints of the stages that batch their results
+CHECKPOINT_INTERVAL = 60
+
+#A checkpoint is a directory of completed parts of a long running stage:
+#    meta.json : format, version and key of the stage inputs and parameters
+#    <part>.npz : arrays of one completed part, written atomically
+
+def open_checkpoint(fullpath, key, interval=CHECKPOINT_INTERVAL):
+
+    """Open the checkpoint directory of a stage run
+
+    Parts saved by a run of the same key are kept for resuming, a directory of
+    another key (inputs or parameters changed) is cleared.
+
+    Parameters:
+        fullpath (str): checkpoint directory
+        key (str) : key of the stage inputs and parameters (e.g. the stage cache key)
+        interval (float) : seconds between two checkpoints of batched parts (default is CHECKPOINT_INTERVAL)
+
+    Returns:
+        checkpoint (dict) : 'fullpath', 'key', 'interval', 'last' (time of the last write) and 'parts' (saved part names)
+
+    """
+
+    meta_fullpath = os.path.join(fullpath, 'meta.json')
+    meta = None
+    if os.path.isfile(meta_fullpath):
+        try:
+            with open(meta_fullpath) as f:
+                meta = json.load(f)
+        except ValueError:
+            meta = None
+
+    if (meta is None) or (meta.get('format') != CHECKPOINT_FORMAT) or \
+       (meta.get('version') != CHECKPOINT_VERSION) or (meta.get('key') != key):
+        if os.path.isdir(fullpath):
+            log('Discarding checkpoint of other inputs --> %s' % fullpath)
+            shutil.rmtree(fullpath)
+        os.makedirs(fullpath)
+        with open(meta_fullpath, 'w') as f:
+            json.dump({'format': CHECKPOINT_FORMAT, 'version': CHECKPOINT_VERSION, 'key': key}, f)
+
+    parts = sorted(x[:-len('.npz')] for x in os.listdir(fullpath) if x.endswith('.npz') and not x.endswith('.tmp.npz'))
+    if parts:
+        log('Resuming from checkpoint, %s parts found --> %s' % (len(parts), fullpath))
+
+    return {'fullpath': fullpath, 'key': key, 'interval': interval, 'last': time.time(), 'parts': parts}
+
+def checkpoint_due(checkpoint):
+
+    """True if the checkpoint interval has passed since the last write"""
+
+    return (time.time() - checkpoint['last']) >= checkpoint['interval']
+
+def write_checkpoint(checkpoint, name, **arrays):
+
+    """Save the arrays of a completed part (atomic replace)"""
+
+    part_fullpath = os.path.join(checkpoint['fullpath'], name + '.npz')
+    with open(part_fullpath.replace('.npz', '.tmp.npz'), 'wb') as f:
+        np.savez(f, **arrays)
+    os.rename(part_fullpath.replace('.npz', '.tmp.npz'), part_fullpath)
+    checkpoint['last'] = time.time()
+    if name not in checkpoint['parts']:
+        checkpoint['parts'].append(name)
+
+def read_checkpoint(checkpoint, prefix):
+
+    """Load the saved parts whose name starts with prefix
+
+    Returns:
+        parts (dict) : part name -> dict of arrays
+    """
+
+    parts = {}
+    for name in checkpoint['parts']:
+        if name.startswith(prefix):
+            with np.load(os.path.join(checkpoint['fullpath'], name + '.npz')) as f:
+                parts[name] = dict((k, f[k]) for k in f.files)
+
+    return parts
+
+def remove_checkpoint(checkpoint):
+
+    """Delete the checkpoint directory once the stage outputs are written"""
+
+    shutil.rmtree(checkpoint['fullpath'], ignore_errors=True)
@@ -0,0 +1,133 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+
+from helpers import log
+
+CLUSTER_CACHE_FORMAT = 'conkat-cluster-cache'
+CLUSTER_CACHE_VERSION = 1
+
+#default size bound of the cache in MB
+CLUSTER_CACHE_MB = 1024
+
+#stored merges between two commits of the cache
+CLUSTER_CACHE_COMMIT = 1000
+
+#A clustering cache is a sqlite database of the merges of clustered networks:
+#    meta : format and version
+#    clusters : key (content hash of the network sequences, cluster_id and backend),
+#        merges (json (seed, node) pairs), size (bytes) and last_used (time of the last
+#        use, the least recently used networks are evicted above the size bound)
+
+def open_cluster_cache(fullpath, max_mb=CLUSTER_CACHE_MB):
+
+    """Open (or create) a clustering cache database
+
+    A database of another format or version is cleared.
+
+    Parameters:
+        fullpath (str): sqlite database file
+        max_mb (float) : size bound of the cached merges in MB (default is CLUSTER_CACHE_MB)
+
+    Returns:
+        cache (dict) : 'fullpath', 'db' (sqlite connection), 'max_bytes', 'hits', 'stored' and 'pending'
+
+    """
+
+    db = sqlite3.connect(fullpath)
+    db.execute('CREATE TABLE IF NOT EXISTS meta (format TEXT, version INTEGER)')
+    meta = db.execute('SELECT format, version FROM meta').fetchone()
+    if meta != (CLUSTER_CACHE_FORMAT, CLUSTER_CACHE_VERSION):
+        if meta is not None:
+            log('Discarding clustering cache of another format --> %s' % fullpath)
+        db.execute('DROP TABLE IF EXISTS clusters')
+        db.execute('DELETE FROM meta')
+        db.execute('INSERT INTO meta VALUES (?, ?)', (CLUSTER_CACHE_FORMAT, CLUSTER_CACHE_VERSION))
+    db.execute('CREATE TABLE IF NOT EXISTS clusters (key TEXT PRIMARY KEY, merges TEXT, size INTEGER, last_used REAL)')
+    db.commit()
+
+    return {'fullpath': fullpath, 'db': db, 'max_bytes': int(max_mb * 1024 * 1024),
+            'hits': 0, 'stored': 0, 'pending': 0}
+
+def cluster_key(headers, seqs, cluster_id, backend='vsearch'):
+
+    """Content hash of the clustering of a network
+
+    The headers and sequences are hashed in the order they are clustered, which
+    decides the cluster centroids, with the identity threshold and the backend,
+    the clustering program with the options that change its clusters (e.g.
+    'vsearch --maxrejects 0 ').
+    """
+
+    h = hashlib.sha256(('%r\t%s\n' % (float(cluster_id), backend)).encode('utf-8'))
+    for (header, seq) in zip(headers, seqs):
+        h.update(('%s\t%s\n' % (header, seq)).encode('utf-8'))
+
+    return h.hexdigest()
+
+def lookup_clusters(cache, keys):
+
+    """Cached merges of the networks of keys, marked as used
+
+    Returns:
+        merges (dict) : key -> (seed, node) pairs of the keys found in the cache
+    """
+
+    (found, keys) = ({}, list(keys))
+    for start in range(0, len(keys), 500):
+        chunk = keys[start:start+500]
+        rows = cache['db'].execute('SELECT key, merges FROM clusters WHERE key IN (%s)' % ','.join('?' * len(chunk)),
+                                   chunk).fetchall()
+        found.update((k, [tuple(m) for m in json.loads(merges)]) for k,merges in rows)
+
+    now = time.time()
+    cache['db'].executemany('UPDATE clusters SET last_used = ? WHERE key = ?', [(now, k) for k in found])
+    cache['db'].commit()
+    cache['hits'] += len(found)
+
+    return found
+
+def store_clusters(cache, key, merges):
+
+    """Save the merges of a clustered network (committed every CLUSTER_CACHE_COMMIT networks)"""
+
+    merges = json.dumps([list(m) for m in merges])
+    cache['db'].execute('INSERT OR REPLACE INTO clusters VALUES (?, ?, ?, ?)', (key, merges, len(merges), time.time()))
+    cache['stored'] += 1
+    cache['pending'] += 1
+    if cache['pending'] >= CLUSTER_CACHE_COMMIT:
+        cache['db'].commit()
+        cache['pending'] = 0
+
+def evict_clusters(cache):
+
+    """Delete the least recently used networks above the size bound of the cache
+
+    Returns:
+        evicted (int) : number of deleted networks
+    """
+
+    rows = cache['db'].execute('SELECT key, size FROM clusters ORDER BY last_used DESC').fetchall()
+    (total, evict) = (0, [])
+    for (key, size) in rows:
+        total += size
+        if total > cache['max_bytes']:
+            evict.append((key,))
+    cache['db'].executemany('DELETE FROM clusters WHERE key = ?', evict)
+    cache['db'].commit()
+
+    return len(evict)
+
+def close_cluster_cache(cache):
+
+    """Commit the stored merges, evict above the size bound and close the database"""
+
+    try:
+        cache['db'].commit()
+        evicted = evict_clusters(cache)
+        log('Clustering cache: %s networks reused, %s stored, %s evicted --> %s' %
+            (cache['hits'], cache['stored'], evicted, cache['fullpath']))
+    finally:
+        cache['db'].close()
@@ -0,0 +1,395 @@
+import numpy as np
+import pandas as pd
+import networkx as nx
+from scipy import sparse
+from scipy.sparse import csgraph
+
+#A compact graph is a dict of arrays:
+#    nodes : object array of node names, node k is nodes[k]
+#    src, dst : int32 edge end points (src <= dst), edge e is (src[e], dst[e])
+#    indptr, indices, edge_ids : CSR adjacency, the neighbours of node k are
+#        indices[indptr[k]:indptr[k+1]] through edges edge_ids[indptr[k]:indptr[k+1]]
+#    node_attrs : dict of attribute name -> array aligned with nodes (None when missing),
+#        the 'well' attribute holds a sorted int32 array of well ids per node
+#    edge_attrs : dict of attribute name -> array aligned with src/dst (None when missing)
+
+def is_compact_graph(G):
+
+    """True if G is a compact graph rather than a networkx graph"""
+
+    return isinstance(G, dict) and ('indptr' in G)
+
+def _column(values):
+
+    """Store attribute values as a numeric array when possible, else as an object array"""
+
+    values = list(values)
+    if all(isinstance(v, (int, float, np.integer, np.floating)) and not isinstance(v, bool) for v in values):
+        return np.asarray(values)
+    #element-wise, so that equal length array values (well sets) stay one object each
+    col = np.empty(len(values), dtype=object)
+    for k,v in enumerate(values):
+        col[k] = v
+    return col
+
+def compact_graph(nodes, src, dst, node_attrs=None, edge_attrs=None):
+
+    """Build a compact graph from integer edge arrays
+
+    Parameters:
+        nodes (list): node names
+        src (np.array) : first end point (index into nodes) of every edge
+        dst (np.array) : second end point (index into nodes) of every edge
+        node_attrs (dict) : attribute name -> values aligned with nodes (default is None)
+        edge_attrs (dict) : attribute name -> values aligned with src/dst (default is None)
+
+    Returns:
+        CG (dict) : compact graph
+
+    """
+
+    names = np.empty(len(nodes), dtype=object)
+    names[:] = list(nodes)
+    src = np.asarray(src, dtype=np.int64)
+    dst = np.asarray(dst, dtype=np.int64)
+    (src, dst) = (np.minimum(src, dst), np.maximum(src, dst))
+
+    #both directions of every edge, self loops once
+    loop = src == dst
+    ids = np.arange(len(src))
+    heads = np.r_[src, dst[~loop]]
+    tails = np.r_[dst, src[~loop]]
+    ids = np.r_[ids, ids[~loop]]
+    order = np.lexsort((tails, heads))
+    indptr = np.r_[0, np.cumsum(np.bincount(heads, minlength=len(names)))]
+
+    CG = {'nodes': names,
+          'src': src.astype(np.int32), 'dst': dst.astype(np.int32),
+          'indptr': indptr.astype(np.int64), 'indices': tails[order].astype(np.int32),
+          'edge_ids': ids[order].astype(np.int64),
+          'node_attrs': dict((k, np.asarray(v)) for k,v in (node_attrs or {}).items()),
+          'edge_attrs': dict((k, np.asarray(v)) for k,v in (edge_attrs or {}).items())}
+
+    return CG
+
+def copy_graph(G):
+
+    """Copy a networkx or compact graph"""
+
+    if not is_compact_graph(G):
+        return G.copy()
+
+    CG = dict((k, v.copy()) for k,v in G.items() if isinstance(v, np.ndarray))
+    CG['node_attrs'] = dict((k, v.copy()) for k,v in G['node_attrs'].items())
+    CG['edge_attrs'] = dict((k, v.copy()) for k,v in G['edge_attrs'].items())
+
+    return CG
+
+def number_of_nodes(G):
+
+    """Number of nodes of a networkx or compact graph"""
+
+    return len(G['nodes']) if is_compact_graph(G) else G.number_of_nodes()
+
+def number_of_edges(G):
+
+    """Number of edges of a networkx or compact graph"""
+
+    return len(G['src']) if is_compact_graph(G) else G.number_of_edges()
+
+def edge_list(G):
+
+    """Edges of a networkx or compact graph as a list of (node, node) name tuples"""
+
+    if not is_compact_graph(G):
+        return list(G.edges())
+
+    return list(zip(G['nodes'][G['src']].tolist(), G['nodes'][G['dst']].tolist()))
+
+def node_attribute(G, name):
+
+    """Node attribute of a networkx or compact graph as a dict of node -> value (missing values skipped)"""
+
+    if not is_compact_graph(G):
+        return nx.get_node_attributes(G, name)
+
+    values = G['node_attrs'].get(name)
+    if values is None:
+        return {}
+    return dict((n, v) for n,v in zip(G['nodes'].tolist(), values.tolist()) if v is not None)
+
+def neighbors(CG, k):
+
+    """Indices of the neighbours of node k"""
+
+    return CG['indices'][CG['indptr'][k]:CG['indptr'][k+1]]
+
+def connected_components(CG):
+
+    """Connected components of a compact graph
+
+    Parameters:
+        CG (dict): compact graph
+
+    Returns:
+        components (list) : sorted node index arrays, largest component first
+            (ties keep the networkx order of the components)
+
+    """
+
+    n = len(CG['nodes'])
+    A = sparse.csr_matrix((np.ones(len(CG['src']), dtype=np.int8), (CG['src'], CG['dst'])), shape=(n, n))
+    (ncomp, labels) = csgraph.connected_components(A, directed=False)
+
+    #scipy labels components in order of their first node, as networkx does
+    order = np.argsort(labels, kind='stable')
+    bounds = np.r_[0, np.cumsum(np.bincount(labels, minlength=ncomp))]
+    components = [order[bounds[c]:bounds[c+1]] for c in range(ncomp)]
+
+    return sorted(components, key=len, reverse=True)
+
+def remove_edges(CG, mask):
+
+    """Compact graph without the edges selected by mask
+
+    Parameters:
+        CG (dict): compact graph
+        mask (np.array) : boolean array aligned with the edges, True for edges to remove
+
+    Returns:
+        CG (dict) : new compact graph with the same nodes
+
+    """
+
+    keep = ~np.asarray(mask, dtype=bool)
+
+    return compact_graph(CG['nodes'], CG['src'][keep], CG['dst'][keep],
+                         node_attrs=dict((k, v.copy()) for k,v in CG['node_attrs'].items()),
+                         edge_attrs=dict((k, v[keep]) for k,v in CG['edge_attrs'].items()))
+
+def contraction_roots(n, pairs):
+
+    """Union-find of node contractions
+
+    The smaller group is linked under the larger one, the node a group is named
+    after is kept apart, so merging large groups stays near linear.
+
+    Parameters:
+        n (int): number of nodes
+        pairs (list) : (u, v) node index pairs, the group of v is merged into the group of u, in order
+
+    Returns:
+        roots (np.array) : node index every node ends up merged into (itself when not merged)
+
+    """
+
+    parent = list(range(n))
+    size = [1] * n
+    #node a group is named after, by union-find root
+    name = list(range(n))
+
+    def find(k):
+        root = k
+        while parent[root] != root:
+            root = parent[root]
+        while parent[k] != root:
+            (parent[k], k) = (root, parent[k])
+        return root
+
+    for (u,v) in pairs:
+        (ru, rv) = (find(u), find(v))
+        if ru == rv:
+            continue
+        (big, small) = (ru, rv) if size[ru] >= size[rv] else (rv, ru)
+        parent[small] = big
+        size[big] += size[small]
+        name[big] = name[ru]
+
+    return np.array([name[find(k)] for k in range(n)], dtype=np.int64)
+
+def _moved_last(src, dst, pairs, edges):
+
+    """Edge whose data every pair of groups ends up with, among edges between the same groups
+
+    The edges are contracted one pair at a time, the edge of v to a group wins
+    over the one of u. The group with fewer neighbours is merged into the other
+    one, so every edge is moved a few times at most.
+
+    Parameters:
+        src, dst (np.array): end points of all edges
+        pairs (list) : (u, v) node index pairs
+        edges (list) : edge indices ending up between the same groups, not self loops
+
+    Returns:
+        kept (list) : edge index kept for every pair of groups
+
+    """
+
+    #neighbour groups of every group, by group id, and group id of every group by its node
+    adj = {}
+    for e in edges:
+        adj.setdefault(int(src[e]), {})[int(dst[e])] = e
+        adj.setdefault(int(dst[e]), {})[int(src[e])] = e
+    group = dict((k, k) for k in adj)
+
+    for (u,v) in pairs:
+        gv = group.pop(v, None)
+        if gv is None:
+            continue
+        gu = group.setdefault(u, gv)
+        if gu == gv:
+            continue
+        (near_u, near_v) = (adj[gu], adj[gv])
+        #edges between u and v become self loops, worked out apart
+        near_u.pop(gv, None)
+        near_v.pop(gu, None)
+        if len(near_u) >= len(near_v):
+            for (w, e) in near_v.items():
+                near_u[w] = adj[w][gu] = e
+                del adj[w][gv]
+            del adj[gv]
+        else:
+            for (w, e) in near_u.items():
+                if w not in near_v:
+                    near_v[w] = adj[w][gv] = e
+                del adj[w][gu]
+            del adj[gu]
+            group[u] = gv
+
+    return sorted(set(e for near in adj.values() for e in near.values()))
+
+def _self_loops(src, dst, roots, pairs):
+
+    """Edge whose data the self loop of every contracted group ends up with
+
+    The edges within the groups are contracted one pair at a time, the last of
+    the edges of v going to u or v sets the self loop of u. The edges of v are
+    taken in the order of G.edges(v) along repeated nx.contracted_nodes calls,
+    which copy the graph every time: the edges to nodes before v by node order,
+    then the other ones in the order they came to be, then the edges added by
+    the previous call.
+
+    Returns:
+        loops (dict) : edge index by group root
+
+    """
+
+    adj = {}
+    for e in np.flatnonzero(roots[src] == roots[dst]).tolist():
+        #edges are [order, edge index, pair that added it] lists shared by both end points
+        link = [e, e, -1]
+        adj.setdefault(int(src[e]), {})[int(dst[e])] = link
+        adj.setdefault(int(dst[e]), {})[int(src[e])] = link
+
+    stamp = len(src)
+    for r,(u,v) in enumerate(pairs):
+        key = lambda item: (1, 0, item[1][0]) if item[1][2] == r - 1 else \
+                           ((0, 0, item[0]) if item[0] < v else (0, 1, item[1][0]))
+        moved = sorted(adj.pop(v, {}).items(), key=key)
+        for (w, link) in moved:
+            if w != v:
+                del adj[w][v]
+        near = adj.setdefault(u, {})
+        for (w, link) in moved:
+            w = u if w == v else w
+            if w in near:
+                near[w][1] = link[1]
+            else:
+                near[w] = adj.setdefault(w, {})[u] = [stamp, link[1], r]
+                stamp += 1
+
+    return dict((k, near[k][1]) for k,near in adj.items() if k in near)
+
+def contract_nodes(CG, pairs):
+
+    """Contract nodes of a compact graph, like repeated nx.contracted_nodes calls
+
+    Every (u, v) pair merges node v into node u, in order. Edges of v move to u,
+    an edge between u and v becomes a self loop, and when two edges end up
+    between the same nodes the data of the edge that moved last is kept, as
+    with networkx 2.x (when v has both a self loop and an edge to u, the one
+    last in G.edges(v)). The graph is rebuilt once from the union-find roots
+    of the pairs. Node attributes of u are not changed, merge them before
+    contracting.
+
+    Parameters:
+        CG (dict): compact graph
+        pairs (list) : (u, v) node index pairs
+
+    Returns:
+        (CG,contraction_df) tuple(dict,pd.DataFrame) : contracted graph and the node
+            attributes of every contracted node v, indexed by (u, v) node names
+
+    """
+
+    pairs = [(int(u), int(v)) for u,v in pairs]
+    if len(pairs) == 0:
+        return (CG, pd.DataFrame())
+
+    n = len(CG['nodes'])
+    roots = contraction_roots(n, pairs)
+    alive = roots == np.arange(n)
+    new_index = np.cumsum(alive) - 1
+    src = new_index[roots[CG['src']]]
+    dst = new_index[roots[CG['dst']]]
+    (src, dst) = (np.minimum(src, dst), np.maximum(src, dst))
+
+    #edges ending up between the same nodes: when two of them meet, the one moved
+    #by that pair wins, self loops are worked out on the edges within the groups
+    order = np.lexsort((dst, src))
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = (src[order][1:] != src[order][:-1]) | (dst[order][1:] != dst[order][:-1])
+    bounds = np.r_[np.flatnonzero(first), len(order)]
+    sizes = np.diff(bounds)
+    multiple = np.repeat(sizes > 1, sizes)
+    loops = _self_loops(CG['src'], CG['dst'], roots, pairs)
+    winners = _moved_last(CG['src'], CG['dst'], pairs, order[multiple & (src[order] != dst[order])].tolist())
+    keep = np.unique(np.r_[order[~multiple], np.array(list(loops.values()) + winners, dtype=np.int64)])
+
+    names = CG['nodes']
+    (us, vs) = (np.array([p[0] for p in pairs]), np.array([p[1] for p in pairs]))
+    contraction_df = pd.DataFrame(dict((k, v[vs]) for k,v in CG['node_attrs'].items()),
+                                  index=pd.MultiIndex.from_arrays([names[us], names[vs]]))
+
+    CG = compact_graph(names[alive], src[keep], dst[keep],
+                       node_attrs=dict((k, v[alive]) for k,v in CG['node_attrs'].items()),
+                       edge_attrs=dict((k, v[keep]) for k,v in CG['edge_attrs'].items()))
+
+    return (CG, contraction_df)
+
+def from_networkx(G):
+
+    """Convert a networkx graph to a compact graph"""
+
+    nodes = list(G.nodes())
+    index = dict((n, k) for k,n in enumerate(nodes))
+    edges = list(G.edges(data=True))
+    src = np.array([index[u] for u,v,d in edges], dtype=np.int64)
+    dst = np.array([index[v] for u,v,d in edges], dtype=np.int64)
+
+    node_data = [G.nodes[n] for n in nodes]
+    node_keys = sorted(set(k for d in node_data for k in d))
+    node_attrs = dict((k, _column(d.get(k) for d in node_data)) for k in node_keys)
+    edge_keys = sorted(set(k for u,v,d in edges for k in d))
+    edge_attrs = dict((k, _column(d.get(k) for u,v,d in edges)) for k in edge_keys)
+
+    return compact_graph(nodes, src, dst, node_attrs=node_attrs, edge_attrs=edge_attrs)
+
+def to_networkx(G):
+
+    """Convert a compact graph to a networkx graph (networkx graphs are returned as is)"""
+
+    if not is_compact_graph(G):
+        return G
+
+    T = nx.Graph()
+    names = G['nodes'].tolist()
+    node_cols = [(k, v.tolist()) for k,v in G['node_attrs'].items()]
+    T.add_nodes_from((n, dict((k, col[i]) for k,col in node_cols if col[i] is not None))
+                     for i,n in enumerate(names))
+
+    edge_cols = [(k, v.tolist()) for k,v in G['edge_attrs'].items()]
+    T.add_edges_from((names[u], names[v], dict((k, col[e]) for k,col in edge_cols if col[e] is not None))
+                     for e,(u,v) in enumerate(zip(G['src'].tolist(), G['dst'].tolist())))
+
+    return T
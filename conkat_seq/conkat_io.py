@@ -0,0 +1,452 @@
+import os
+import json
+import shutil
+import itertools
+import numpy as np
+import pandas as pd
+import networkx as nx
+
+from helpers import log
+from helpers import format_wells
+
+from compact_graph import compact_graph
+from compact_graph import is_compact_graph
+from compact_graph import from_networkx
+from compact_graph import to_networkx
+
+OCCURRENCES_FORMAT = 'conkat-occurrences'
+OCCURRENCES_VERSION = 1
+
+#typed columns of the occurrences table, seeds and well lists are stored separately
+OCCURRENCES_COLUMNS = [('Ov1', np.int32), ('Ov2', np.int32), ('count', np.int32),
+                       ('a', np.int32), ('b', np.int32), ('c', np.int32), ('d', np.int32),
+                       ('P0', np.float64), ('odds', np.float64), ('pvalue', np.float64), ('P', np.float64)]
+
+#dtypes of all stored arrays of the occurrences table but the seed names
+_OCCURRENCES_DTYPES = dict([('V1', np.int32), ('V2', np.int32)] + OCCURRENCES_COLUMNS +
+                           [('wells_offsets', np.int64), ('wells_flat', np.int32)])
+
+def write_occurrences(df, fullpath, Nwells=None):
+
+    """Write an occurrences table to a binary columnar directory
+
+    Layout of the directory:
+        meta.json : format, version, number of rows, Nwells and df.attrs
+        seeds.npy : sorted seed names, V1.npy / V2.npy hold int32 codes into it
+        <column>.npy : one typed array per column of OCCURRENCES_COLUMNS
+        wells_offsets.npy / wells_flat.npy : wells of row k are flat[offsets[k]:offsets[k+1]]
+
+    Parameters:
+        df (pd.DataFrame): occurrences table from calc_domain_occurances
+        fullpath (str): output directory (replaced if it exists)
+        Nwells (int) : total number of wells (default is None)
+
+    Returns:
+
+    """
+
+    tmp_fullpath = fullpath.rstrip('/') + '.tmp'
+    if os.path.isdir(tmp_fullpath):
+        shutil.rmtree(tmp_fullpath)
+    os.makedirs(tmp_fullpath)
+
+    seeds = np.unique(np.concatenate((df['V1'].values, df['V2'].values)).astype(str))
+    np.save(os.path.join(tmp_fullpath, 'seeds.npy'), seeds)
+    for col in ['V1', 'V2']:
+        codes = np.searchsorted(seeds, df[col].values.astype(str)).astype(np.int32)
+        np.save(os.path.join(tmp_fullpath, col + '.npy'), codes)
+
+    for (col, dtype) in OCCURRENCES_COLUMNS:
+        if col in df.columns:
+            np.save(os.path.join(tmp_fullpath, col + '.npy'), df[col].values.astype(dtype))
+
+    if 'wells' in df.columns:
+        lengths = np.fromiter((len(x) for x in df['wells'].values), dtype=np.int64, count=len(df))
+        offsets = np.r_[0, np.cumsum(lengths)].astype(np.int64)
+        flat = np.fromiter(itertools.chain.from_iterable(df['wells'].values), dtype=np.int32, count=offsets[-1])
+        np.save(os.path.join(tmp_fullpath, 'wells_offsets.npy'), offsets)
+        np.save(os.path.join(tmp_fullpath, 'wells_flat.npy'), flat)
+
+    meta = {'format': OCCURRENCES_FORMAT, 'version': OCCURRENCES_VERSION, 'nrows': len(df),
+            'Nwells': (None if Nwells is None else int(Nwells)),
+            'attrs': dict((k, v) for k,v in df.attrs.items() if isinstance(v, (int, float, str)))}
+    with open(os.path.join(tmp_fullpath, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+
+    if os.path.isdir(fullpath):
+        shutil.rmtree(fullpath)
+    os.rename(tmp_fullpath, fullpath)
+
+def open_occurrences_writer(fullpath, seeds):
+
+    """Start a binary occurrences directory written block by block
+
+    The rows appended by append_occurrences go to raw column files of a temp
+    directory, close_occurrences_writer turns them into the layout of
+    write_occurrences without loading them.
+
+    Parameters:
+        fullpath (str): output directory (replaced when the writer is closed)
+        seeds (np.array) : seed names, V1 and V2 of the appended rows are indexes into it
+
+    Returns:
+        writer (dict) : 'fullpath', 'tmp_fullpath', 'files' (column -> raw file), 'nrows' and 'nflat'
+
+    """
+
+    tmp_fullpath = fullpath.rstrip('/') + '.tmp'
+    if os.path.isdir(tmp_fullpath):
+        shutil.rmtree(tmp_fullpath)
+    os.makedirs(tmp_fullpath)
+    np.save(os.path.join(tmp_fullpath, 'seeds.npy'), np.asarray(seeds).astype(str))
+
+    files = dict((c, open(os.path.join(tmp_fullpath, c + '.raw'), 'wb')) for c in _OCCURRENCES_DTYPES)
+    files['wells_offsets'].write(np.zeros(1, dtype=np.int64).tobytes())
+
+    return {'fullpath': fullpath, 'tmp_fullpath': tmp_fullpath, 'files': files, 'nrows': 0, 'nflat': 0}
+
+def append_occurrences(writer, V1, V2, Ov1, Ov2, offsets, flat, odds, pvals, Nwells):
+
+    """Append a block of tested pairs to an occurrences writer
+
+    The derived columns of calc_domain_occurances are computed and written one
+    at a time.
+
+    Parameters:
+        writer (dict): from open_occurrences_writer
+        V1 (np.array) : seed indexes of the first seeds
+        V2 (np.array) : seed indexes of the second seeds
+        Ov1 (np.array) : wells of the first seeds
+        Ov2 (np.array) : wells of the second seeds
+        offsets (np.array) : shared wells of pair k are flat[offsets[k]:offsets[k+1]]
+        flat (np.array) : shared well ids
+        odds (np.array) : Fisher test odds ratios
+        pvals (np.array) : Fisher test p-values
+        Nwells (int) : total number of wells
+
+    Returns:
+
+    """
+
+    def write(col, values):
+        writer['files'][col].write(np.asarray(values, dtype=_OCCURRENCES_DTYPES[col]).tobytes())
+
+    count = np.diff(offsets)
+    Ov1 = np.asarray(Ov1, dtype=np.int64)
+    Ov2 = np.asarray(Ov2, dtype=np.int64)
+    write('V1', V1)
+    write('V2', V2)
+    write('Ov1', Ov1)
+    write('Ov2', Ov2)
+    write('count', count)
+    write('a', count)
+    write('b', Ov1 - count)
+    write('c', Ov2 - count)
+    write('d', Nwells - (Ov1 + Ov2 - count))
+    write('P0', (Ov1 * Ov2) / float(Nwells**2))
+    write('odds', odds)
+    write('pvalue', pvals)
+    with np.errstate(divide='ignore'):
+        write('P', -np.log10(np.asarray(pvals, dtype=np.float64)))
+    write('wells_offsets', offsets[1:] + writer['nflat'])
+    write('wells_flat', flat)
+    writer['nrows'] += len(count)
+    writer['nflat'] += int(offsets[-1])
+
+def close_occurrences_writer(writer, Nwells=None, attrs=None):
+
+    """Turn the raw columns of an occurrences writer into the write_occurrences layout
+
+    Parameters:
+        writer (dict): from open_occurrences_writer
+        Nwells (int) : total number of wells (default is None)
+        attrs (dict) : table attributes saved in meta.json (default is None)
+
+    Returns:
+
+    """
+
+    for (col, f) in writer['files'].items():
+        f.close()
+        raw_fullpath = f.name
+        dtype = np.dtype(_OCCURRENCES_DTYPES[col])
+        with open(os.path.join(writer['tmp_fullpath'], col + '.npy'), 'wb') as out:
+            np.lib.format.write_array_header_1_0(out, {'descr': np.lib.format.dtype_to_descr(dtype),
+                                                       'fortran_order': False,
+                                                       'shape': (os.path.getsize(raw_fullpath) // dtype.itemsize,)})
+            with open(raw_fullpath, 'rb') as raw:
+                shutil.copyfileobj(raw, out, 2**24)
+        os.remove(raw_fullpath)
+
+    meta = {'format': OCCURRENCES_FORMAT, 'version': OCCURRENCES_VERSION, 'nrows': writer['nrows'],
+            'Nwells': (None if Nwells is None else int(Nwells)),
+            'attrs': dict((k, v) for k,v in (attrs or {}).items() if isinstance(v, (int, float, str)))}
+    with open(os.path.join(writer['tmp_fullpath'], 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+
+    if os.path.isdir(writer['fullpath']):
+        shutil.rmtree(writer['fullpath'])
+    os.rename(writer['tmp_fullpath'], writer['fullpath'])
+
+def discard_occurrences_writer(writer):
+
+    """Close the raw files of an unfinished occurrences writer and remove its temp directory"""
+
+    for f in writer['files'].values():
+        f.close()
+    shutil.rmtree(writer['tmp_fullpath'], ignore_errors=True)
+
+def read_occurrences_meta(fullpath):
+
+    """Read the meta data of a binary occurrences directory
+
+    Raises:
+        IOError: Not a binary occurrences directory.
+    """
+
+    meta_fullpath = os.path.join(fullpath, 'meta.json')
+    if not os.path.isfile(meta_fullpath):
+        raise IOError('Not a binary occurrences directory -> %s' % fullpath)
+    with open(meta_fullpath) as f:
+        meta = json.load(f)
+    if meta.get('format') != OCCURRENCES_FORMAT:
+        raise IOError('Not a binary occurrences directory -> %s' % fullpath)
+
+    return meta
+
+def read_occurrences_column(fullpath, column, mmap=True):
+
+    """Load one stored array ('seeds', 'V1', 'pvalue', 'wells_offsets', ...) of a binary occurrences directory"""
+
+    return np.load(os.path.join(fullpath, column + '.npy'), mmap_mode=('r' if mmap else None))
+
+def read_occurrences(fullpath, columns=None, mmap=True):
+
+    """Load an occurrences table written by write_occurrences
+
+    Parameters:
+        fullpath (str): binary occurrences directory
+        columns (list) : columns to load, 'V1'/'V2' are decoded to seed names and
+            'wells' is rebuilt as lists (default is None, all columns)
+        mmap (bool) : memory-map the stored arrays (default is True)
+
+    Returns:
+        df (pd.DataFrame) : with df.attrs restored
+
+    Raises:
+        IOError: Not a binary occurrences directory.
+    """
+
+    meta = read_occurrences_meta(fullpath)
+    stored = [c for c,dtype in OCCURRENCES_COLUMNS if os.path.isfile(os.path.join(fullpath, c + '.npy'))]
+    has_wells = os.path.isfile(os.path.join(fullpath, 'wells_offsets.npy'))
+    if columns is None:
+        columns = ['V1', 'V2'] + stored + (['wells'] if has_wells else [])
+
+    df = pd.DataFrame(index=pd.RangeIndex(meta['nrows']))
+    seeds = None
+    for col in columns:
+        if col in ['V1', 'V2']:
+            if seeds is None:
+                seeds = read_occurrences_column(fullpath, 'seeds', mmap=False).astype(object)
+            df[col] = seeds[read_occurrences_column(fullpath, col, mmap)]
+        elif col == 'wells':
+            offsets = read_occurrences_column(fullpath, 'wells_offsets', mmap)
+            flat = read_occurrences_column(fullpath, 'wells_flat', mmap=False).tolist()
+            df[col] = [flat[offsets[k]:offsets[k+1]] for k in range(meta['nrows'])]
+        else:
+            df[col] = read_occurrences_column(fullpath, col, mmap)
+
+    df.attrs.update(meta['attrs'])
+
+    return df
+
+NETWORK_FORMAT = 'conkat-network'
+NETWORK_VERSION = 2
+
+def _write_network_column(dirpath, name, values):
+
+    """Save one attribute column, returns its kind ('numeric', 'wells' or 'string')
+
+    Numeric columns are saved as a single .npy, integer arrays (well sets) as
+    flat int32 values with offsets, strings as utf-8 bytes with offsets.
+    Missing values (None) are recorded in a <name>_missing.npy mask.
+    """
+
+    values = np.asarray(values)
+    missing = None
+    if values.dtype.kind == 'O':
+        missing = np.array([v is None for v in values], dtype=bool)
+        present = values[~missing]
+        if len(present) and all(isinstance(v, np.ndarray) for v in present):
+            arrays = [np.zeros(0, dtype=np.int32) if m else v for v,m in zip(values, missing)]
+            lengths = np.fromiter((len(v) for v in arrays), dtype=np.int64, count=len(arrays))
+            np.save(os.path.join(dirpath, name + '_offsets.npy'), np.r_[0, np.cumsum(lengths)].astype(np.int64))
+            np.save(os.path.join(dirpath, name + '_values.npy'),
+                    np.concatenate(arrays).astype(np.int32) if len(arrays) else np.zeros(0, dtype=np.int32))
+            if missing.any():
+                np.save(os.path.join(dirpath, name + '_missing.npy'), missing)
+            return 'wells'
+        if all(isinstance(v, (int, float, np.integer, np.floating)) and not isinstance(v, bool) for v in present):
+            values = np.array([np.nan if m else v for v,m in zip(values, missing)], dtype=np.float64)
+        else:
+            values = np.array(['' if m else str(v) for v,m in zip(values, missing)], dtype=object)
+        if not missing.any():
+            missing = None
+    if missing is not None:
+        np.save(os.path.join(dirpath, name + '_missing.npy'), missing)
+
+    if values.dtype.kind in 'biuf':
+        np.save(os.path.join(dirpath, name + '.npy'), values)
+        return 'numeric'
+
+    encoded = [str(v).encode('utf-8') for v in values]
+    lengths = np.fromiter((len(x) for x in encoded), dtype=np.int64, count=len(encoded))
+    np.save(os.path.join(dirpath, name + '_offsets.npy'), np.r_[0, np.cumsum(lengths)].astype(np.int64))
+    np.save(os.path.join(dirpath, name + '_bytes.npy'), np.frombuffer(b''.join(encoded), dtype=np.uint8))
+    return 'string'
+
+def _read_network_column(dirpath, name, kind, mmap=True):
+
+    """Load one attribute column saved by _write_network_column"""
+
+    mmap_mode = 'r' if mmap else None
+    if kind == 'numeric':
+        values = np.load(os.path.join(dirpath, name + '.npy'), mmap_mode=mmap_mode)
+    elif kind == 'wells':
+        offsets = np.load(os.path.join(dirpath, name + '_offsets.npy'))
+        flat = np.load(os.path.join(dirpath, name + '_values.npy'))
+        values = np.empty(len(offsets) - 1, dtype=object)
+        for k in range(len(offsets) - 1):
+            values[k] = flat[offsets[k]:offsets[k+1]]
+    else:
+        offsets = np.load(os.path.join(dirpath, name + '_offsets.npy')).tolist()
+        blob = np.load(os.path.join(dirpath, name + '_bytes.npy')).tobytes()
+        values = np.empty(len(offsets) - 1, dtype=object)
+        values[:] = [blob[offsets[k]:offsets[k+1]].decode('utf-8') for k in range(len(offsets) - 1)]
+
+    missing_fullpath = os.path.join(dirpath, name + '_missing.npy')
+    if os.path.isfile(missing_fullpath):
+        missing = np.load(missing_fullpath)
+        values = np.array(values, dtype=object)
+        values[missing] = None
+
+    return values
+
+def write_network(G, fullpath):
+
+    """Write a network to a binary node table + edge table directory
+
+    Layout of the directory:
+        meta.json : format, version, number of nodes and edges, attribute columns and their kind
+            (numeric, wells or string)
+        nodes_* : node names (string column)
+        src.npy / dst.npy : int32 edge end points, indexes into the nodes
+        node_<attr>_* / edge_<attr>_* : one column per node and edge attribute
+
+    Parameters:
+        G (nx.network or compact graph): network to save
+        fullpath (str): output directory (replaced if it exists)
+
+    Returns:
+
+    """
+
+    CG = G if is_compact_graph(G) else from_networkx(G)
+
+    tmp_fullpath = fullpath.rstrip('/') + '.tmp'
+    if os.path.isdir(tmp_fullpath):
+        shutil.rmtree(tmp_fullpath)
+    os.makedirs(tmp_fullpath)
+
+    _write_network_column(tmp_fullpath, 'nodes', CG['nodes'])
+    np.save(os.path.join(tmp_fullpath, 'src.npy'), CG['src'])
+    np.save(os.path.join(tmp_fullpath, 'dst.npy'), CG['dst'])
+    node_columns = dict((k, _write_network_column(tmp_fullpath, 'node_' + k, v)) for k,v in CG['node_attrs'].items())
+    edge_columns = dict((k, _write_network_column(tmp_fullpath, 'edge_' + k, v)) for k,v in CG['edge_attrs'].items())
+
+    meta = {'format': NETWORK_FORMAT, 'version': NETWORK_VERSION,
+            'nnodes': len(CG['nodes']), 'nedges': len(CG['src']),
+            'node_columns': node_columns, 'edge_columns': edge_columns}
+    with open(os.path.join(tmp_fullpath, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+
+    if os.path.isdir(fullpath):
+        shutil.rmtree(fullpath)
+    os.rename(tmp_fullpath, fullpath)
+
+def read_network_meta(fullpath):
+
+    """Read the meta data of a binary network directory
+
+    Raises:
+        IOError: Not a binary network directory.
+    """
+
+    meta_fullpath = os.path.join(fullpath, 'meta.json')
+    if not os.path.isfile(meta_fullpath):
+        raise IOError('Not a binary network directory -> %s' % fullpath)
+    with open(meta_fullpath) as f:
+        meta = json.load(f)
+    if meta.get('format') != NETWORK_FORMAT:
+        raise IOError('Not a binary network directory -> %s' % fullpath)
+
+    return meta
+
+def read_network(fullpath, node_columns=None, edge_columns=None, backend='compact', mmap=True):
+
+    """Load a network written by write_network
+
+    Parameters:
+        fullpath (str): binary network directory
+        node_columns (list) : node attributes to load (default is None, all)
+        edge_columns (list) : edge attributes to load (default is None, all)
+        backend (str) : 'compact' or 'networkx' (default is 'compact')
+        mmap (bool) : memory-map numeric columns (default is True)
+
+    Returns:
+        G (compact graph or nx.network) :
+
+    Raises:
+        IOError: Not a binary network directory.
+    """
+
+    meta = read_network_meta(fullpath)
+    if node_columns is None:
+        node_columns = list(meta['node_columns'])
+    if edge_columns is None:
+        edge_columns = list(meta['edge_columns'])
+
+    nodes = _read_network_column(fullpath, 'nodes', 'string')
+    src = np.load(os.path.join(fullpath, 'src.npy'))
+    dst = np.load(os.path.join(fullpath, 'dst.npy'))
+    node_attrs = dict((k, _read_network_column(fullpath, 'node_' + k, meta['node_columns'][k], mmap))
+                      for k in node_columns if k in meta['node_columns'])
+    edge_attrs = dict((k, _read_network_column(fullpath, 'edge_' + k, meta['edge_columns'][k], mmap))
+                      for k in edge_columns if k in meta['edge_columns'])
+
+    CG = compact_graph(nodes, src, dst, node_attrs=node_attrs, edge_attrs=edge_attrs)
+    if backend == 'networkx':
+        return to_networkx(CG)
+
+    return CG
+
+def write_graphml(G, fullpath):
+
+    """Export a network as GraphML (Cytoscape), well sets in their '_' joined string form
+
+    Parameters:
+        G (nx.network or compact graph): network to export
+        fullpath (str): output .graphml file
+
+    Returns:
+
+    """
+
+    T = to_networkx(G)
+    if T is G:
+        T = G.copy()
+    for (n, wells) in nx.get_node_attributes(T, 'well').items():
+        T.nodes[n]['well'] = format_wells(wells)
+
+    nx.write_graphml(T, fullpath)
@@ -10,12 +10,35 @@ Parameters:
     min_shared_occurances (int): only analyze domain pairs with co-occurances > min_shared_occurances
     alpha (float) : maximal adjusted p-value threshold, default = 10**-6
     fdr (True/False): p-value correction for multiple tests using two-stage Benjamini, Krieger, & Yekutieli, default = True'
+    sweep (float): also build the networks of several alphas in one pass, default = None
+    sweep_fdr (True/False): corrections of the sweep networks, default = fdr
+    count_engine (str): pair counting engine, sparse (incidence matrix product), chunked (seed blocks spilled to disk) or loop (per-well pairs), default = sparse
+    memory_budget (float): peak memory in MB of chunked pair counting per worker, tested pairs are streamed to the occurrences table, default = 1024
+    spill_dir (str): directory for chunked pair counting temp files, default = OUTPATH
+    workers (int): number of processes for co-occurrence counting and testing and edge flagging, default = 1
+    incremental (flag) : update co-occurrences from the occurrence state saved in OUTPATH, default = False
+    prune (flag) : skip domain pairs that can not reach significance at alpha, default = False
+    export_csv (flag) : also export the occurrences table as CSV, default = False
+    export_graphml (flag) : also export the networks as GraphML (Cytoscape), default = False
+    graph_backend (str): network representation, networkx (dict of dicts) or compact (CSR arrays, converted to networkx for export), default = networkx
     merge_similar (float) : identify threshold for merging similar domains within networks, default = 0. (0 to skip)
-    threads (int): number of threads to use by vsearch, default = 1
+    threads (int): total number of vsearch threads, shared by the network clustering jobs running at once, default = 20
+    merge_batch_size (int): sequences per vsearch call clustering several networks at once, default = 50000 (0 for one call per network)
+    inprocess_cluster_max (int): networks of up to inprocess_cluster_max domains of equal length are clustered in process instead of by vsearch, default = 0
+    cluster_cache (str): sqlite file keeping the clustering of every network between runs, default = None
+    cluster_cache_mb (float): size bound of the clustering cache in MB, least recently used networks are evicted, default = 1024
+    command_timeout (float): seconds before an external command (vsearch) is killed, default = None (no limit)
     
     flag_edges (flag) : run monte carlo analysis to flag edges potenially affected by index swapping, default = False
+    exact_null_max (int): exact null distributions of edges sharing up to exact_null_max wells (monte carlo above), default = 64
+    null_table (str): .npz file keeping the null distributions between runs, default = None
+    adaptive_flag (flag) : stop monte carlo draws once every edge is decided at 99% confidence, the 1% error spent over the successive looks, default = False
+    max_draws (int): monte carlo draws of borderline edges with adaptive_flag, default = 500
+    random_seed (int): seed of the edge flagging monte carlo draws, default = 0
+    wells_per_plate (int): plate format of the library subpools (96, 384 or 1536), default = 384
+    nplates (int): number of library plates, default = plates holding the largest well id
     verbose (flag) : increase output verbosity, default = False
-    override (flag) : ignore and re-write existing files, default = False
+    override (flag) : recompute every stage, ignoring the stage cache (OUTPATH/MANIFEST.json), default = False
 
 """
 
@@ -39,14 +62,43 @@ from collections import defaultdict
 from itertools import combinations
 from scipy import stats
 import tempfile
+import time
 
 from helpers import log
 from helpers import ensure_dir  
+from helpers import format_wells
+from helpers import configure_commands
 
 from conkat_utils import calc_domain_occurances
 from conkat_utils import build_graph
+from conkat_utils import threshold_sweep
+from conkat_utils import load_occurrence_state
+from conkat_utils import save_occurrence_state
+from conkat_io import read_occurrences
+
 from conkat_utils import flag_barcode_swap_edges   
+from conkat_utils import load_null_table
+from conkat_utils import save_null_table
 from conkat_utils import merge_similar_nodes
+from conkat_utils import MIN_NET_SIZE
+from conkat_utils import MERGE_MAXREJECTS
+from conkat_io import read_network
+from conkat_io import write_network
+from conkat_io import write_graphml
+from compact_graph import copy_graph
+from compact_graph import remove_edges
+from compact_graph import to_networkx
+from stage_cache import file_digest
+from stage_cache import load_manifest
+from stage_cache import save_manifest
+from stage_cache import check_stage
+from stage_cache import record_stage
+from checkpoint import open_checkpoint
+from checkpoint import remove_checkpoint
+from plate_geometry import plate_geometry
+from plate_geometry import plates_needed
+from cluster_cache import open_cluster_cache
+from cluster_cache import close_cluster_cache
 
 if __name__ == "__main__":
 
@@ -72,19 +124,90 @@ if __name__ == "__main__":
                         help='p-value correction for multiple tests using two-stage Benjamini, Krieger, & Yekutieli (True/False)',
                         required=False, type=str, default='True')
 
+    parser.add_argument('--sweep', nargs='+',
+                        help='also build the networks of several alphas (e.g. 1e-4 1e-6 1e-8) in one pass',
+                        required=False, type=str, default=None)
+
+    parser.add_argument('--sweep_fdr', nargs='+',
+                        help='corrections of the sweep networks (True/False), default = --fdr',
+                        required=False, type=str, default=None, choices=['True','False'])
+
+    parser.add_argument('--count_engine', help='pair counting engine, sparse (incidence matrix product), chunked (seed blocks spilled to disk) or loop (per-well pairs), default = sparse',
+                        required=False, type=str, default='sparse', choices=['sparse','chunked','loop'])
+
+    parser.add_argument('--memory_budget', help='peak memory in MB of chunked pair counting per worker, tested pairs are streamed to the occurrences table, default = 1024',
+                        required=False, type=float, default=1024)
+
+    parser.add_argument('--spill_dir', help='directory for chunked pair counting temp files, default = OUTPATH',
+                        required=False, type=str, default=None)
+
+    parser.add_argument('--workers', help='number of processes for co-occurrence counting and testing and edge flagging, default = 1',
+                        required=False, type=int, default=1)
+
+    parser.add_argument('--incremental', help='update co-occurrences from the occurrence state saved in OUTPATH, only recounting wells that changed, default = False',
+                        required=False, action='store_true')
+
+    parser.add_argument('--prune', help='skip domain pairs that can not reach significance at alpha, default = False',
+                        required=False, action='store_true')
+
+    parser.add_argument('--export_csv', help='also export the occurrences table as CSV, default = False',
+                        required=False, action='store_true')
+
+    parser.add_argument('--export_graphml', help='also export the networks as GraphML (Cytoscape), default = False',
+                        required=False, action='store_true')
+
+    parser.add_argument('--graph_backend', help='network representation, networkx (dict of dicts) or compact (CSR arrays, converted to networkx for export), default = networkx',
+                        required=False, type=str, default='networkx', choices=['networkx','compact'])
+
     parser.add_argument('--merge_similar_id', help='identify threshold for merging similar domains within networks, default = 0.9',
                         required=False, type=float, default=0.9)
 
-    parser.add_argument('--threads', help='number of threads to use by vsearch, default = 20',
+    parser.add_argument('--threads', help='total number of vsearch threads, shared by the network clustering jobs running at once, default = 20',
                         type=int, default=20)
 
+    parser.add_argument('--merge_batch_size', help='sequences per vsearch call clustering several networks at once, default = 50000 (0 for one call per network)',
+                        required=False, type=int, default=50000)
+
+    parser.add_argument('--inprocess_cluster_max', help='networks of up to inprocess_cluster_max domains of equal length are clustered in process instead of by vsearch, default = 0',
+                        required=False, type=int, default=0)
+
+    parser.add_argument('--cluster_cache', help='sqlite file keeping the clustering of every network between runs, default = None',
+                        required=False, type=str, default=None)
+
+    parser.add_argument('--cluster_cache_mb', help='size bound of the clustering cache in MB, least recently used networks are evicted, default = 1024',
+                        required=False, type=float, default=1024)
+
+    parser.add_argument('--command_timeout', help='seconds before an external command (vsearch) is killed, default = None (no limit)',
+                        required=False, type=float, default=None)
+
     parser.add_argument('--flag_edges', help='run monte carlo analysis to flag edges potenially affected by index swapping, default = False',
                         required=False, action='store_true')
 
+    parser.add_argument('--exact_null_max', help='exact null distributions of edges sharing up to exact_null_max wells (monte carlo above), default = 64',
+                        required=False, type=int, default=64)
+
+    parser.add_argument('--null_table', help='.npz file keeping the null distributions of edge flagging between runs, default = None',
+                        required=False, type=str, default=None)
+
+    parser.add_argument('--adaptive_flag', help='stop monte carlo draws once every edge is decided at 99%% confidence, the 1%% error spent over the successive looks, default = False',
+                        required=False, action='store_true')
+
+    parser.add_argument('--max_draws', help='monte carlo draws of borderline edges with --adaptive_flag, default = 500',
+                        required=False, type=int, default=500)
+
+    parser.add_argument('--random_seed', help='seed of the edge flagging monte carlo draws, default = 0',
+                        required=False, type=int, default=0)
+
+    parser.add_argument('--wells_per_plate', help='plate format of the library subpools, default = 384',
+                        required=False, type=int, default=384, choices=[96, 384, 1536])
+
+    parser.add_argument('--nplates', help='number of library plates, default = plates holding the largest well id',
+                        required=False, type=int, default=None)
+
     parser.add_argument('--verbose', help='increase output verbosity',
                         action='store_true')
 
-    parser.add_argument('--override', help='re-write existing files',
+    parser.add_argument('--override', help='recompute every stage, ignoring the stage cache',
                         action='store_true')
 
     args = parser.parse_args()
@@ -95,6 +218,15 @@ if __name__ == "__main__":
     OUTPATH = args.outpath
 
     min_pair_count = args.min_shared_occurances
+    count_engine = args.count_engine
+    memory_budget = args.memory_budget
+    spill_dir = args.spill_dir
+    prune = args.prune
+    export_csv = args.export_csv
+    graph_backend = args.graph_backend
+    export_graphml = args.export_graphml
+    workers = args.workers
+    incremental = args.incremental
     alpha = float(eval(args.alpha))
     if alpha < 0:
         print('Negative alpha value -> %s' % alpha )
@@ -102,7 +234,19 @@ if __name__ == "__main__":
 
 
     merge_similar_id = args.merge_similar_id
+    merge_batch_size = args.merge_batch_size
+    inprocess_cluster_max = args.inprocess_cluster_max
+    cluster_cache_fullpath = args.cluster_cache
+    cluster_cache_mb = args.cluster_cache_mb
+    command_timeout = args.command_timeout
     flag_edges = args.flag_edges
+    exact_null_max = args.exact_null_max
+    null_table_fullpath = args.null_table
+    adaptive_flag = args.adaptive_flag
+    max_draws = args.max_draws
+    random_seed = args.random_seed
+    wells_per_plate = args.wells_per_plate
+    nplates = args.nplates
 
     threads = args.threads                     
     verbose = args.verbose
@@ -114,10 +258,22 @@ if __name__ == "__main__":
     else:
         method = 'fdr_tsbky'
 
+    sweep_alphas = None
+    if args.sweep:
+        sweep_alphas = [float(eval(x)) for x in args.sweep]
+        sweep_methods = [('pvalue' if x == 'False' else 'fdr_tsbky') for x in (args.sweep_fdr or [fdr])]
+        if prune:
+            log('--prune is ignored with --sweep, pruned tables only hold for a single alpha')
+            prune = False
+
     ###
 
     ensure_dir(OUTPATH)
 
+    #wall time, cpu time and memory of every external command
+    performance_log = OUTPATH + 'PERFORMANCE_' + time.strftime('%Y%m%d-%H%M%S') + '.tsv'
+    configure_commands(perf_log=performance_log, timeout=command_timeout)
+
     frames = []
     for clustering_dataframe_file in list_of_clustering_dataframes:
         try:
@@ -136,57 +292,189 @@ if __name__ == "__main__":
     merged_filtered_clustering_table_fullpath = OUTPATH + 'CLUSTERING-DATAFRAME_' + '#'.join(DOMAINS) + '.csv'
     merged_filtered_clustering_table.to_csv(merged_filtered_clustering_table_fullpath)  
 
-    domain_occurances_table_fullpath = OUTPATH + 'OCCURRENCES-DATAFRAME_' + '#'.join(DOMAINS) + '.csv'
+    #stage cache, every stage is keyed by its parameters and the keys/digests of its inputs
+    manifest_fullpath = OUTPATH + 'MANIFEST.json'
+    manifest = load_manifest(manifest_fullpath)
+    input_digests = dict(('input%s:%s' % (k, os.path.basename(x)), file_digest(x))
+                         for k,x in enumerate(list_of_clustering_dataframes))
+
+    domain_occurances_table_fullpath = OUTPATH + 'OCCURRENCES-DATAFRAME_' + '#'.join(DOMAINS) + '.occ'
+    #pruned tables depend on alpha and method
+    if prune:
+        domain_occurances_table_fullpath = domain_occurances_table_fullpath.replace('.occ', '_PRUNED_%s_%s.occ' % (method, alpha))
     #calculate multi-domain co-occurances 
 
+    #the occurrence state is shared by all domain combinations in OUTPATH
+    occurrence_state_fullpath = OUTPATH + 'OCCURRENCES-STATE.npz'
 
-    if os.path.isfile(domain_occurances_table_fullpath):
+    #counting engines, workers and incremental updates give identical tables
+    stage = 'occurrences:' + os.path.basename(domain_occurances_table_fullpath)
+    params = {'min_pair_count': min_pair_count, 'prune': prune,
+              'alpha': (alpha if prune else None), 'method': (method if prune else None)}
+    outputs = [domain_occurances_table_fullpath]
+    (hit, occurrences_key, reason) = check_stage(manifest, stage, params, input_digests, outputs, override)
+    if hit:
         log('File exists --> %s' % domain_occurances_table_fullpath)
-        domain_occurances_table = pd.read_csv(domain_occurances_table_fullpath,index_col=0)
+        #build_graph only needs the pairs and their p-values
+        domain_occurances_table = read_occurrences(domain_occurances_table_fullpath, columns=['V1','V2','pvalue'])
     else:
         log('Calculating domain co-occurances...')
+        occurrence_state = None
+        if incremental:
+            occurrence_state = {}
+            if os.path.isfile(occurrence_state_fullpath):
+                log('Updating occurrence state --> %s' % occurrence_state_fullpath)
+                occurrence_state = load_occurrence_state(occurrence_state_fullpath)
         domain_occurances_table = calc_domain_occurances(merged_filtered_clustering_table, 
-            min_pair_count, verb=verbose)
-        domain_occurances_table.to_csv(domain_occurances_table_fullpath)
-
-    networkFile = OUTPATH + 'NETWORKS#' +  '#'.join(DOMAINS) + '_' + str(alpha) +'.graphml'
-
-    if (os.path.isfile(networkFile) & ~(override)):
+            min_pair_count, verb=verbose, engine=count_engine,
+            alpha=(alpha if prune else None), method=method,
+            memory_budget=(memory_budget if count_engine == 'chunked' else None),
+            spill_dir=(spill_dir if spill_dir else OUTPATH), workers=workers,
+            state=occurrence_state, output=domain_occurances_table_fullpath)
+        if incremental:
+            save_occurrence_state(occurrence_state, occurrence_state_fullpath)
+    record_stage(manifest, stage, occurrences_key, params, input_digests, outputs, hit, reason)
+    save_manifest(manifest, manifest_fullpath)
+
+    if export_csv:
+        domain_occurances_csv_fullpath = domain_occurances_table_fullpath.replace('.occ', '.csv')
+        if 'wells' not in domain_occurances_table.columns:
+            read_occurrences(domain_occurances_table_fullpath).to_csv(domain_occurances_csv_fullpath)
+        else:
+            domain_occurances_table.to_csv(domain_occurances_csv_fullpath)
+        log('Occurrences table exported --> %s' % domain_occurances_csv_fullpath)
+
+    #node annotations come from the input dataframes, covered by the occurrences key
+    if sweep_alphas:
+        sweep_summary_fullpath = OUTPATH + 'SWEEP-SUMMARY#' + '#'.join(DOMAINS) + '.csv'
+        sweep_methods = sorted(set(sweep_methods))
+        sweep_files = [OUTPATH + 'NETWORKS#' + '#'.join(DOMAINS) + '_%s_%s.net' % (m, a)
+                       for m in sweep_methods for a in sorted(sweep_alphas)]
+        stage = 'sweep:' + os.path.basename(sweep_summary_fullpath)
+        params = {'alphas': sorted(sweep_alphas), 'methods': sweep_methods}
+        inputs = {'occurrences': occurrences_key}
+        outputs = [sweep_summary_fullpath] + sweep_files
+        (hit, key, reason) = check_stage(manifest, stage, params, inputs, outputs, override)
+        if not hit:
+            log('Building sweep networks...')
+            summary = []
+            for (sweep_method, sweep_alpha, S, counts) in threshold_sweep(domain_occurances_table, 
+                    merged_filtered_clustering_table, sweep_alphas, sweep_methods,
+                    verb=verbose, ntests=domain_occurances_table.attrs.get('ntests'), backend=graph_backend):
+                write_network(S, OUTPATH + 'NETWORKS#' + '#'.join(DOMAINS) + '_%s_%s.net' % (sweep_method, sweep_alpha))
+                counts.update({'method': sweep_method, 'alpha': sweep_alpha})
+                summary.append(counts)
+            pd.DataFrame(summary, columns=['method','alpha','nodes','edges','components']).to_csv(sweep_summary_fullpath)
+            log('Sweep summary saved --> %s' % sweep_summary_fullpath)
+        record_stage(manifest, stage, key, params, inputs, outputs, hit, reason)
+        save_manifest(manifest, manifest_fullpath)
+        if export_graphml:
+            for sweepFile in sweep_files:
+                write_graphml(read_network(sweepFile), sweepFile.replace('.net','.graphml'))
+
+    networkFile = OUTPATH + 'NETWORKS#' +  '#'.join(DOMAINS) + '_' + str(alpha) +'.net'
+
+    stage = 'graph:' + os.path.basename(networkFile)
+    params = {'alpha': alpha, 'method': method}
+    inputs = {'occurrences': occurrences_key}
+    (hit, graph_key, reason) = check_stage(manifest, stage, params, inputs, [networkFile], override)
+    if hit:
         log('File exists --> %s' % networkFile)
-        G = nx.read_graphml(networkFile)
+        G = read_network(networkFile, backend=graph_backend)
     else:
         log('Building domain clustering graph...')
         G = build_graph(domain_occurances_table, merged_filtered_clustering_table, 
-            alpha, method)
+            alpha, method, ntests=domain_occurances_table.attrs.get('ntests'),
+            backend=graph_backend)
 
-        nx.write_graphml(G, networkFile)
+        write_network(G, networkFile)
+    record_stage(manifest, stage, graph_key, params, inputs, [networkFile], hit, reason)
+    save_manifest(manifest, manifest_fullpath)
+    if export_graphml:
+        write_graphml(G, networkFile.replace('.net','.graphml'))
 
     #flag hop
-    network_flagged = networkFile.replace('.graphml','_EDGE_FLAG.graphml')
-    if (os.path.isfile(network_flagged) & ~(override) & (flag_edges)):
-        log('File exists --> %s' % network_flagged)
-        P = nx.read_graphml(network_flagged)
-    elif (flag_edges):
-        log('flagging edges potentially affected by index swapping...')
-        (G,P,flag) = flag_barcode_swap_edges(G, N=500, verb=verbose)
-        nx.write_graphml(G, networkFile.replace('.graphml','_EDGE_FLAG.graphml'))
+    network_flagged = networkFile.replace('.net','_EDGE_FLAG.net')
+    merge_input_key = graph_key
+    if flag_edges:
+        stage = 'flag:' + os.path.basename(network_flagged)
+        if nplates is None:
+            nplates = plates_needed(merged_filtered_clustering_table['well'].values, wells_per_plate)
+        geometry = plate_geometry(wells_per_plate, nplates)
+        params = {'pval': 0.05, 'N': 500, 'exact_null_max': exact_null_max, 'random_seed': random_seed,
+                  'wells_per_plate': wells_per_plate, 'nplates': nplates}
+        if adaptive_flag:
+            params.update(adaptive=True, max_draws=max_draws, spending='bonferroni_looks')
+        inputs = {'graph': graph_key}
+        (hit, merge_input_key, reason) = check_stage(manifest, stage, params, inputs, [network_flagged], override)
+        if hit:
+            log('File exists --> %s' % network_flagged)
+            G = read_network(network_flagged)
+            #flagged edges are kept in the saved network
+            P = remove_edges(G, G['edge_attrs']['hopFlag'] == 1)
+            if graph_backend == 'networkx':
+                (G,P) = (to_networkx(G),to_networkx(P))
+        else:
+            log('flagging edges potentially affected by index swapping...')
+            checkpoint = open_checkpoint(network_flagged.replace('.net','.ckpt'), merge_input_key)
+            if null_table_fullpath:
+                null_table = load_null_table(null_table_fullpath, N=500, exact_max=exact_null_max, geometry=geometry)
+            else:
+                null_table = None
+            (G,P,flag) = flag_barcode_swap_edges(G, N=500, verb=verbose, null_table=null_table, exact_max=exact_null_max,
+                                                 adaptive=adaptive_flag, max_N=max_draws,
+                                                 random_seed=random_seed, workers=workers, checkpoint=checkpoint,
+                                                 geometry=geometry)
+            if null_table_fullpath:
+                save_null_table(null_table, null_table_fullpath)
+            write_network(G, network_flagged)
+            remove_checkpoint(checkpoint)
+        record_stage(manifest, stage, merge_input_key, params, inputs, [network_flagged], hit, reason)
+        save_manifest(manifest, manifest_fullpath)
+        if export_graphml:
+            write_graphml(G, network_flagged.replace('.net','.graphml'))
     else:
-        P = G.copy()
+        P = copy_graph(G)
 
     #compress graph (test might have issues)
-    network_compressed = networkFile.replace('.graphml','_COMPRESSED.graphml')
-    contraction_df_fullpath = OUTPATH + 'MERGED-NODES-DATAFRAME#' + '#'.join(DOMAINS) + '.csv'
-    if (os.path.isfile(network_compressed) & (os.path.isfile(contraction_df_fullpath))
-     & ~(bool(override)) & (bool(merge_similar_id))):
-        log('File exists --> %s' % network_compressed)
-        C = nx.read_graphml(network_compressed)
-        contraction_df = pd.read_csv(contraction_df_fullpath)
-    elif (merge_similar_id):
-        log('merging similar domains within networks...')
-        (contraction_df,C) = merge_similar_nodes(P, cluster_id=merge_similar_id)  
-        nx.write_graphml(C,network_compressed)
-        contraction_df_fullpath = OUTPATH + 'MERGED_DOMAINS#' + '#'.join(DOMAINS) + '_' + str(alpha) + '.csv'
-        if len(contraction_df) > 0:
-            contraction_df.to_csv(contraction_df_fullpath)
+    network_compressed = networkFile.replace('.net','_COMPRESSED.net')
+    contraction_df_fullpath = OUTPATH + 'MERGED_DOMAINS#' + '#'.join(DOMAINS) + '_' + str(alpha) + '.csv'
+    if merge_similar_id:
+        stage = 'merge:' + os.path.basename(network_compressed)
+        min_net_size = MIN_NET_SIZE
+        params = {'merge_similar_id': merge_similar_id, 'min_net_size': min_net_size, 'batch_size': merge_batch_size,
+                  'inprocess_max': inprocess_cluster_max, 'maxrejects': MERGE_MAXREJECTS}
+        inputs = {('flag' if flag_edges else 'graph'): merge_input_key}
+        outputs = [network_compressed, contraction_df_fullpath]
+        (hit, key, reason) = check_stage(manifest, stage, params, inputs, outputs, override)
+        if hit:
+            log('File exists --> %s' % network_compressed)
+            C = read_network(network_compressed, backend=graph_backend)
+            contraction_df = pd.read_csv(contraction_df_fullpath) if os.path.isfile(contraction_df_fullpath) else pd.DataFrame()
+        else:
+            log('merging similar domains within networks...')
+            checkpoint = open_checkpoint(network_compressed.replace('.net','.ckpt'), key)
+            cache = open_cluster_cache(cluster_cache_fullpath, cluster_cache_mb) if cluster_cache_fullpath else None
+            try:
+                (contraction_df,C) = merge_similar_nodes(P, cluster_id=merge_similar_id, min_net_size=min_net_size,
+                                                       checkpoint=checkpoint,
+                                                       threads=threads, batch_size=merge_batch_size,
+                                                       inprocess_max=inprocess_cluster_max, cache=cache)
+            finally:
+                #keep the clusterings stored before a failure
+                if cache is not None:
+                    close_cluster_cache(cache)
+            write_network(C, network_compressed)
+            if os.path.isfile(contraction_df_fullpath):
+                os.remove(contraction_df_fullpath)
+            if len(contraction_df) > 0:
+                if 'well' in contraction_df.columns:
+                    contraction_df['well'] = contraction_df['well'].map(format_wells, na_action='ignore')
+                contraction_df.to_csv(contraction_df_fullpath)
+            remove_checkpoint(checkpoint)
+        record_stage(manifest, stage, key, params, inputs, outputs, hit, reason)
+        save_manifest(manifest, manifest_fullpath)
+        if export_graphml:
+            write_graphml(C, network_compressed.replace('.net','.graphml'))
 
     log('Done!')
\ No newline at end of file
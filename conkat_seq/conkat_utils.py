@@ -4,57 +4,394 @@ import os
 import subprocess
 import networkx as nx
 import tempfile
+import multiprocessing
+import threading
+from multiprocessing.pool import ThreadPool
+import shutil
 import matplotlib.pyplot as plt
-from helpers import calc_fisher
+from helpers import fisher_exact_batch
 import numpy as np
-import random
+from scipy import sparse
+import itertools
 from itertools import combinations
+from math import comb
 from collections import defaultdict
+from scipy import stats
 from statsmodels.stats.multitest import multipletests
 
 
 from helpers import log
-from helpers import int_to_well_position
 from helpers import makeFasta
-from helpers import execute
+from helpers import run_command
+from helpers import parse_wells
+
+from compact_graph import compact_graph
+from compact_graph import is_compact_graph
+from compact_graph import copy_graph
+from compact_graph import number_of_nodes
+from compact_graph import number_of_edges
+from compact_graph import edge_list
+from compact_graph import node_attribute
+from compact_graph import connected_components
+from compact_graph import remove_edges
+from compact_graph import contract_nodes
+from compact_graph import contraction_roots
+from compact_graph import from_networkx
+from compact_graph import to_networkx
+
+from checkpoint import checkpoint_due
+from checkpoint import write_checkpoint
+from checkpoint import read_checkpoint
+
+from plate_geometry import plate_geometry
+from plate_geometry import geometry_layout
+from plate_geometry import well_groups
+
+from sequence_clustering import cluster_fast
+
+from cluster_cache import cluster_key
+from cluster_cache import lookup_clusters
+from cluster_cache import store_clusters
+
+from conkat_io import write_occurrences
+from conkat_io import read_occurrences
+from conkat_io import open_occurrences_writer
+from conkat_io import append_occurrences
+from conkat_io import close_occurrences_writer
+from conkat_io import discard_occurrences_writer
+
+def seed_well_incidence(filtered_clustering_table):
+
+    """Build a binary well x seed incidence matrix from a clustering table
 
-def calc_domain_occurances(filtered_clustering_table, MIN_PAIR_COUNT=3, verb=False): 
-    
-    """Calculate p-values for domain pairs based on filtered clustering table 
-    
     Parameters:
-        filtered_clustering_table (str): 
-        MIN_PAIR_COUNT (int) : 
-        verb (bool) :(default is False)
+        filtered_clustering_table (pd.DataFrame): clustering table with 'seed' and 'well' columns
+
+    Returns:
+        (seeds,wells,X) tuple(np.array,np.array,sparse.csc_matrix) : sorted seed names,
+            sorted well ids and the (Nwells x Nseeds) incidence matrix
 
-    Returns: 
-        df (pd.DataFrame) : 
-    
-    Raises:
-        IOError: An error occurred accessing the bigtable.Table object.
-    
     """
-    
-    Nwells = filtered_clustering_table['well'].nunique()
 
-    if verb:
-        log('Calculating pairs statistics...')
-        log('%s subpools found...' % Nwells)
+    seeds, seed_idx = np.unique(filtered_clustering_table['seed'].values, return_inverse=True)
+    wells, well_idx = np.unique(filtered_clustering_table['well'].values, return_inverse=True)
+
+    X = sparse.csc_matrix((np.ones(len(seed_idx), dtype=np.int32), (well_idx, seed_idx)),
+                          shape=(len(wells), len(seeds)))
+    #a seed can be listed more than once in a well
+    X.sum_duplicates()
+    X.data[:] = 1
+
+    return (seeds, wells, X)
+
+def count_pairs_sparse(X, MIN_PAIR_COUNT=3, start=0, end=None):
+
+    """Count co-occurrences of all seed pairs with a single sparse product
+
+    Parameters:
+        X (sparse.csc_matrix): binary (Nwells x Nseeds) incidence matrix
+        MIN_PAIR_COUNT (int) : only keep pairs co-occurring in >= MIN_PAIR_COUNT wells
+        start (int) : first seed of the block of first seeds (default is 0)
+        end (int) : end of the block of first seeds (default is None, all seeds)
+
+    Returns:
+        (rows,cols,counts) tuple(np.array,np.array,np.array) : seed indexes (start <= rows < end,
+            rows < cols) and co-occurrence counts of the kept pairs, sorted by (rows,cols)
+
+    """
+
+    end = X.shape[1] if end is None else end
+    C = sparse.triu(X[:, start:end].T.tocsr().dot(X[:, start:]), k=1).tocsr()
+    C.sort_indices()
+    C = C.tocoo()
+    keep = C.data >= MIN_PAIR_COUNT
+
+    return (C.row[keep] + start, C.col[keep] + start, C.data[keep])
+
+#bytes held per product entry by count_pairs_sparse: int32 data and indices of the CSR product (8),
+#int32 rows of its COO form in triu (4), the triu mask (1) and the int32 COO upper triangle (12);
+#tracemalloc peaks on random incidence matrices stay under 24 bytes per product entry
+PAIR_PRODUCT_BYTES = 8 + 4 + 1 + 12
+
+#bytes held per shared well and per tested pair of a seed block while its pairs are tested and
+#written: int32 well indexes and well ids (4 + 4), int64 rows, cols and offsets, float64 odds and
+#p-values of the pair (5 * 8) and the int64 or float64 occurrences column being written (8)
+SHARED_WELL_BYTES = 4 + 4
+TESTED_PAIR_BYTES = 5 * 8 + 8
+
+#bytes held per entry (one of the Ov1 + Ov2 wells of a pair) by pair_wells_sparse: int32 data and
+#indices of the pair x well product (8) and its data < 2 mask (1), plus the pair incidence
+#matrix; tracemalloc peaks on random incidence matrices stay under 10 bytes per entry
+SHARED_WELL_PRODUCT_BYTES = 8 + 1 + 1
+
+def seed_block_bytes(MIN_PAIR_COUNT=3):
+
+    """Bytes held per unit of seed block work (a well shared by two seeds) by either pass over a block
+
+    Tested pairs share at least MIN_PAIR_COUNT wells, so a block holds at most one
+    tested pair per MIN_PAIR_COUNT units of work.
+    """
+
+    return max(PAIR_PRODUCT_BYTES, SHARED_WELL_BYTES + TESTED_PAIR_BYTES / float(max(1, MIN_PAIR_COUNT)))
+
+def seed_block_bounds(X, memory_budget=None, bytes_per_entry=PAIR_PRODUCT_BYTES, nblocks=1):
+
+    """Split the seeds into blocks whose pair products fit a memory budget
+
+    The product of a block is bounded by the sum, over the block seeds, of the
+    number of seeds sharing each of their wells.
+
+    Parameters:
+        X (sparse.csc_matrix): binary (Nwells x Nseeds) incidence matrix
+        memory_budget (float) : memory budget in MB (default is None, one block)
+        bytes_per_entry (float) : bytes held per product entry (default is PAIR_PRODUCT_BYTES)
+        nblocks (int) : minimal number of blocks of similar work (default is 1)
+
+    Returns:
+        bounds (list) : (start,end) seed index tuples
+
+    """
+
+    nseeds = X.shape[1]
+    if (memory_budget is None) and (nblocks <= 1):
+        return [(0, nseeds)]
+
+    well_sizes = np.diff(X.tocsr().indptr)
+    work = np.cumsum(X.T.dot(well_sizes))
+    max_entries = np.inf if memory_budget is None else memory_budget * 2**20 / bytes_per_entry
+    if len(work):
+        max_entries = min(max_entries, work[-1] / float(nblocks))
+    max_entries = max(1, int(max_entries))
+
+    bounds = []
+    start = 0
+    while start < nseeds:
+        done = work[start - 1] if start else 0
+        end = max(start + 1, int(np.searchsorted(work, done + max_entries, side='right')))
+        bounds.append((start, min(end, nseeds)))
+        start = end
+
+    return bounds
+
+def pair_wells_sparse(X, rows, cols):
+
+    """Find the wells shared by each seed pair
+
+    Parameters:
+        X (sparse.csc_matrix): binary (Nwells x Nseeds) incidence matrix
+        rows (np.array): first seed index of every pair
+        cols (np.array): second seed index of every pair
+
+    Returns:
+        (offsets,flat) tuple(np.array,np.array) : well indexes of pair k are
+            flat[offsets[k]:offsets[k+1]], sorted
+
+    """
+
+    npairs = len(rows)
+    #each pair row holds a one for both of its seeds, shared wells sum up to 2
+    P = sparse.csr_matrix((np.ones(2*npairs, dtype=np.int32),
+                           (np.repeat(np.arange(npairs), 2), np.column_stack((rows, cols)).ravel())),
+                          shape=(npairs, X.shape[1]))
+    S = P.dot(X.T.tocsr()).tocsr()
+    S.data[S.data < 2] = 0
+    S.eliminate_zeros()
+    S.sort_indices()
+
+    return (S.indptr.astype(np.int64), S.indices)
+
+#relative safety margin applied to p-value bounds before pruning
+PRUNE_RTOL = 1e-6
+
+def min_pair_pvalue(Ov1, Ov2, Nwells, MIN_PAIR_COUNT=3, cache=None):
+
+    """Smallest two-sided Fisher p-value a seed pair can reach
+
+    For fixed margins the p-value only decreases away from the hypergeometric
+    mode, so the minimum over all counts >= MIN_PAIR_COUNT is reached at one of
+    the two extreme counts.
+
+    Parameters:
+        Ov1 (np.array): number of wells of the first seed
+        Ov2 (np.array): number of wells of the second seed
+        Nwells (int): total number of wells
+        MIN_PAIR_COUNT (int) : smallest count a tested pair can have
+        cache (dict) : fisher_exact_batch memo (default is None)
+
+    Returns:
+        pmin (np.array) : 1.0 where no count >= MIN_PAIR_COUNT is possible
+
+    """
+
+    Ov1 = np.asarray(Ov1, dtype=np.int64)
+    Ov2 = np.asarray(Ov2, dtype=np.int64)
+    hi = np.minimum(Ov1, Ov2)
+    lo = np.maximum(MIN_PAIR_COUNT, Ov1 + Ov2 - Nwells)
+    possible = lo <= hi
+    lo = np.minimum(lo, hi)
+
+    p_hi = fisher_exact_batch(hi, Ov1, Ov2, Nwells, cache)[1]
+    p_lo = fisher_exact_batch(lo, Ov1, Ov2, Nwells, cache)[1]
+
+    return np.where(possible, np.minimum(p_lo, p_hi), 1.0)
+
+def pruning_threshold(pmin, alpha, method, weights=None):
+
+    """Largest raw p-value that can still be rejected by build_graph
+
+    Every correction in multipletests gives corrected p-values >= raw p-values,
+    so alpha bounds the rejectable p-values, except for the two-stage FDR
+    procedures. Their second stage rejects up to alpha' * m / m0, where m0 is
+    at least the number of pruned pairs, so the bound is raised until it holds
+    for the pairs it prunes. Pairs with a bound above the threshold can not be
+    rejected and do not change the corrected p-values of rejected pairs.
+
+    Parameters:
+        pmin (np.array): smallest reachable p-value of every candidate pair
+        alpha (float) : significance threshold
+        method (str) : 'pvalue' or a statsmodels multipletests method
+        weights (np.array) : number of candidate pairs behind every pmin value (default is None, one)
+
+    Returns:
+        threshold (float) :
+
+    """
+
+    threshold = alpha
+    if method in ['fdr_tsbky', 'fdr_tsbh']:
+        alpha_prime = alpha / (1 + alpha) if method == 'fdr_tsbky' else alpha
+        bound = pmin * (1 - PRUNE_RTOL)
+        weights = np.ones(len(pmin)) if weights is None else weights
+        ntests = np.sum(weights)
+        while True:
+            npruned = np.sum(weights[bound > threshold])
+            if (npruned == 0) or (alpha_prime * ntests / float(npruned) <= threshold):
+                break
+            threshold = alpha_prime * ntests / float(npruned)
+
+    return threshold
+
+def prune_seeds(Ov, Nwells, MIN_PAIR_COUNT, alpha, cache=None):
+
+    """Flag seeds that can not reach p < alpha with any seed of the library
+
+    Parameters:
+        Ov (np.array): number of wells of every seed
+        Nwells (int): total number of wells
+        MIN_PAIR_COUNT (int) :
+        alpha (float) : raw p-value threshold
+        cache (dict) : fisher_exact_batch memo (default is None)
+
+    Returns:
+        keep (np.array) : boolean mask of seeds to keep
+
+    """
+
+    values = np.unique(Ov)
+    #a perfectly co-occurring partner is usually the best case, check it first
+    reachable = min_pair_pvalue(values, values, Nwells, MIN_PAIR_COUNT, cache) * (1 - PRUNE_RTOL) <= alpha
+    for k in np.flatnonzero(~reachable):
+        pmin = min_pair_pvalue(np.repeat(values[k], len(values)), values, Nwells, MIN_PAIR_COUNT, cache)
+        reachable[k] = (pmin * (1 - PRUNE_RTOL) <= alpha).any()
+
+    return np.isin(Ov, values[reachable])
+
+def update_occurrence_state(state, filtered_clustering_table):
+
+    """Update a persisted well x seed incidence and pair count state with a clustering table
+
+    Only the wells whose seeds differ from the state are recounted:
+    C = C - triu(Xw_old.T Xw_old) + triu(Xw_new.T Xw_new) over the touched wells w.
+    The table must hold all the data (e.g. old plus new plates or domains).
+
+    Parameters:
+        state (dict): 'seeds','wells','X' (incidence) and 'C' (upper triangular pair counts),
+            updated in place (empty dict to initialize)
+        filtered_clustering_table (pd.DataFrame):
+
+    Returns:
+        touched (int) : number of wells recounted
+
+    """
+
+    (seeds_tab, wells_tab, X_tab) = seed_well_incidence(filtered_clustering_table)
+    seeds_tab = seeds_tab.astype(str)
+
+    if not state:
+        state.update(seeds=seeds_tab, wells=wells_tab, X=X_tab,
+                     C=sparse.triu(X_tab.T.tocsr().dot(X_tab), k=1).tocsr())
+        return len(wells_tab)
+
+    seeds = np.union1d(state['seeds'], seeds_tab)
+    wells = np.union1d(state['wells'], wells_tab)
+    shape = (len(wells), len(seeds))
+    seed_old = np.searchsorted(seeds, state['seeds'])
+
+    X_old = _reindex_sparse(state['X'], np.searchsorted(wells, state['wells']), seed_old, shape).tocsr()
+    X_new = _reindex_sparse(X_tab, np.searchsorted(wells, wells_tab), np.searchsorted(seeds, seeds_tab), shape).tocsr()
+    C = _reindex_sparse(state['C'], seed_old, seed_old, (len(seeds), len(seeds))).tocsr()
+
+    touched = np.unique((X_old != X_new).tocoo().row)
+    Xw_old = X_old[touched]
+    Xw_new = X_new[touched]
+    C = (C - sparse.triu(Xw_old.T.tocsr().dot(Xw_old), k=1) + sparse.triu(Xw_new.T.tocsr().dot(Xw_new), k=1)).tocsr()
+    C.eliminate_zeros()
+
+    #drop wells and seeds that left the table
+    keep_wells = np.diff(X_new.indptr) > 0
+    keep_seeds = np.diff(X_new.tocsc().indptr) > 0
+    state.update(seeds=seeds[keep_seeds], wells=wells[keep_wells],
+                 X=X_new[keep_wells][:, keep_seeds].tocsc(), C=C[keep_seeds][:, keep_seeds].tocsr())
+
+    return len(touched)
+
+def _reindex_sparse(M, row_map, col_map, shape):
+    M = M.tocoo()
+    return sparse.csc_matrix((M.data, (row_map[M.row], col_map[M.col])), shape=shape)
+
+def save_occurrence_state(state, fullpath):
+
+    """Save an occurrence state (see update_occurrence_state) to a .npz file"""
+
+    (X, C) = (state['X'].tocsc(), state['C'].tocsr())
+    with open(fullpath, 'wb') as f:
+        np.savez(f, seeds=state['seeds'].astype(str), wells=state['wells'],
+                 X_indptr=X.indptr, X_indices=X.indices,
+                 C_indptr=C.indptr, C_indices=C.indices, C_data=C.data)
+
+def load_occurrence_state(fullpath):
+
+    """Load an occurrence state saved by save_occurrence_state"""
+
+    with np.load(fullpath) as f:
+        (seeds, wells) = (f['seeds'], f['wells'])
+        X = sparse.csc_matrix((np.ones(len(f['X_indices']), dtype=np.int32), f['X_indices'], f['X_indptr']),
+                              shape=(len(wells), len(seeds)))
+        C = sparse.csr_matrix((f['C_data'], f['C_indices'], f['C_indptr']), shape=(len(seeds), len(seeds)))
+
+    return dict(seeds=seeds, wells=wells, X=X, C=C)
+
+def _count_pairs_loop(filtered_clustering_table, Nwells, MIN_PAIR_COUNT=3, verb=False):
+
+    """Count co-occurrences of seed pairs by enumerating the pairs inside every well
+
+    Returns:
+        pairs_dict (dict) : (V1,V2) pair tuple -> list of shared wells
+
+    """
 
     #create a dic where key is well and values are all the seeds inside the well
-    wells_dict = {} 
+    wells_dict = {}
     for w,gr in filtered_clustering_table.groupby('well')['seed']:
         wells_dict[w] = gr.unique()
-        
-    clusterWellDict = filtered_clustering_table.groupby('seed').well.nunique().to_dict()
 
-    #iterate over all wells and generate all pairwise combinations of seeds 
-    #make a dic where key is the pair tuple the value is the number of co-occurance for this pair across plate 
+    #iterate over all wells and generate all pairwise combinations of seeds
+    #make a dic where key is the pair tuple the value is the number of co-occurance for this pair across plate
     if verb:
         log('Counting pairs occurances... ')
     pairs_dict = defaultdict(list)
 
-    if len(wells_dict.keys()) > Nwells: 
+    if len(wells_dict.keys()) > Nwells:
         log('Number of wells is larger than %s...' % Nwells)
         sys.exit()
 
@@ -71,31 +408,223 @@ def calc_domain_occurances(filtered_clustering_table, MIN_PAIR_COUNT=3, verb=Fal
         log('Current pairs count %s' % len(pairs_dict))
 
     #Iterate over all pairs are remove those which appears together below / above cutoff counts
-    #Removes most of pairs which appear together only once or twince in the entire plate 
+    #Removes most of pairs which appear together only once or twince in the entire plate
 
     if verb:
         log('Removing pairs with MIN_PAIR_COUNT < %s' % MIN_PAIR_COUNT)
-    
+
     l = len(pairs_dict)
-    for i,k in enumerate(pairs_dict.keys()):
-        if (len(pairs_dict[k]) < MIN_PAIR_COUNT) :
-            del pairs_dict[k]
+    pairs_dict = dict((k,v) for k,v in pairs_dict.items() if len(v) >= MIN_PAIR_COUNT)
     if verb:
         log('%s pairs removed...' % (l-len(pairs_dict)))
 
+    return pairs_dict
+
+def calc_domain_occurances(filtered_clustering_table, MIN_PAIR_COUNT=3, verb=False, engine='sparse',
+                           fisher_cache=None, alpha=None, method='pvalue', memory_budget=None,
+                           spill_dir=None, workers=1, state=None, output=None): 
+    
+    """Calculate p-values for domain pairs based on filtered clustering table 
+    
+    Parameters:
+        filtered_clustering_table (str): 
+        MIN_PAIR_COUNT (int) : 
+        verb (bool) :(default is False)
+        engine (str) : pair counting engine, 'sparse' (well x seed incidence matrix product),
+            'chunked' (sparse products over seed blocks spilled to disk)
+            or 'loop' (per-well pair enumeration) (default is 'sparse')
+        fisher_cache (dict) : (a,Ov1,Ov2) -> (oddsratio,pvalue) memo shared between calls with the same Nwells,
+            worker processes start from a copy of it and their new entries are merged back (default is None)
+        alpha (float) : skip seeds and pairs that can not be significant at alpha (default is None, no pruning)
+        method (str) : correction method used with alpha in build_graph (default is 'pvalue')
+        memory_budget (float) : peak memory in MB of the 'chunked' engine per process, half for the pair
+            products and tested pairs of a seed block, half for the shared-well products of its
+            chunks (the incidence matrix is not counted, default is None, one block)
+        spill_dir (str) : directory for the 'chunked' temp files (default is None, system temp)
+        workers (int) : number of processes sharing the seed blocks of the 'sparse' and 'chunked'
+            engines, results are identical to the serial path (default is 1)
+        state (dict) : occurrence state of a previous run (see update_occurrence_state), updated in
+            place so only wells that changed are recounted (default is None)
+        output (str) : binary occurrences directory (see conkat_io.write_occurrences) receiving the
+            table; the 'sparse' and 'chunked' engines stream every tested seed block to it and
+            never hold the whole table (default is None, the table is returned)
+
+    Returns: 
+        df (pd.DataFrame) : df.attrs holds 'ntests' (candidate pairs including pruned ones, but not
+            the pairs of pruned seeds, only pruned with method 'pvalue' which needs no number of
+            tests), 'pruned_pairs' and 'pruned_seeds'; with output, the V1, V2 and pvalue columns
+            read back memory mapped from output
+    
+    Raises:
+        IOError: An error occurred accessing the bigtable.Table object.
+        ValueError: Unknown counting engine or state used with the 'loop' engine.
+    
+    """
+    
+    Nwells = filtered_clustering_table['well'].nunique()
+
     if verb:
-        log('Current pairs count %s' % len(pairs_dict))
+        log('Calculating pairs statistics...')
+        log('%s subpools found...' % Nwells)
+
+    if fisher_cache is None:
+        fisher_cache = {}
+    pruned_seeds = 0
+
+    if (engine == 'loop') and (state is not None):
+        raise ValueError('Occurrence state requires the sparse or chunked engine')
+
+    if engine == 'loop':
+        pairs_dict = _count_pairs_loop(filtered_clustering_table, Nwells, MIN_PAIR_COUNT, verb)
+        clusterWellDict = filtered_clustering_table.groupby('seed').well.nunique().to_dict()
+        V1 = np.array([x[0] for x in pairs_dict.keys()], dtype=object)
+        V2 = np.array([x[1] for x in pairs_dict.keys()], dtype=object)
+        Ov1 = np.array([clusterWellDict[x] for x in V1], dtype=np.int64)
+        Ov2 = np.array([clusterWellDict[x] for x in V2], dtype=np.int64)
+        pair_wells = list(pairs_dict.values())
+        keep = np.ones(len(V1), dtype=bool)
+        if alpha is not None:
+            keep = _prune_pairs(Ov1, Ov2, Nwells, MIN_PAIR_COUNT, alpha, method, fisher_cache, verb)
+        ntests = len(V1)
+        V1 = V1[keep].tolist()
+        V2 = V2[keep].tolist()
+        Ov1 = Ov1[keep]
+        Ov2 = Ov2[keep]
+        pair_wells = [w for w,k in zip(pair_wells, keep) if k]
+        (odds, pvals) = fisher_exact_batch([len(x) for x in pair_wells], Ov1, Ov2, Nwells, cache=fisher_cache)
+    elif engine in ['sparse', 'chunked']:
+        if verb:
+            log('Counting pairs occurances (%s)... ' % engine)
+        C = None
+        if state is not None:
+            touched = update_occurrence_state(state, filtered_clustering_table)
+            (seeds, wells, X, C) = (state['seeds'], state['wells'], state['X'], state['C'])
+            log('%s of %s wells recounted from occurrence state...' % (touched, len(wells)))
+        else:
+            (seeds, wells, X) = seed_well_incidence(filtered_clustering_table)
+        Ov = np.diff(X.indptr)
+        #without multiple test correction pairs of hopeless seeds need not even be counted
+        if (alpha is not None) and (method == 'pvalue'):
+            keep_seeds = prune_seeds(Ov, Nwells, MIN_PAIR_COUNT, alpha, fisher_cache)
+            pruned_seeds = int(len(seeds) - keep_seeds.sum())
+            if verb:
+                log('%s seeds can not reach p < %s and are skipped...' % (pruned_seeds, alpha))
+            (seeds, Ov, X) = (seeds[keep_seeds], Ov[keep_seeds], X[:, keep_seeds])
+            if C is not None:
+                C = C[keep_seeds][:, keep_seeds]
+
+        #half of the budget for the pairs of a seed block, half for the shared-well products of its chunks
+        chunk_budget = None
+        if engine == 'chunked':
+            block_budget = None if memory_budget is None else memory_budget / 2.0
+            chunk_budget = block_budget
+            bounds = seed_block_bounds(X, block_budget, seed_block_bytes(MIN_PAIR_COUNT), nblocks=4*workers)
+            tmpdir = tempfile.mkdtemp(dir=spill_dir)
+            if verb:
+                log('%s seed blocks, spilling pair counts to %s...' % (len(bounds), tmpdir))
+        else:
+            bounds = seed_block_bounds(X, nblocks=(4*workers if workers > 1 else 1))
+            tmpdir = None
+
+        pool = None
+        writer = None
+        try:
+            _init_pair_shard(X, C, Ov, Nwells, MIN_PAIR_COUNT, chunk_budget, tmpdir, fisher_cache)
+            shard_map = map
+            if workers > 1:
+                if verb:
+                    log('Sharding %s seed blocks over %s workers...' % (len(bounds), workers))
+                pool = multiprocessing.Pool(workers, initializer=_init_pair_shard,
+                                            initargs=(X, C, Ov, Nwells, MIN_PAIR_COUNT, chunk_budget, tmpdir,
+                                                      fisher_cache, True))
+                shard_map = pool.imap
+
+            #first pass: count pairs block by block
+            margins = (alpha is not None)
+            counted = list(shard_map(_count_pair_shard, [(k, start, stop, margins) for k,(start,stop) in enumerate(bounds)]))
+            parts = [x[0] for x in counted]
+
+            ntests = 0
+            (keys, reachable) = (None, None)
+            if alpha is not None:
+                #all pairs sharing margins share their p-value bound
+                (keys, inverse) = np.unique(np.concatenate([x[1] for x in counted] + [[]]).astype(np.int64), return_inverse=True)
+                counts = np.bincount(inverse.reshape(-1), weights=np.concatenate([x[2] for x in counted] + [[]]))
+                ntests = int(counts.sum())
+                pmin = min_pair_pvalue(keys // (Nwells + 1), keys % (Nwells + 1), Nwells, MIN_PAIR_COUNT, fisher_cache)
+                threshold = pruning_threshold(pmin, alpha, method, weights=counts)
+                if verb:
+                    log('Pruning pairs with p-value bound > %s...' % threshold)
+                reachable = pmin * (1 - PRUNE_RTOL) <= threshold
+
+            #second pass: prune, collect shared wells and test every block
+            (V1, V2, Ov1, Ov2, pair_wells, odds, pvals) = ([], [], [], [], [], [], [])
+            if output is not None:
+                writer = open_occurrences_writer(output, seeds)
+            for (rows, cols, offsets, flat, block_odds, block_pvals, memo) in shard_map(_test_pair_shard, [(part, keys, reachable) for part in parts]):
+                if memo:
+                    fisher_cache.update(memo)
+                if alpha is None:
+                    ntests += len(rows)
+                if writer is not None:
+                    append_occurrences(writer, rows, cols, Ov[rows], Ov[cols], offsets, wells[flat],
+                                       block_odds, block_pvals, Nwells)
+                    continue
+                flat_wells = wells[flat].tolist()
+                pair_wells.extend([flat_wells[offsets[k]:offsets[k+1]] for k in range(len(rows))])
+                V1.extend(seeds[rows].tolist())
+                V2.extend(seeds[cols].tolist())
+                Ov1.append(Ov[rows])
+                Ov2.append(Ov[cols])
+                odds.append(block_odds)
+                pvals.append(block_pvals)
+            (Ov1, Ov2, odds, pvals) = [np.concatenate(x + [[]]) for x in (Ov1, Ov2, odds, pvals)]
+            if writer is not None:
+                npairs = writer['nrows']
+                close_occurrences_writer(writer, Nwells, {'ntests': ntests, 'pruned_pairs': ntests - npairs,
+                                                          'pruned_seeds': pruned_seeds})
+                writer = None
+            if pool is not None:
+                pool.close()
+        except BaseException:
+            #stop the other workers rather than wait for their blocks
+            if pool is not None:
+                pool.terminate()
+            raise
+        finally:
+            if pool is not None:
+                pool.join()
+            _PAIR_SHARD.clear()
+            if tmpdir is not None:
+                shutil.rmtree(tmpdir, ignore_errors=True)
+            if writer is not None:
+                discard_occurrences_writer(writer)
+    else:
+        raise ValueError('Unknown counting engine -> %s' % engine)
+
+    if (output is not None) and (engine != 'loop'):
+        if alpha is not None:
+            log('%s seeds and %s candidate pairs skipped by alpha pruning...' % (pruned_seeds, ntests - npairs))
+        if verb:
+            log('%s pairs tested and written --> %s' % (npairs, output))
+        return read_occurrences(output, columns=['V1', 'V2', 'pvalue'])
+
+    if alpha is not None:
+        log('%s seeds and %s candidate pairs skipped by alpha pruning...' % (pruned_seeds, ntests - len(V1)))
+
+    if verb:
+        log('Current pairs count %s' % len(V1))
         log('Performing pair-wise Fisher test...')
 
-    indexs = pairs_dict.keys()
+    indexs = list(zip(V1,V2))
     #Build df to hold all pairs and their binomial scores 
     df = pd.DataFrame(index=indexs,columns = ['V1','V2','Ov1','Ov2','P0','binom','count'])
-    df['V1'] = [x[0] for x in pairs_dict.keys()]
-    df['V2'] = [x[1] for x in pairs_dict.keys()]
-    df['Ov1'] = df.V1.apply(lambda x: clusterWellDict[x])
-    df['Ov2'] = df.V2.apply(lambda x: clusterWellDict[x])
+    df['V1'] = V1
+    df['V2'] = V2
+    df['Ov1'] = Ov1
+    df['Ov2'] = Ov2
     df['P0'] = [float(a*b)/(Nwells**2) for a,b in zip(df['Ov1'].values,df['Ov2'].values)] 
-    df['wells'] = pairs_dict.values()
+    df['wells'] = pair_wells
 
     df['count'] = df['wells'].apply(lambda x: len(x))
 
@@ -104,17 +633,201 @@ def calc_domain_occurances(filtered_clustering_table, MIN_PAIR_COUNT=3, verb=Fal
     df['c'] = df['Ov2'] - df['count']
     df['d'] = Nwells-(df['a'] + df['b'] + df['c'])
 
-    df['fisher'] = df.apply(lambda row: calc_fisher(row['a'],row['b'],row['c'],row['d']),axis=1).values
-    df['pvalue'] = df.fisher.apply(lambda x: x[1] )
-    df['odds'] = df.fisher.apply(lambda x: x[0] )
-    df['P']  = df.pvalue.apply(lambda x: -np.log10(x))
+    df['odds'] = odds
+    df['pvalue'] = pvals
+    with np.errstate(divide='ignore'):
+        df['P'] = -np.log10(df['pvalue'].values)
+
+    df.attrs['ntests'] = ntests
+    df.attrs['pruned_pairs'] = ntests - len(df)
+    df.attrs['pruned_seeds'] = pruned_seeds
 
     if verb:
         log('Fisher test done')
+
+    if output is not None:
+        write_occurrences(df, output, Nwells)
     
     return df
 
-def build_graph(pairs_occurances,filtered_clustering_table,alpha,method,verb=False):
+#state of the seed block shards, set in every worker process by _init_pair_shard
+_PAIR_SHARD = {}
+
+def _init_pair_shard(X, C, Ov, Nwells, MIN_PAIR_COUNT, memory_budget, tmpdir, fisher_cache=None, return_cache=False):
+    _PAIR_SHARD.update(X=X, C=C, Ov=Ov, Nwells=Nwells, MIN_PAIR_COUNT=MIN_PAIR_COUNT, memory_budget=memory_budget,
+                       tmpdir=tmpdir, fisher_cache=({} if fisher_cache is None else fisher_cache),
+                       return_cache=return_cache)
+
+def _count_pair_shard(task):
+
+    """Count the pairs of one seed block, spill them if a temp dir is set
+
+    Returns:
+        (part,keys,counts) : pairs array (or its .npy path) and the histogram of their margins
+    """
+
+    (k, start, end, margins) = task
+    (X, Ov, Nwells) = (_PAIR_SHARD['X'], _PAIR_SHARD['Ov'], _PAIR_SHARD['Nwells'])
+
+    if _PAIR_SHARD['C'] is not None:
+        #pair counts kept in an occurrence state
+        block = _PAIR_SHARD['C'][start:end].tocoo()
+        keep = block.data >= _PAIR_SHARD['MIN_PAIR_COUNT']
+        part = np.vstack((block.row[keep] + start, block.col[keep])).astype(np.int64)
+    else:
+        part = np.vstack(count_pairs_sparse(X, _PAIR_SHARD['MIN_PAIR_COUNT'], start, end)[:2]).astype(np.int64)
+    (keys, counts) = (None, None)
+    if margins:
+        (keys, counts) = np.unique(Ov[part[0]] * (Nwells + 1) + Ov[part[1]], return_counts=True)
+    if _PAIR_SHARD['tmpdir'] is not None:
+        part_fullpath = os.path.join(_PAIR_SHARD['tmpdir'], 'pairs_%05d.npy' % k)
+        np.save(part_fullpath, part.astype(np.int32))
+        part = part_fullpath
+
+    return (part, keys, counts)
+
+def _test_pair_shard(task):
+
+    """Prune, collect shared wells and run the Fisher tests of one seed block
+
+    Returns:
+        (rows,cols,offsets,flat,odds,pvals,memo) : flat well indexes of pair k are flat[offsets[k]:offsets[k+1]],
+            memo holds the Fisher cache entries added by the block in a worker process (None in process)
+    """
+
+    (part, keys, reachable) = task
+    (X, Ov, Nwells) = (_PAIR_SHARD['X'], _PAIR_SHARD['Ov'], _PAIR_SHARD['Nwells'])
+
+    if not isinstance(part, np.ndarray):
+        part = np.load(part).astype(np.int64)
+    (rows, cols) = (part[0], part[1])
+    if keys is not None:
+        keep = reachable[np.searchsorted(keys, Ov[rows] * (Nwells + 1) + Ov[cols])]
+        (rows, cols) = (rows[keep], cols[keep])
+
+    (offsets, flat) = ([np.zeros(1, dtype=np.int64)], [])
+    for chunk in _pair_chunks(Ov[rows] + Ov[cols], _PAIR_SHARD['memory_budget']):
+        (chunk_offsets, chunk_flat) = pair_wells_sparse(X, rows[chunk], cols[chunk])
+        offsets.append(chunk_offsets[1:] + offsets[-1][-1])
+        flat.append(chunk_flat)
+    offsets = np.concatenate(offsets)
+    flat = np.concatenate(flat + [np.array([], dtype=np.int32)])
+
+    cache = _PAIR_SHARD['fisher_cache']
+    ncached = len(cache)
+    (odds, pvals) = fisher_exact_batch(np.diff(offsets), Ov[rows], Ov[cols], Nwells, cache=cache)
+    #entries are added at the end of the memo, the parent merges them into the cache of the call
+    memo = list(itertools.islice(cache.items(), ncached, None)) if _PAIR_SHARD['return_cache'] else None
+
+    return (rows, cols, offsets, flat, odds, pvals, memo)
+
+def _pair_chunks(sizes, memory_budget=None, bytes_per_entry=SHARED_WELL_PRODUCT_BYTES):
+
+    """Split pairs into consecutive slices whose shared-well products fit a memory budget"""
+
+    if (memory_budget is None) or (len(sizes) == 0):
+        return [slice(0, len(sizes))]
+
+    max_entries = max(1, int(memory_budget * 2**20 / bytes_per_entry))
+    work = np.cumsum(sizes)
+    chunks = []
+    start = 0
+    while start < len(sizes):
+        done = work[start - 1] if start else 0
+        end = max(start + 1, int(np.searchsorted(work, done + max_entries, side='right')))
+        chunks.append(slice(start, end))
+        start = end
+
+    return chunks
+
+def _prune_pairs(Ov1, Ov2, Nwells, MIN_PAIR_COUNT, alpha, method, cache=None, verb=False):
+
+    """Boolean mask of the candidate pairs that can still be significant"""
+
+    pmin = min_pair_pvalue(Ov1, Ov2, Nwells, MIN_PAIR_COUNT, cache)
+    threshold = pruning_threshold(pmin, alpha, method)
+    if verb:
+        log('Pruning pairs with p-value bound > %s...' % threshold)
+
+    return pmin * (1 - PRUNE_RTOL) <= threshold
+
+def node_attribute_table(filtered_clustering_table, nodes=None):
+
+    """Collect the node attributes of every seed from the clustering table
+
+    Parameters:
+        filtered_clustering_table (pd.DataFrame): clustering table with seed, well, type, seq, clusterSize and domain columns
+        nodes (list) : seeds to annotate (default is None, all seeds)
+
+    Returns:
+        attrs (pd.DataFrame) : indexed by seed with well (sorted int32 array of unique wells),
+            seq, clusterSize and domain columns
+
+    """
+
+    keep = np.ones(len(filtered_clustering_table), dtype=bool)
+    if nodes is not None:
+        keep = filtered_clustering_table['seed'].isin(list(nodes)).values
+    seeds = filtered_clustering_table['seed'].values[keep]
+    wells = filtered_clustering_table['well'].values[keep].astype(np.int64)
+
+    #unique (seed, well) pairs sorted by seed code then well
+    (names, codes) = np.unique(seeds.astype(str), return_inverse=True)
+    order = np.lexsort((wells, codes))
+    (codes, wells) = (codes[order], wells[order])
+    first = np.ones(len(codes), dtype=bool)
+    first[1:] = (codes[1:] != codes[:-1]) | (wells[1:] != wells[:-1])
+    (codes, wells) = (codes[first], wells[first])
+    starts = np.ones(len(codes), dtype=bool)
+    starts[1:] = codes[1:] != codes[:-1]
+    bounds = np.r_[np.flatnonzero(starts), len(codes)]
+    attrs = pd.DataFrame(index=pd.Index(names[codes[bounds[:-1]]].astype(object), name='seed'))
+    well_sets = np.empty(len(bounds) - 1, dtype=object)
+    for k in range(len(bounds) - 1):
+        well_sets[k] = wells[bounds[k]:bounds[k+1]].astype(np.int32)
+    attrs['well'] = well_sets
+
+    #centroid attributes, the last centroid row of a seed wins
+    centroids = filtered_clustering_table.loc[keep & (filtered_clustering_table['type'] == 'S').values,
+                                              ['seed','seq','clusterSize','domain']]
+    centroids = centroids.drop_duplicates(subset='seed', keep='last').set_index('seed')
+    attrs = attrs.join(centroids, how='outer')
+
+    return attrs
+
+def _assemble_graph(V1, V2, risks, backend='networkx'):
+
+    """Graph of the (V1, V2) edges weighted by risks, nodes in order of first appearance"""
+
+    if backend == 'compact':
+        nodes = pd.unique(np.column_stack((V1, V2)).ravel())
+        index = pd.Index(nodes)
+        return compact_graph(nodes, index.get_indexer(V1), index.get_indexer(V2),
+                             edge_attrs={'weight': risks})
+
+    G = nx.Graph()
+    G.add_weighted_edges_from(zip(V1.tolist(), V2.tolist(), risks.tolist()))
+    return G
+
+def _annotate_graph(G, attrs):
+
+    """Set the node_attribute_table columns and a zero 'compressed' count on the nodes of G"""
+
+    if is_compact_graph(G):
+        sub = attrs.reindex(G['nodes'])
+        for attr in ['well','seq','clusterSize','domain']:
+            G['node_attrs'][attr] = sub[attr].astype(object).where(sub[attr].notna(), None).values
+        G['node_attrs']['compressed'] = np.zeros(len(G['nodes']), dtype=np.int64)
+        return G
+
+    sub = attrs.reindex(list(G.nodes()))
+    for attr in ['well','seq','clusterSize','domain']:
+        nx.set_node_attributes(G, name=attr, values=sub[attr].dropna().to_dict())
+        
+    nx.set_node_attributes(G, name='compressed', values=0)
+    return G
+
+def build_graph(pairs_occurances,filtered_clustering_table,alpha,method,verb=False,ntests=None,backend='networkx'):
     
     """Calculate p-values for domain pairs based on filtered clustering table 
     
@@ -124,169 +837,718 @@ def build_graph(pairs_occurances,filtered_clustering_table,alpha,method,verb=Fal
         alpha (float) :(default is False)
         method (str) : 
         verb (bool) : 
+        ntests (int) : number of tests for multiple test correction, pairs pruned from
+            pairs_occurances count as p = 1.0 (default is None, len(pairs_occurances))
+        backend (str) : graph representation, 'networkx' or 'compact' (default is 'networkx')
 
-    Returns: 
-        G (nx.network) : 
+    Returns:
+        G (nx.network or compact graph) : edges weighted by -log10 of the (corrected) p-value
     
     Raises:
         IOError: An error occurred accessing the bigtable.Table object.
     
     """
-    G=nx.Graph()
-    
     #Weight edges based on co-occurance
     
-    pairs_occurances['pair'] = zip(pairs_occurances.V1.values,pairs_occurances.V2.values)
+    pvals = pairs_occurances['pvalue'].values.astype(np.float64)
     if method == 'pvalue':
-        try:
-            edges = pairs_occurances[pairs_occurances['pvalue'] < alpha]['pair'].apply(lambda x: ast.literal_eval(x)).values
-        except:
-            edges = pairs_occurances[pairs_occurances['pvalue'] < alpha]['pair'].values
-        finally:
-            risks = pairs_occurances[pairs_occurances['pvalue'] < alpha]['pvalue'].apply(lambda x: -np.log10(x)).astype(str).values
-            weightedEdges = [ e + (b,) for e,b  in zip(edges,risks)]
+        mask = pvals < alpha
     else:
-        (reject, pvals_correct,a,b) = multipletests(pairs_occurances.pvalue.values,alpha,method)
-        pairs_occurances['pvalue_correct'] = pvals_correct
-        pairs_occurances['reject'] = reject
-        try:
-            edges = pairs_occurances[pairs_occurances['reject']]['pair'].apply(lambda x: ast.literal_eval(x)).values
-        except:
-            edges = pairs_occurances[pairs_occurances['reject']]['pair'].values
-        finally:
-            risks = pairs_occurances[pairs_occurances['reject']]['pvalue_correct'].apply(lambda x: -np.log10(x)).astype(str).values
-            weightedEdges = [ e + (b,) for e,b  in zip(edges,risks)]
+        if (ntests is not None) and (ntests > len(pvals)):
+            pvals = np.r_[pvals, np.ones(ntests - len(pvals))]
+        (reject, pvals, a, b) = multipletests(pvals,alpha,method)
+        pvals = pvals[:len(pairs_occurances)]
+        mask = reject[:len(pairs_occurances)]
+        pairs_occurances['pvalue_correct'] = pvals
+        pairs_occurances['reject'] = mask
 
-    G.add_weighted_edges_from(weightedEdges)
+    with np.errstate(divide='ignore'):
+        risks = -np.log10(pvals[mask])
+    G = _assemble_graph(pairs_occurances['V1'].values[mask], pairs_occurances['V2'].values[mask], risks, backend)
     
     log("Constructing network --> %s %s" % (method,alpha))
-    log("%s nodes and %s edges found..." % (len(G.nodes()),len(G.edges)))
+    log("%s nodes and %s edges found..." % (number_of_nodes(G),number_of_edges(G)))
 
 
     if verb:
         log('annotating netwrok file...')
 
-    wellsReadsDict = filtered_clustering_table.astype(str).groupby('seed')['well'].apply( lambda x: set(x.tolist())).to_dict()
-    s = pd.Series(wellsReadsDict)
-    attr_dict = s.apply(lambda x: '_'.join(sorted(list(x),key=int ))).to_dict()
-    nx.set_node_attributes(G, name='well', values=attr_dict)
-    
     #extract attributes from filtered_clustering_table to graph
-    centroids_indexs = filtered_clustering_table[filtered_clustering_table['type'] == 'S'].index
-    for attr in ['seq','clusterSize','domain']:
-        attr_dict = dict(zip(filtered_clustering_table.loc[centroids_indexs,'seed'],filtered_clustering_table.loc[centroids_indexs,attr]))
-        nx.set_node_attributes(G, name=attr, values=attr_dict)
-        
-    nx.set_node_attributes(G, name='compressed', values=0)
+    nodes = G['nodes'] if is_compact_graph(G) else G.nodes()
+    return _annotate_graph(G, node_attribute_table(filtered_clustering_table, nodes))
 
-    return G
+def _prefix_component_counts(src, dst, cuts):
 
-def flag_barcode_swap_edges(G,pval=0.05,N=500,verb=False):
-    
-    """Monte-Carlo test to flag edges with biased co-occurrence distributions 
-    
-    Dependencies:
-        vsearch (https://github.com/torognes/vsearch)
+    """Nodes and connected components of the graphs made of the first k edges, for every k in cuts
+
+    A single union-find pass over the edges, cuts must be sorted.
+    """
+
+    parent = {}
+    def find(x):
+        while parent[x] != x:
+            parent[x] = parent[parent[x]]
+            x = parent[x]
+        return x
+
+    counts = []
+    (nnodes, ncomponents, e) = (0, 0, 0)
+    for k in cuts:
+        for (u, v) in zip(src[e:k].tolist(), dst[e:k].tolist()):
+            for x in (u, v):
+                if x not in parent:
+                    parent[x] = x
+                    nnodes += 1
+                    ncomponents += 1
+            (ru, rv) = (find(u), find(v))
+            if ru != rv:
+                parent[ru] = rv
+                ncomponents -= 1
+        e = max(e, k)
+        counts.append((nnodes, ncomponents))
+
+    return counts
+
+def threshold_sweep(pairs_occurances,filtered_clustering_table,alphas,methods,verb=False,ntests=None,backend='networkx'):
+
+    """Build the networks of several alpha thresholds and corrections in one pass
+
+    The p-values are sorted once. For every method the rejected pairs at
+    increasing alphas are nested prefixes of the sorted pairs, so node and
+    component counts come from a single union-find pass, and the nodes are
+    annotated once. Every network is identical to build_graph at the same
+    alpha and method.
 
     Parameters:
-        G (nx.network): 
-        pval (float) : 
-        N (int) : 
-        verb (bool) :(default is False)
+        pairs_occurances (pd.DataFrame): occurrences table with V1, V2 and pvalue columns
+        filtered_clustering_table (pd.DataFrame) : clustering table
+        alphas (list) : significance thresholds
+        methods (list) : 'pvalue' or statsmodels multipletests methods
+        verb (bool) : (default is False)
+        ntests (int) : number of tests for multiple test correction (default is None, len(pairs_occurances))
+        backend (str) : graph representation, 'networkx' or 'compact' (default is 'networkx')
+
+    Returns:
+        sweep (generator) : (method, alpha, G, counts) tuples, counts is a dict of nodes,
+            edges and components, alphas ascending within every method
+
+    """
+
+    pvals = pairs_occurances['pvalue'].values.astype(np.float64)
+    npairs = len(pvals)
+    order = np.argsort(pvals, kind='stable')
+    sorted_pvals = pvals[order]
+    if (ntests is not None) and (ntests > npairs):
+        padded = np.r_[sorted_pvals, np.ones(ntests - npairs)]
+    else:
+        padded = sorted_pvals
+
+    (V1, V2) = (pairs_occurances['V1'].values, pairs_occurances['V2'].values)
+    (codes, uniques) = pd.factorize(np.column_stack((V1[order], V2[order])).ravel())
+    (src, dst) = (codes[0::2], codes[1::2])
+
+    #rejected prefix length and corrected p-values of every threshold
+    selections = []
+    for method in methods:
+        for alpha in sorted(alphas):
+            if method == 'pvalue':
+                k = int(np.searchsorted(sorted_pvals, alpha, side='left'))
+                corrected = sorted_pvals[:k]
+            else:
+                (reject, corrected, a, b) = multipletests(padded, alpha, method, is_sorted=True)
+                k = int(np.sum(reject[:npairs]))
+                corrected = corrected[:k]
+            selections.append((method, alpha, k, corrected))
+    if verb:
+        log('%s thresholds, up to %s edges...' % (len(selections), max([0] + [x[2] for x in selections])))
+
+    kmax = max([0] + [x[2] for x in selections])
+    attrs = node_attribute_table(filtered_clustering_table, uniques[np.unique(np.r_[src[:kmax], dst[:kmax]])])
+
+    for method in methods:
+        method_selections = [x for x in selections if x[0] == method]
+        counts = _prefix_component_counts(src, dst, [x[2] for x in method_selections])
+        for ((method, alpha, k, corrected), (nnodes, ncomponents)) in zip(method_selections, counts):
+            #edges in occurrences table order, as in build_graph
+            rank = np.argsort(order[:k], kind='stable')
+            rows = order[:k][rank]
+            with np.errstate(divide='ignore'):
+                risks = -np.log10(corrected[rank])
+            G = _assemble_graph(V1[rows], V2[rows], risks, backend)
+            log("Constructing network --> %s %s" % (method,alpha))
+            log("%s nodes and %s edges found..." % (number_of_nodes(G),number_of_edges(G)))
+            yield (method, alpha, _annotate_graph(G, attrs),
+                   {'nodes': nnodes, 'edges': k, 'components': ncomponents})
+
+def max_group_occupancy(groups):
+
+    """Largest number of wells sharing a group, for every row of a 2D array of group ids"""
+
+    groups = np.atleast_2d(groups)
+    (n, k) = groups.shape
+    if k == 0:
+        return np.zeros(n, dtype=np.int64)
+    ngroups = int(groups.max()) + 1
+    counts = np.bincount((groups + np.arange(n)[:,None] * ngroups).ravel(), minlength=n * ngroups)
+
+    return counts.reshape(n, ngroups).max(axis=1)
+
+def simulate_max_occupancy(nwells, N, rng, geometry=None):
+
+    """Row and column maxima of N random draws of nwells distinct wells
+
+    Parameters:
+        nwells (int): number of wells per draw
+        N (int) : number of draws
+        rng (np.random.Generator) : random generator
+        geometry (dict) : plates the wells are drawn from (default is None, plate_geometry())
+
+    Returns:
+        (rowMax,colMax) tuple(np.array,np.array) : maxima of every draw
 
-    Returns: 
-        (G,P,flag) tuple(pd.DataFrame,nx.network) : 
-    
     Raises:
-        IOError: An error occurred accessing the bigtable.Table object.
-        
+        ValueError: More wells than the plates hold.
     """
-    
-    wells_attr = nx.get_node_attributes(G,'well')
-    results = pd.DataFrame(columns = ['Nwells','rowMax', 'rowidx','p_row', 'colMax','colidx','p_col'])
-    N = float(N)
-    edges = G.edges()
-    
+
+    geometry = plate_geometry() if geometry is None else geometry
+    total_wells = geometry['nwells']
+    if nwells > total_wells:
+        raise ValueError('Cannot draw %s wells out of %s' % (nwells, total_wells))
+    if nwells == 0:
+        return (np.zeros(N, dtype=np.int64), np.zeros(N, dtype=np.int64))
+
+    #the nwells smallest of total_wells uniform keys are a uniform draw without replacement
+    samples = np.argpartition(rng.random((N, total_wells)), nwells - 1, axis=1)[:, :nwells] + 1
+    (rows, cols) = (geometry['row_group'][samples], geometry['col_group'][samples])
+
+    return (max_group_occupancy(rows), max_group_occupancy(cols))
+
+def _truncated_polymul(a, b, n):
+    c = [0] * (n + 1)
+    for i,x in enumerate(a):
+        if x:
+            for j,y in enumerate(b[:n + 1 - i]):
+                c[i + j] += x * y
+    return c
+
+def exact_max_occupancy_sf(nwells, group_size, ngroups):
+
+    """Exact probability that a random draw of nwells distinct wells puts at least k wells in one group
+
+    The draws with fewer than k wells in every group are counted as the x^nwells
+    coefficient of (sum_{j<k} C(group_size, j) x^j)^ngroups, in exact integers.
+
+    Parameters:
+        nwells (int): number of wells per draw
+        group_size (int) : wells per group (plate row or column)
+        ngroups (int) : number of groups
+
+    Returns:
+        sf (np.array) : sf[k] = P(max occupancy >= k), k = 0 ... group_size
+
+    """
+
+    total = comb(group_size * ngroups, nwells)
+    sf = np.zeros(group_size + 1)
+    sf[0] = 1.0
+    sf[1] = 1.0 if nwells else 0.0
+    for k in range(2, min(nwells, group_size) + 1):
+        (below, power, e) = ([1] + [0] * nwells, [comb(group_size, j) for j in range(k)], ngroups)
+        while e:
+            if e & 1:
+                below = _truncated_polymul(below, power, nwells)
+            e >>= 1
+            if e:
+                power = _truncated_polymul(power, power, nwells)
+        sf[k] = (total - below[nwells]) / total
+
+    return sf
+
+#null distributions of Nwells up to EXACT_NULL_MAX are computed exactly by default
+EXACT_NULL_MAX = 64
+
+def null_distribution_table(N=500, exact_max=EXACT_NULL_MAX, geometry=None):
+
+    """Empty table of max row / max column occupancy null distributions, filled by null_occupancy_sf
+
+    Parameters:
+        N (int): default number of Monte-Carlo draws per Nwells (default is 500)
+        exact_max (int) : exact distributions up to exact_max wells, Monte-Carlo above (default is EXACT_NULL_MAX)
+        geometry (dict) : plate geometry of the library (default is None, plate_geometry())
+
+    Returns:
+        null_table (dict) : 'geometry', 'layout', 'N', 'exact_max', 'row_sf' and 'col_sf' (survival functions,
+            one row per Nwells, NaN until computed), 'source' (0 missing, 1 Monte-Carlo, 2 exact)
+            and 'draws' (Monte-Carlo draws behind every row)
+
+    """
+
+    geometry = plate_geometry() if geometry is None else geometry
+    total = geometry['nwells']
+    return {'geometry': geometry, 'layout': geometry_layout(geometry),
+            'N': int(N), 'exact_max': int(exact_max),
+            'row_sf': np.full((total + 1, geometry['ncols'] + 1), np.nan),
+            'col_sf': np.full((total + 1, geometry['nrows'] + 1), np.nan),
+            'source': np.zeros(total + 1, dtype=np.int8),
+            'draws': np.zeros(total + 1, dtype=np.int64)}
+
+#largest number of Monte-Carlo draws simulated at once
+SIMULATION_BLOCK = 1000
+
+def null_occupancy_sf(null_table, nwells, rng, draws=None):
+
+    """Survival functions of the max row and max column occupancy of nwells random wells
+
+    Computed once per nwells and kept in null_table. Monte-Carlo distributions
+    with fewer than draws draws are extended with new draws.
+
+    Parameters:
+        null_table (dict): from null_distribution_table, updated in place
+        nwells (int) : number of shared wells
+        rng (np.random.Generator) : random generator of the Monte-Carlo draws
+        draws (int) : minimal number of Monte-Carlo draws (default is None, null_table['N'])
+
+    Returns:
+        (row_sf,col_sf) tuple(np.array,np.array) : row_sf[k] = P(max row occupancy >= k)
+
+    """
+
+    draws = null_table['N'] if draws is None else int(draws)
+    geometry = null_table['geometry']
+    (nrows, ncols, nplates) = (geometry['nrows'], geometry['ncols'], geometry['nplates'])
+    if (not null_table['source'][nwells]) and (nwells <= null_table['exact_max']):
+        #a plate row holds ncols wells, a plate column nrows wells
+        null_table['row_sf'][nwells] = exact_max_occupancy_sf(nwells, ncols, nrows * nplates)
+        null_table['col_sf'][nwells] = exact_max_occupancy_sf(nwells, nrows, ncols * nplates)
+        null_table['source'][nwells] = 2
+    elif (null_table['source'][nwells] != 2) and (null_table['draws'][nwells] < draws):
+        done = null_table['draws'][nwells]
+        row_count = np.nan_to_num(null_table['row_sf'][nwells]) * done
+        col_count = np.nan_to_num(null_table['col_sf'][nwells]) * done
+        while done < draws:
+            n = min(draws - done, SIMULATION_BLOCK)
+            (simRowMax, simColMax) = simulate_max_occupancy(nwells, n, rng, geometry)
+            row_count = row_count + np.cumsum(np.bincount(simRowMax, minlength=ncols + 1)[::-1])[::-1]
+            col_count = col_count + np.cumsum(np.bincount(simColMax, minlength=nrows + 1)[::-1])[::-1]
+            done += n
+        null_table['row_sf'][nwells] = np.round(row_count) / float(done)
+        null_table['col_sf'][nwells] = np.round(col_count) / float(done)
+        null_table['source'][nwells] = 1
+        null_table['draws'][nwells] = done
+
+    return (null_table['row_sf'][nwells], null_table['col_sf'][nwells])
+
+def save_null_table(null_table, fullpath):
+
+    """Save a null distribution table (see null_distribution_table) to a .npz file"""
+
+    with open(fullpath, 'wb') as f:
+        np.savez(f, **dict((k, v) for k,v in null_table.items() if k != 'geometry'))
+
+def load_null_table(fullpath, N=500, exact_max=EXACT_NULL_MAX, geometry=None):
+
+    """Load a null distribution table saved by save_null_table
+
+    Distributions of another plate layout are discarded, exact ones are only
+    kept up to exact_max and Monte-Carlo ones above exact_max (they are
+    extended when fewer than N draws were saved).
+
+    Parameters:
+        fullpath (str): .npz file, a new table is returned if it does not exist
+        N (int) : default number of Monte-Carlo draws per Nwells (default is 500)
+        exact_max (int) : exact distributions up to exact_max wells (default is EXACT_NULL_MAX)
+        geometry (dict) : plate geometry of the library (default is None, plate_geometry())
+
+    Returns:
+        null_table (dict) :
+
+    """
+
+    null_table = null_distribution_table(N, exact_max, geometry)
+    if not os.path.isfile(fullpath):
+        return null_table
+
+    with np.load(fullpath) as f:
+        saved = dict((k, f[k]) for k in f.files)
+    if not np.array_equal(saved['layout'], null_table['layout']):
+        log('Plate layout changed, null distributions discarded --> %s' % fullpath)
+        return null_table
+
+    nwells = np.arange(len(saved['source']))
+    keep = (((saved['source'] == 2) & (nwells <= exact_max)) |
+            ((saved['source'] == 1) & (nwells > exact_max)))
+    for k in ['row_sf', 'col_sf', 'source', 'draws']:
+        if k in saved:
+            null_table[k][keep] = saved[k][keep]
+    log('%s null distributions loaded --> %s' % (keep.sum(), fullpath))
+
+    return null_table
+
+def binomial_interval(x, n, confidence=0.99):
+
+    """Clopper-Pearson confidence interval of a binomial proportion
+
+    Parameters:
+        x (np.array): number of successes
+        n (np.array) : number of trials
+        confidence (float) : confidence level (default is 0.99)
+
+    Returns:
+        (lower,upper) tuple(np.array,np.array) :
+
+    """
+
+    x = np.asarray(x, dtype=np.float64)
+    n = np.asarray(n, dtype=np.float64)
+    a = (1 - confidence) / 2.0
+    with np.errstate(invalid='ignore', divide='ignore'):
+        lower = np.where(x > 0, stats.beta.ppf(a, x, n - x + 1), 0.0)
+        upper = np.where(x < n, stats.beta.ppf(1 - a, x + 1, n - x), 1.0)
+
+    return (lower, upper)
+
+#first batch of draws of adaptive flagging, doubled until every edge is decided
+ADAPTIVE_FIRST_DRAWS = 20
+
+def adaptive_looks(N, max_N):
+
+    """Largest number of looks of adaptive flagging, from ADAPTIVE_FIRST_DRAWS draws doubled up to N, then up to max_N"""
+
+    (looks, n) = (1, min(ADAPTIVE_FIRST_DRAWS, N))
+    while n < max(N, max_N):
+        n = min(2 * n, N) if n < N else min(2 * n, max_N)
+        looks += 1
+
+    return looks
+
+def _adaptive_null_pvalues(null_table, nwells, rowMax, colMax, rng, pval, N, max_N, confidence):
+
+    """Sequential Monte-Carlo p-values of the edges sharing nwells wells
+
+    Draws are added to the null distribution of nwells, in doubling batches,
+    and an edge stops at the first batch where the confidence intervals of its
+    row and column p-values put min_p on one side of pval. The error rate of
+    confidence is spent over the looks (Bonferroni): every look uses intervals
+    at level 1 - (1 - confidence) / (2 * adaptive_looks(N, max_N)), so an edge
+    is misclassified with probability at most 1 - confidence whichever look
+    stops it. Edges still undecided after N draws go on up to max_N draws.
+
+    Returns:
+        (p_row,p_col,draws) tuple(np.array,np.array,np.array) : p-values and draws of every edge
+
+    """
+
+    #the row and column intervals of every look share the error rate
+    look_confidence = 1 - (1 - confidence) / (2.0 * adaptive_looks(N, max_N))
+
+    p_row = np.full(len(rowMax), np.nan)
+    p_col = np.full(len(rowMax), np.nan)
+    draws = np.zeros(len(rowMax), dtype=np.int64)
+    undecided = np.ones(len(rowMax), dtype=bool)
+    n = min(ADAPTIVE_FIRST_DRAWS, N)
+    while undecided.any():
+        (row_sf, col_sf) = null_occupancy_sf(null_table, nwells, rng, draws=n)
+        done = null_table['draws'][nwells]
+        idx = np.flatnonzero(undecided)
+        (p_row[idx], p_col[idx], draws[idx]) = (row_sf[rowMax[idx]], col_sf[colMax[idx]], done)
+        if null_table['source'][nwells] == 2:
+            break
+
+        (row_lo, row_up) = binomial_interval(np.round(p_row[idx] * done), done, look_confidence)
+        (col_lo, col_up) = binomial_interval(np.round(p_col[idx] * done), done, look_confidence)
+        decided = (np.minimum(row_lo, col_lo) >= pval) | (np.minimum(row_up, col_up) < pval)
+        undecided[idx[decided]] = False
+        if done >= max(N, max_N):
+            break
+        n = min(2 * done, N) if done < N else min(2 * done, max_N)
+
+    return (p_row, p_col, draws)
+
+#state of the flagging shards, set in every worker process by _init_flag_shard
+_FLAG_SHARD = {}
+
+#edges per flagging shard (and checkpoint part)
+FLAG_SHARD_EDGES = 10000
+
+def _init_flag_shard(edges, node_wells, null_table, params):
+    _FLAG_SHARD.update(edges=edges, node_wells=node_wells, null_table=null_table, params=params)
+
+def _observe_flag_shard(task):
+
+    """Shared wells and their largest plate row and column of a slice of the edges
+
+    Returns:
+        (Nwells,rowMax,rowidx,colMax,colidx) : arrays aligned with the edges of the slice
+    """
+
+    (start, end) = task
+    (edges, node_wells) = (_FLAG_SHARD['edges'][start:end], _FLAG_SHARD['node_wells'])
+    geometry = _FLAG_SHARD['null_table']['geometry']
+    Nwells = np.zeros(len(edges), dtype=np.int64)
+    rowMax = np.zeros(len(edges), dtype=np.int64)
+    colMax = np.zeros(len(edges), dtype=np.int64)
+    rowidx = np.full(len(edges), None, dtype=object)
+    colidx = np.full(len(edges), None, dtype=object)
+
+    for (k, edge) in enumerate(edges):
+        wells = np.intersect1d(node_wells[edge[0]], node_wells[edge[1]], assume_unique=True)
+        Nwells[k] = len(wells)
+        if Nwells[k] == 0:
+            continue
+
+        #observed
+        (rows, cols) = well_groups(geometry, wells)
+        (row_groups, row_counts) = np.unique(rows, return_counts=True)
+        (col_groups, col_counts) = np.unique(cols, return_counts=True)
+        (rowMax[k], colMax[k]) = (row_counts.max(), col_counts.max())
+        rowidx[k] = geometry['row_labels'][row_groups[np.argmax(row_counts)]]
+        colidx[k] = geometry['col_labels'][col_groups[np.argmax(col_counts)]]
+
+    return (Nwells, rowMax, rowidx, colMax, colidx)
+
+def _null_flag_shard(task):
+
+    """P-values of the edges sharing nwells wells
+
+    The Monte-Carlo draws of nwells come from their own random stream, spawned
+    from the run entropy and nwells, so p-values do not depend on the workers.
+
+    Returns:
+        (nwells,p_row,p_col,draws,entry) : entry holds the null_table rows of nwells
+    """
+
+    (nwells, rowMax, colMax) = task
+    (null_table, params) = (_FLAG_SHARD['null_table'], _FLAG_SHARD['params'])
+    rng = np.random.default_rng(np.random.SeedSequence(params['entropy'], spawn_key=(int(nwells),)))
+
+    if params['adaptive']:
+        (p_row, p_col, draws) = _adaptive_null_pvalues(null_table, nwells, rowMax, colMax, rng, params['pval'],
+                                                       params['N'], params['max_N'], params['confidence'])
+    else:
+        (row_sf, col_sf) = null_occupancy_sf(null_table, nwells, rng)
+        (p_row, p_col) = (row_sf[rowMax], col_sf[colMax])
+        draws = np.full(len(rowMax), null_table['draws'][nwells])
+
+    entry = dict((k, null_table[k][nwells]) for k in ['row_sf', 'col_sf', 'source', 'draws'])
+
+    return (nwells, p_row, p_col, draws, entry)
+
+def flag_barcode_swap_edges(G,pval=0.05,N=500,verb=False,random_seed=None,null_table=None,exact_max=EXACT_NULL_MAX,
+                            adaptive=False,max_N=None,confidence=0.99,workers=1,checkpoint=None,geometry=None):
+
+    """Monte-Carlo test to flag edges with biased co-occurrence distributions
+
+    The shared wells of every edge are placed on plate rows and columns. Edges
+    with more than 2 shared wells in a row or column are tested against the null
+    distribution of the same number of random wells, computed once per Nwells
+    (exactly up to exact_max wells, else from N random draws).
+
+    Parameters:
+        G (nx.network or compact graph):
+        pval (float) :
+        N (int) :
+        verb (bool) :(default is False)
+        random_seed (int) : seed of the simulations, results are the same for any number of workers (default is None)
+        null_table (dict) : null distributions from null_distribution_table or load_null_table,
+            updated in place (default is None, a new table)
+        exact_max (int) : exact null distributions up to exact_max wells, for a new table (default is EXACT_NULL_MAX)
+        adaptive (bool) : stop drawing once every edge is decided at the confidence level, spent over
+            the looks (see _adaptive_null_pvalues) (default is False)
+        max_N (int) : adaptive draws up to max_N for edges still undecided after N draws (default is None, N)
+        confidence (float) : confidence level of adaptive decisions (default is 0.99)
+        workers (int) : number of processes sharing the edges and the null distributions (default is 1)
+        checkpoint (dict) : from open_checkpoint, completed edge slices and Nwells groups are saved
+            there and reused when resuming (default is None)
+        geometry (dict) : plate geometry of the library, for a new null table (default is None, plate_geometry())
+
+    Returns:
+        (G,P,flag) tuple(nx.network,nx.network,pd.DataFrame) : graphs of the same backend as G
+
+    """
+
+    if null_table is None:
+        null_table = null_distribution_table(N, exact_max, geometry)
+    max_N = N if max_N is None else max(int(max_N), N)
+    params = {'entropy': np.random.SeedSequence(random_seed).entropy, 'pval': pval, 'N': N, 'max_N': max_N,
+              'adaptive': adaptive, 'confidence': confidence}
+    edges = edge_list(G)
+    node_wells = dict((n, parse_wells(w)) for n,w in node_attribute(G,'well').items())
+
     if verb:
         log('%s edges found...' % len(edges))
-    
-    counter = 0
-    for edge in edges:
-        if ((verb) & (counter % 1000 == 0)) :
-            log('%.1f '% (float(counter)/len(edges)*100))
-        counter += 1
-        w1 = set(wells_attr[edge[0]].split('_'))
-        w2 = set(wells_attr[edge[1]].split('_'))
-        edge = str(edge)
-        wells = [int(x) for x in w1.intersection(w2)]
-        Nwells = len(wells)
-        
-        #observed 
-        o = pd.DataFrame()
-        o['well'] = wells
-        o['platePos'] = o.well.apply(lambda x: int_to_well_position(x) )
-        o['plate'] = o.well.apply(lambda x: x / 384 )
-        o['rowPos'] = o.platePos.apply(lambda x: x[0])
-        o['rowPos'] = 'R' + o['rowPos'].astype(str) + '_P' + o['plate'].astype(str)
-        o['colPos'] = o.platePos.apply(lambda x: x[1:])
-        o['colPos'] = 'C' + o['colPos'].astype(str) + '_P' + o['plate'].astype(str)
-        
-        results.loc[edge,'Nwells'] = Nwells
-        results.loc[edge,'rowMax'] = (max(o['rowPos'].value_counts()))
-        results.loc[edge,'colMax'] = (max(o['colPos'].value_counts()))
-        results.loc[edge,'rowidx'] = o['rowPos'].value_counts().idxmax()
-        results.loc[edge,'colidx'] = o['colPos'].value_counts().idxmax()
-
-        if (results.loc[edge,'rowMax'] > 2) | (results.loc[edge,'colMax'] > 2) :
-            colRes = 0
-            rowRes = 0
-            #N monte carlo simulations of random well distribution 
-            for i in range(int(N)):
-                s = pd.DataFrame()
-                s['well'] = random.sample(range(384*6), Nwells)
-                s['platePos'] = s.well.apply(lambda x: int_to_well_position(x) )
-                s['plate'] = s.well.apply(lambda x: x / 384 )
-                s['rowPos'] = s.platePos.apply(lambda x: x[0])
-                s['rowPos'] = 'R' + s['rowPos'].astype(str) + '_P' + s['plate'].astype(str)
-                s['colPos'] = s.platePos.apply(lambda x: x[1:])
-                s['colPos'] = 'C' + s['colPos'].astype(str) + '_P' + s['plate'].astype(str)
-                simRowMax = (max(s['rowPos'].value_counts()))
-                simColMax = (max(s['colPos'].value_counts()))
-                if simRowMax >= results.loc[edge,'rowMax'] :
-                    rowRes+=1
-                if simColMax >= results.loc[edge,'colMax']:
-                    colRes+=1
-            
-            results.loc[edge,'p_row'] = (rowRes/N)
-            results.loc[edge,'p_col'] = (colRes/N)
-            results.loc[edge,'min_p'] = min((colRes/N),(rowRes/N))
-            
-    nx.set_edge_attributes(G, 0, 'hopFlag') 
-    try:   
-        flag = results[results['min_p'] < pval]
-        log('%s edges flagged...' % len(flag))
-        
-        edges = [eval(x) for x in flag.index.astype(str).values]
-        attrs = dict(zip(edges,[{'hopFlag':1}]*len(flag)))
-        nx.set_edge_attributes(G, attrs)
-        P = G.copy()
-        P.remove_edges_from(edges)
-        return (G,P,flag)
-    except:
-        log('%s edges flagged...' % 0)
-        return (G,G,pd.DataFrame())
 
+    #preallocated results, filled shard by shard
+    nedges = len(edges)
+    Nwells = np.zeros(nedges, dtype=np.int64)
+    rowMax = np.zeros(nedges, dtype=np.int64)
+    colMax = np.zeros(nedges, dtype=np.int64)
+    rowidx = np.full(nedges, None, dtype=object)
+    colidx = np.full(nedges, None, dtype=object)
+    p_row = np.full(nedges, np.nan)
+    p_col = np.full(nedges, np.nan)
+    draws = np.zeros(nedges, dtype=np.int64)
 
+    pool = None
+    try:
+        _init_flag_shard(edges, node_wells, null_table, params)
+        shard_map = map
+        if workers > 1:
+            if verb:
+                log('Sharding edge flagging over %s workers...' % workers)
+            pool = multiprocessing.Pool(workers, initializer=_init_flag_shard,
+                                        initargs=(edges, node_wells, null_table, params))
+            shard_map = pool.imap
 
- 
-        
+        bounds = np.r_[np.arange(0, nedges, FLAG_SHARD_EDGES), nedges]
+        tasks = [(start, end) for start,end in zip(bounds[:-1], bounds[1:])]
+        saved = read_checkpoint(checkpoint, 'observe_') if checkpoint else {}
+        for (start, end) in tasks:
+            part = saved.get('observe_%010d_%010d' % (start, end))
+            if part is not None:
+                (Nwells[start:end], rowMax[start:end], colMax[start:end]) = (part['Nwells'], part['rowMax'], part['colMax'])
+                (rowidx[start:end], colidx[start:end]) = [np.where(part[k] == '', None, part[k].astype(object)) for k in ['rowidx', 'colidx']]
+        tasks = [x for x in tasks if 'observe_%010d_%010d' % x not in saved]
+        for ((start, end), shard) in zip(tasks, shard_map(_observe_flag_shard, tasks)):
+            (Nwells[start:end], rowMax[start:end], rowidx[start:end], colMax[start:end], colidx[start:end]) = shard
+            if checkpoint:
+                write_checkpoint(checkpoint, 'observe_%010d_%010d' % (start, end),
+                                 Nwells=shard[0], rowMax=shard[1], colMax=shard[3],
+                                 rowidx=np.array(['' if x is None else x for x in shard[2]], dtype=str),
+                                 colidx=np.array(['' if x is None else x for x in shard[4]], dtype=str))
+            if verb:
+                log('%.1f '% (float(end)/max(nedges, 1)*100))
 
-    
+        #null distribution of random well distribution, once per Nwells
+        tested = (rowMax > 2) | (colMax > 2)
+        groups = dict((nwells, np.flatnonzero(tested & (Nwells == nwells))) for nwells in np.unique(Nwells[tested]))
+        saved = read_checkpoint(checkpoint, 'null_') if checkpoint else {}
+        resumed = [(nwells, part['p_row'], part['p_col'], part['draws'],
+                    dict((k, part['entry_' + k]) for k in ['row_sf', 'col_sf', 'source', 'draws']))
+                   for (nwells, part) in [(int(name.split('_')[1]), part) for name,part in saved.items()]
+                   if nwells in groups]
+        tasks = [(nwells, rowMax[idx], colMax[idx]) for nwells,idx in groups.items() if 'null_%06d' % nwells not in saved]
+        for (nwells, group_p_row, group_p_col, group_draws, entry) in itertools.chain(resumed, shard_map(_null_flag_shard, tasks)):
+            idx = groups[nwells]
+            (p_row[idx], p_col[idx], draws[idx]) = (group_p_row, group_p_col, group_draws)
+            for (k, v) in entry.items():
+                null_table[k][nwells] = v
+            if checkpoint and ('null_%06d' % nwells not in saved):
+                write_checkpoint(checkpoint, 'null_%06d' % nwells, p_row=group_p_row, p_col=group_p_col, draws=group_draws,
+                                 **dict(('entry_' + k, v) for k,v in entry.items()))
+        if pool is not None:
+            pool.close()
+    except BaseException:
+        #stop the other workers rather than wait for their shards
+        if pool is not None:
+            pool.terminate()
+        raise
+    finally:
+        if pool is not None:
+            pool.join()
+        _FLAG_SHARD.clear()
+
+    results = pd.DataFrame({'Nwells': Nwells, 'rowMax': rowMax, 'rowidx': rowidx, 'p_row': p_row,
+                            'colMax': colMax, 'colidx': colidx, 'p_col': p_col,
+                            'min_p': np.fmin(p_row, p_col), 'draws': draws},
+                           index=pd.Index([str(e) for e in edges], name='edge'))
+    flagged = (results['min_p'] < pval).values
+    flag = results[flagged]
+    simulated = tested & (draws > 0)
+    if simulated.any():
+        log('%s edges tested by monte carlo, %.1f draws per edge (N=%s)...' % (simulated.sum(), draws[simulated].mean(), N))
+    log('%s edges flagged...' % len(flag))
+
+    if is_compact_graph(G):
+        G['edge_attrs']['hopFlag'] = flagged.astype(np.int64)
+        return (G,remove_edges(G, flagged),flag)
+
+    nx.set_edge_attributes(G, dict(zip(edges, flagged.astype(int).tolist())), 'hopFlag')
+    P = G.copy()
+    P.remove_edges_from([e for e,f in zip(edges, flagged) if f])
 
     return (G,P,flag)
-  
 
-def merge_similar_nodes(G, cluster_id=0.9, min_net_size=3, threads=20, verb=False, run=True):   
+#state of the clustering jobs of merge_similar_nodes, shared by the threads of the job pool
+_MERGE_SHARD = {}
+
+def _init_merge_shard(clusterSize_dict, seq_dict, cluster_id, threads, verb, run):
+    _MERGE_SHARD.update(clusterSize_dict=clusterSize_dict, seq_dict=seq_dict, cluster_id=cluster_id,
+                        verb=verb, run=run, free=[threads], budget=threading.Condition(), abort=False)
+
+def _merge_jobs(nodesBySub, todo, threads, batch_size):
+
+    """Split the sub-networks to cluster into jobs sharing a budget of vsearch threads
+
+    Small sub-networks are packed together (up to batch_size sequences, and into at
+    least as many jobs as threads) on a single thread, a job gets a share of the
+    threads proportional to its number of sequences.
+
+    Returns:
+        jobs (list) : (subs, threads) tuples in sub-network order, subs is a dict of
+            sub-network number -> node names
+    """
+
+    total = sum(len(nodesBySub[i]) for i in todo)
+    cap = min(batch_size, -(-total // threads)) if batch_size else 0
+
+    (jobs, subs, size) = ([], {}, 0)
+    for i in todo:
+        if subs and (size + len(nodesBySub[i]) > cap):
+            jobs.append(subs)
+            (subs, size) = ({}, 0)
+        subs[i] = list(nodesBySub[i])
+        size += len(nodesBySub[i])
+    if subs:
+        jobs.append(subs)
+
+    return [(subs, max(1, min(threads, threads * sum(len(s) for s in subs.values()) // total))) for subs in jobs]
+
+def _cluster_job(job):
+
+    """Cluster the sub-networks of a job once its threads are free in the budget
+
+    Returns:
+        merges (dict) : sub-network number -> (seed, node) pairs, None without a clustering table
+    """
+
+    (subs, threads) = job
+    budget = _MERGE_SHARD['budget']
+    with budget:
+        while (_MERGE_SHARD['free'][0] < threads) and not _MERGE_SHARD['abort']:
+            budget.wait()
+        if _MERGE_SHARD['abort']:
+            return {}
+        _MERGE_SHARD['free'][0] -= threads
+
+    try:
+        args = (_MERGE_SHARD['clusterSize_dict'], _MERGE_SHARD['seq_dict'], _MERGE_SHARD['cluster_id'], threads,
+                _MERGE_SHARD['verb'], _MERGE_SHARD['run'])
+        if len(subs) == 1:
+            ((i, sub),) = subs.items()
+            return {i: _cluster_sub_network(sub, *args)}
+        if _MERGE_SHARD['verb']:
+            log('Clustering %s sub-networks (%s sequences) in one vsearch call...' %
+                (len(subs), sum(len(s) for s in subs.values())))
+        return _cluster_sub_networks(subs, *args)
+    finally:
+        with budget:
+            _MERGE_SHARD['free'][0] += threads
+            budget.notify_all()
+
+#sequences per batched vsearch call of merge_similar_nodes
+MERGE_BATCH_SIZE = 50000
+
+#vsearch --maxrejects of every merge clustering, batched or not (0 for no limit): candidate centroids
+#of the other sub-networks of a batch must not use up the rejects of a query, and a sub-network
+#clustered alone must give the same clusters as in a batch
+MERGE_MAXREJECTS = 0
+MERGE_VSEARCH_OPTIONS = '--maxrejects %s ' % MERGE_MAXREJECTS
+
+#sub-networks with fewer nodes are not clustered by merge_similar_nodes
+MIN_NET_SIZE = 3
+
+def merge_similar_nodes(G, cluster_id=0.9, min_net_size=MIN_NET_SIZE, threads=20, verb=False, run=True, checkpoint=None,
+                        batch_size=MERGE_BATCH_SIZE, inprocess_max=0, cache=None):   
     
     """Collapse similar nodes (sequence identify>cluser_id) within domain networks 
     
@@ -294,15 +1556,27 @@ def merge_similar_nodes(G, cluster_id=0.9, min_net_size=3, threads=20, verb=Fals
         vsearch (https://github.com/torognes/vsearch)
 
     Parameters:
-        G (nx.network): 
+        G (nx.network or compact graph): 
         cluster_id (float) :
-        min_net_size (int):  
-        threads (int) : 
+        min_net_size (int): sub-networks with fewer nodes are left as they are (default is MIN_NET_SIZE)
+        threads (int) : total vsearch threads, shared by the clustering jobs running at once
         verb (bool) :(default is False)
         verb (run) :(default is True)
+        checkpoint (dict) : from open_checkpoint, the merges of the clustered sub-networks are
+            saved there every checkpoint interval and reused when resuming (default is None)
+        batch_size (int) : sub-networks are clustered together by vsearch calls of up to batch_size
+            sequences, clusters are kept within sub-networks (default is MERGE_BATCH_SIZE, 0 for
+            one vsearch call per sub-network)
+        inprocess_max (int) : sub-networks of up to inprocess_max nodes with sequences of equal length
+            are clustered in process by sequence_clustering.cluster_fast instead of vsearch, unless some
+            of their sequences may align with gaps (default is 0)
+        cache (dict) : from open_cluster_cache, sub-networks clustered by earlier runs are taken from
+            the cache and new clusterings are stored there (default is None)
+
+    Merges are applied in sub-network order, the contracted network does not depend on threads.
 
     Returns: 
-        (contraction_df,T) tuple(pd.DataFrame,nx.network) : 
+        (contraction_df,T) tuple(pd.DataFrame,nx.network) : T has the backend of G
     
     Raises:
         IOError: An error occurred accessing the bigtable.Table object.
@@ -310,42 +1584,235 @@ def merge_similar_nodes(G, cluster_id=0.9, min_net_size=3, threads=20, verb=Fals
     """
 
     compressed_dict = defaultdict(list)
-    T = G.copy()
-    clusterSize_dict = nx.get_node_attributes(T,'clusterSize')
+    compact = is_compact_graph(G)
+    T = copy_graph(G) if compact else from_networkx(G)
+    clusterSize_dict = node_attribute(T,'clusterSize')
+    seq_dict = node_attribute(T,'seq')
     
     #iterate over all sub-netowrks and annotate accorind to netNum
-    nodesBySub = sorted(nx.connected_components(G), key = len, reverse=True)
+    nodesBySub = [T['nodes'][c].tolist() for c in connected_components(T)]
+    node_index = dict((n, k) for k,n in enumerate(T['nodes'].tolist()))
+    #(seed, node) node index pairs of all merges
+    merged_pairs = []
     if verb:
         log('%s sub-networks found...' % (len(nodesBySub) ))
     
     log('%s networks found... ' % len(nodesBySub))
-    for i,sub in enumerate(nodesBySub):
-        #try:
-        if (i%100 == 0):
-            log(i)
+
+    #(seed, node) merges of the sub-networks clustered before an interruption
+    resumed = {}
+    for part in (read_checkpoint(checkpoint, 'merge_') if checkpoint else {}).values():
+        for (i, start, end) in zip(part['subs'], part['offsets'][:-1], part['offsets'][1:]):
+            resumed[int(i)] = list(zip(part['seeds'][start:end].tolist(), part['nodes'][start:end].tolist()))
+    pending = []
+
+    #clustering jobs of the sub-networks left, run ahead of the merges by a pool of threads
+    todo = [i for i,sub in enumerate(nodesBySub) if (len(sub) >= min_net_size) and (i not in resumed)]
+    inprocess = set(i for i in todo if (len(nodesBySub[i]) <= inprocess_max) and
+                    _equal_length_sequences(nodesBySub[i], seq_dict))
+    #sub-networks of the same sequences clustered by earlier runs
+    (keys, cached) = ({}, {})
+    if (cache is not None) and todo:
+        keys = _cluster_keys(nodesBySub, todo, inprocess, clusterSize_dict, seq_dict, cluster_id)
+        hits = lookup_clusters(cache, keys.values())
+        cached = dict((i, hits[k]) for i,k in keys.items() if k in hits)
+        inprocess -= set(cached)
+    #in process clustering first, sub-networks with sequences that may align with gaps join the vsearch jobs
+    local = {}
+    for i in sorted(inprocess):
+        (headers, seqs) = _sub_network_fasta(nodesBySub[i], clusterSize_dict, seq_dict)
+        local[i] = cluster_fast(headers, seqs, cluster_id, maxrejects=MERGE_MAXREJECTS)
+    gapped = set(i for i,merges in local.items() if merges is None)
+    inprocess -= gapped
+    if gapped and (cache is not None):
+        keys.update(_cluster_keys(nodesBySub, gapped, set(), clusterSize_dict, seq_dict, cluster_id))
+        hits = lookup_clusters(cache, [keys[i] for i in gapped])
+        cached.update((i, hits[keys[i]]) for i in gapped if keys[i] in hits)
+    if cache is not None:
+        log('%s of %s sub-networks found in the clustering cache...' % (len(cached), len(todo)))
+    todo = [i for i in todo if (i not in inprocess) and (i not in cached)]
+    if inprocess:
+        log('%s sub-networks clustered in process...' % len(inprocess))
+    if gapped - set(cached):
+        log('%s sub-networks left to vsearch, their sequences may align with gaps...' % len(gapped - set(cached)))
+    jobs = _merge_jobs(nodesBySub, todo, max(1, threads), batch_size) if todo else []
+    clustered = {}
+
+    pool = None
+    try:
+        _init_merge_shard(clusterSize_dict, seq_dict, cluster_id, max(1, threads), verb, run)
+        shard_map = map
+        if (threads > 1) and (len(jobs) > 1):
+            if verb:
+                log('Running %s clustering jobs over %s threads...' % (len(jobs), threads))
+            pool = ThreadPool(min(threads, len(jobs)))
+            shard_map = pool.imap
+        results = shard_map(_cluster_job, jobs)
+
+        for i,sub in enumerate(nodesBySub):
+            #try:
+            if (i%100 == 0):
+                log(i)
             
-        if len(sub) < min_net_size:
-            continue
+            if len(sub) < min_net_size:
+                continue
+
+            if i in resumed:
+                merges = resumed[i]
+            elif i in cached:
+                merges = cached.pop(i)
+            else:
+                if i in inprocess:
+                    merges = local.pop(i)
+                else:
+                    while i not in clustered:
+                        clustered.update(next(results))
+                    merges = clustered.pop(i)
+                if merges is None:
+                    #no clustering table, nothing merged and nothing kept for a later run
+                    merges = []
+                else:
+                    if cache is not None:
+                        store_clusters(cache, keys[i], merges)
+                    if checkpoint:
+                        pending.append((i, merges))
+                        if checkpoint_due(checkpoint):
+                            _write_merge_checkpoint(checkpoint, pending)
+                            pending = []
         
-        #make tempdir and files 
-        tmpdir = tempfile.mkdtemp()
-        input_file = 'network_nodes.fna'
-        input_file = os.path.join(tmpdir, input_file)
+            #compress similar nodes based on vsearch clustering output  
+            for (seed, node) in merges:
+                if verb:
+                    log('Compressing node %s into node %s' % (seed,node))
+                #log all merges  
+                compressed_dict[seed].append(node)
+                merged_pairs.append((node_index[seed], node_index[node]))
+            if verb:
+                log('Compressed %s nodes...' % (len(merges)))
+
+        if pool is not None:
+            pool.close()
+    except BaseException:
+        #drop the queued jobs and let the waiting ones return without calling vsearch
+        if pool is not None:
+            with _MERGE_SHARD['budget']:
+                _MERGE_SHARD['abort'] = True
+                _MERGE_SHARD['budget'].notify_all()
+            pool.terminate()
+        raise
+    finally:
+        if pool is not None:
+            pool.join()
+        _MERGE_SHARD.clear()
+
+    #contract all merges at once, wells aggregated over the merged groups
+    T = _merge_node_attributes(T, merged_pairs)
+    (T, contraction_df) = contract_nodes(T, merged_pairs)
+    log('%s nodes merged...' % len(contraction_df))
+    if compact:
+        return (contraction_df,T)
+
+    return (contraction_df,to_networkx(T))
+
+def _cluster_keys(nodesBySub, subs, inprocess, clusterSize_dict, seq_dict, cluster_id):
+
+    """Clustering cache keys of sub-networks, clustered in process or by vsearch
+
+    Returns:
+        keys (dict) : sub-network number -> key
+    """
+
+    keys = {}
+    for i in subs:
+        (headers, seqs) = _sub_network_fasta(nodesBySub[i], clusterSize_dict, seq_dict)
+        #the options of vsearch are those of the in process clustering too
+        keys[i] = cluster_key(headers, seqs, cluster_id,
+                              ('inprocess ' if i in inprocess else 'vsearch ') + MERGE_VSEARCH_OPTIONS)
+
+    return keys
+
+def _equal_length_sequences(sub, seq_dict):
 
-        centroids_filename = input_file.replace('.fna','_OTU.fna')
-        centroids_filename = os.path.join(tmpdir, centroids_filename)
+    """True if every node of the sub-network has a sequence, all of the same length"""
 
-        table_filename = input_file.replace('.fna','_OTU.txt')
-        table_filename = os.path.join(tmpdir, table_filename)
+    seqs = [seq_dict.get(n) for n in sub]
+    return all(isinstance(s, str) for s in seqs) and (len(set(len(s) for s in seqs)) == 1)
 
-        # Ensure the file is read/write by the creator only
-        saved_umask = os.umask(0o001)
+def _merge_node_attributes(CG, pairs):
 
-        s = pd.Series(dict(zip(sub,sub)))
-        s = s.map(clusterSize_dict).sort_values(ascending=False)
-        headers = s.index.values
-        seqs = s.index.map(nx.get_node_attributes(G,'seq')).values
+    """Aggregate the node attributes of the nodes merged by (seed, node) index pairs
 
+    The union of the wells of every merged group is set on the node the group
+    is contracted into, and the compressed count of a node goes up by one for
+    every pair it is the seed of, as when the merges were applied one by one.
+
+    Returns:
+        CG (dict) : compact graph, updated in place
+    """
+
+    roots = contraction_roots(len(CG['nodes']), pairs)
+    merged = np.flatnonzero(roots != np.arange(len(roots)))
+    if len(merged) == 0:
+        return CG
+
+    attrs = CG['node_attrs']
+    if 'compressed' in attrs:
+        compressed = np.array([0 if c is None else int(c) for c in attrs['compressed']], dtype=np.int64)
+        compressed += np.bincount([u for u,v in pairs], minlength=len(roots))
+        attrs['compressed'] = compressed
+    if 'well' in attrs:
+        order = merged[np.argsort(roots[merged], kind='stable')]
+        bounds = np.r_[0, np.flatnonzero(np.diff(roots[order])) + 1, len(order)]
+        for (start, end) in zip(bounds[:-1], bounds[1:]):
+            root = roots[order[start]]
+            attrs['well'][root] = np.unique(np.concatenate([parse_wells(attrs['well'][k])
+                                                            for k in [root] + order[start:end].tolist()]))
+
+    return CG
+
+def _write_merge_checkpoint(checkpoint, pending):
+
+    """Save the (seed, node) merges of a batch of clustered sub-networks"""
+
+    merges = [m for i,sub_merges in pending for m in sub_merges]
+    write_checkpoint(checkpoint, 'merge_%010d' % pending[-1][0],
+                     subs=np.array([i for i,sub_merges in pending], dtype=np.int64),
+                     offsets=np.r_[0, np.cumsum([len(sub_merges) for i,sub_merges in pending])].astype(np.int64),
+                     seeds=np.array([m[0] for m in merges], dtype=str),
+                     nodes=np.array([m[1] for m in merges], dtype=str))
+
+def _sub_network_fasta(sub, clusterSize_dict, seq_dict):
+
+    """Headers and sequences of a sub-network, largest clusters first"""
+
+    s = pd.Series(dict(zip(sub,sub)))
+    s = s.map(clusterSize_dict).sort_values(ascending=False)
+
+    return (list(s.index.values), list(s.index.map(seq_dict).values))
+
+def _vsearch_clusters(headers, seqs, cluster_id, threads, verb=False, run=True, options=''):
+
+    """Cluster sequences with vsearch --cluster_fast
+
+    Returns:
+        otuDF (pd.DataFrame) : 'H' and 'S' rows of the uc table, h is the centroid of
+            every query q (itself for centroids), None if the table can not be read
+    """
+
+    #make tempdir and files (mkdtemp creates it read/write by the creator only, the process umask
+    #is left alone as clustering jobs run in threads)
+    tmpdir = tempfile.mkdtemp()
+    input_file = 'network_nodes.fna'
+    input_file = os.path.join(tmpdir, input_file)
+
+    centroids_filename = input_file.replace('.fna','_OTU.fna')
+    centroids_filename = os.path.join(tmpdir, centroids_filename)
+
+    table_filename = input_file.replace('.fna','_OTU.txt')
+    table_filename = os.path.join(tmpdir, table_filename)
+
+    no_table_flag = False
+    try:
         makeFasta(headers,seqs,input_file)
 
         cmd = ('vsearch '
@@ -356,19 +1823,18 @@ def merge_similar_nodes(G, cluster_id=0.9, min_net_size=3, threads=20, verb=Fals
                '-sizein '
                '--threads %s '  %
                 (input_file,cluster_id,centroids_filename,table_filename,threads)
-               )
+               ) + options
 
         if verb:
             log('\n')
             log(cmd)
 
         if run:
-            execute(cmd)
+            run_command(cmd)
 
         if verb:
                 log('Parsing OTU information from %s' % table_filename)
 
-        no_table_flag = False
         try:
             otuDF = pd.read_csv(table_filename,sep='\t',index_col=None)
             otuDF.columns  = ['type','cluster','length','ident','strand','','','align','q','h']
@@ -376,65 +1842,104 @@ def merge_similar_nodes(G, cluster_id=0.9, min_net_size=3, threads=20, verb=Fals
             log('Unable to read clustering table %s...' % table_filename )
             no_table_flag = True
 
+    finally:
+    #clear temp files, also when vsearch failed
+        try:
+            shutil.rmtree(tmpdir)
+        except:
+            log('Unable to remove temp files at %s...' % tmpdir)
+    
+    if (no_table_flag):
+        return None
+    
+    #Only consider 'Hit' or 'Seed' rows 
+    otuDF = otuDF[ (otuDF.type == 'H') | (otuDF.type == 'S') ]
+    #Select only seed rows
+    seedsIndex = otuDF[otuDF['type'] == 'S'].index
+    #For seeds put self as hit
+    otuDF.loc[seedsIndex,'h'] = otuDF.loc[seedsIndex,'q'] 
 
-        #except:
-        #print 'IOError'
-        #sys.exit()
+    return otuDF
 
-        finally:
-        #clear temp files 
-            try:
-                os.remove(input_file)
-                os.remove(centroids_filename)
-                os.remove(table_filename)
-                os.umask(saved_umask)
-                os.rmdir(tmpdir)
-            except:
-                log('Unable to remove temp files at %s...' % tmpdir)
-        
-        if (no_table_flag):
-            continue
-        
-        #Only consider 'Hit' or 'Seed' rows 
-        otuDF = otuDF[ (otuDF.type == 'H') | (otuDF.type == 'S') ]
-        #Select only seed rows
-        seedsIndex = otuDF[otuDF['type'] == 'S'].index
-        #For seeds put self as hit
-        otuDF.loc[seedsIndex,'h'] = otuDF.loc[seedsIndex,'q'] 
-        
-        #compress similar nodes based on vsearch clustering output  
-        counter = 0
-        for seed, group in otuDF.groupby('h'):
-            #iterativly contract all nodes within cluster centroid node
-            for node in group['q'].values:
-                if node == seed:
-                    continue
-                if verb:
-                    log('Compressing node %s into node %s' % (seed,node))
-                #log all merges  
-                compressed_dict[seed].append(node)
-                #merge wells of contracted nodes 
-                T.node[seed]['well'] = T.node[seed]['well'] + '_' + T.node[node]['well']
-                T.node[seed]['well'] = '_'.join(sorted(list(set(T.node[seed]['well'].split('_')))))
-                #flag as compressed 
-                T.node[seed]['compressed'] = int(T.node[seed]['compressed']) + 1
-                T = nx.contracted_nodes(T,seed,node)
-                counter += 1 
-        if verb:
-            log('Compressed %s nodes...' % (counter))
-    
-    contraction_dict = nx.get_node_attributes(T,'contraction')
+def _cluster_merges(otuDF):
 
-    contraction_df = pd.DataFrame.from_dict({(i,j): contraction_dict[i][j] 
-                           for i in contraction_dict.keys() 
-                           for j in contraction_dict[i].keys()},
-                       orient='index')
-    
-    for node in T.nodes():
-        if 'contraction' in T.node[node].keys():
-            del T.node[node]['contraction']
-    
-    return (contraction_df,T)
+    """(seed, node) pairs merging every node into its cluster centroid seed"""
+
+    #iterativly contract all nodes within cluster centroid node
+    merges = []
+    for seed, group in otuDF.groupby('h'):
+        for node in group['q'].values:
+            if node == seed:
+                continue
+            merges.append((seed, node))
+
+    return merges
+
+def _cluster_sub_network(sub, clusterSize_dict, seq_dict, cluster_id, threads, verb=False, run=True):
+
+    """Cluster the node sequences of a sub-network with vsearch
+
+    Returns:
+        merges (list) : (seed, node) pairs, node is merged into its cluster centroid seed,
+            None if vsearch gave no readable clustering table (or was not run)
+    """
+
+    (headers, seqs) = _sub_network_fasta(sub, clusterSize_dict, seq_dict)
+    otuDF = _vsearch_clusters(headers, seqs, cluster_id, threads, verb, run, options=MERGE_VSEARCH_OPTIONS)
+    if otuDF is None:
+        return None
+
+    return _cluster_merges(otuDF)
+
+def _cluster_sub_networks(subs, clusterSize_dict, seq_dict, cluster_id, threads, verb=False, run=True):
+
+    """Cluster the node sequences of several sub-networks with a single vsearch call
+
+    Clusters stay within their sub-network: a sub-network with a node clustered
+    with the centroid of another sub-network (and that other sub-network) is
+    clustered again on its own. Candidate centroids of the other sub-networks
+    must not use up the rejects of a query, so the batch runs with --maxrejects
+    MERGE_MAXREJECTS (no limit), as sub-networks clustered on their own.
+
+    Parameters:
+        subs (dict): sub-network number -> node names
+        clusterSize_dict (dict) : node -> cluster size
+        seq_dict (dict) : node -> sequence
+        cluster_id (float) :
+        threads (int) :
+        verb (bool) :(default is False)
+        run (bool) :(default is True)
+
+    Returns:
+        merges (dict) : sub-network number -> (seed, node) pairs, as from _cluster_sub_network
+    """
+
+    (headers, seqs, sub_of) = ([], [], {})
+    for (i, sub) in subs.items():
+        (sub_headers, sub_seqs) = _sub_network_fasta(sub, clusterSize_dict, seq_dict)
+        headers.extend(sub_headers)
+        seqs.extend(sub_seqs)
+        sub_of.update((n, i) for n in sub_headers)
+
+    otuDF = _vsearch_clusters(headers, seqs, cluster_id, threads, verb, run, options=MERGE_VSEARCH_OPTIONS)
+    if otuDF is None:
+        return dict((i, None) for i in subs)
+
+    q_sub = otuDF['q'].map(sub_of).values
+    h_sub = otuDF['h'].map(sub_of).values
+    crossed = q_sub != h_sub
+    conflicts = set(q_sub[crossed].tolist()) | set(h_sub[crossed].tolist())
+    if verb and conflicts:
+        log('%s sub-networks clustered across sub-networks, clustering them alone...' % len(conflicts))
+
+    merges = dict((i, []) for i in subs)
+    keep = ~np.isin(q_sub, list(conflicts))
+    for (i, group) in otuDF[keep].groupby(q_sub[keep]):
+        merges[i] = _cluster_merges(group)
+    for i in sorted(conflicts):
+        merges[i] = _cluster_sub_network(subs[i], clusterSize_dict, seq_dict, cluster_id, threads, verb, run)
+
+    return merges
 
 def clean_host_reads(input_file_fullpath, host_ref_fullpath, 
                      output_file_fullpath, maxindel=10, minid=0.95, 
@@ -481,14 +1986,14 @@ def clean_host_reads(input_file_fullpath, host_ref_fullpath,
         print(cmd)
 
     if run:
-        execute(cmd,screen=True)
+        run_command(cmd,screen=True)
     
-    cmd = ('samtools fasta %s > %s' % (bam_file_fullpath, output_file_fullpath) )
+    cmd = ('samtools fasta %s' % bam_file_fullpath)
     if verbose:
-        print(cmd)
+        print('%s > %s' % (cmd, output_file_fullpath))
 
     if run:
-        execute(cmd,screen=True)
+        run_command(cmd,screen=True,stdout_path=output_file_fullpath)
 
     if remove_files:
         os.remove(bam_file_fullpath)
@@ -11,6 +11,7 @@ Parameters:
     relative_th_factor (float) : relative size threshold for removing amplicons with low reads within clusters, default = 0.05'
     min_subpools (int) : only consider amplicons detected in more than min_subpools subpools
     threads (int): number of threads to use by vsearch, default = 1
+    wells_per_plate (int): plate format of the library subpools (96, 384 or 1536), default = 384
     remove_files (bool) : do not keep processed read files, default = False
     verbose (bool) : increase output verbosity, default = False
 
@@ -24,9 +25,9 @@ from Bio import SeqIO
 import re
 
 from helpers import ensure_dir
-from helpers import execute
 from helpers import log
-from helpers import int_to_well_position
+from plate_geometry import plate_geometry
+from plate_geometry import plates_needed
 
 
 
@@ -58,6 +59,9 @@ if __name__ == "__main__":
     parser.add_argument('--threads', help='number of threads to use by vsearch, default = 1',
                         type=int, default=1)
 
+    parser.add_argument('--wells_per_plate', help='plate format of the library subpools, default = 384',
+                        required=False, type=int, default=384, choices=[96, 384, 1536])
+
     parser.add_argument('--verbose', help='increase output verbosity',
                         action='store_true')
 
@@ -69,6 +73,7 @@ if __name__ == "__main__":
     min_subpools = args.min_subpools
     relative_th_factor = args.relative_size_threshold
     threads = args.threads
+    wells_per_plate = args.wells_per_plate
     verbose = args.verbose
     
     
@@ -156,12 +161,12 @@ if __name__ == "__main__":
     log('%s clusters found (%s OTUs)...' % (otu.h.nunique(),len(otu)))
 
     #annotate plate position 
-    otu['plate'] = otu.well.apply(lambda x: x / 384 )
-    otu['platePos'] = otu.well.apply(lambda x: int_to_well_position(x) )
-    otu['rowPos'] = otu.platePos.apply(lambda x: x[0])
-    otu['rowPos'] = 'R' + otu['rowPos'].astype(str) + '_P' + otu['plate'].astype(str)
-    otu['colPos'] = otu.platePos.apply(lambda x: x[1:])
-    otu['colPos'] = 'C' + otu['colPos'].astype(str) + '_P' + otu['plate'].astype(str)
+    geometry = plate_geometry(wells_per_plate, plates_needed(otu['well'].values, wells_per_plate))
+    wells = otu['well'].values.astype(int)
+    otu['plate'] = geometry['plate'][wells]
+    otu['platePos'] = geometry['position'][wells]
+    otu['rowPos'] = geometry['row_labels'][geometry['row_group'][wells]]
+    otu['colPos'] = geometry['col_labels'][geometry['col_group'][wells]]
 
     #min_read_size
     log('Dropping clusters with min_read_size < %s from table...' % (min_read_size,))
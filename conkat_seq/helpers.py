@@ -1,7 +1,14 @@
 import sys
 import os
+import numpy as np
 from scipy import stats
+from scipy.special import gammaln
 import subprocess
+import shlex
+import signal
+import time
+import threading
+from collections import deque
 
 def log(s):
     print(s)
@@ -10,6 +17,102 @@ def calc_fisher(a,b,c,d):
     oddsratio, pvalue = stats.fisher_exact([[a,b],[c,d]])
     return oddsratio,pvalue  
 
+#relative tolerance used to treat hypergeometric probabilities as equal
+FISHER_RTOL = 1e-7
+
+def fisher_exact_batch(a, Ov1, Ov2, Nwells, cache=None):
+
+    """Two-sided Fisher exact test for arrays of co-occurrence tables
+
+    Every table is [[a, Ov1-a], [Ov2-a, Nwells-Ov1-Ov2+a]] so each test is a
+    hypergeometric tail over (a, Ov1, Ov2) for a fixed Nwells. Tests sharing the
+    same margins reuse one hypergeometric pmf. P-values match
+    stats.fisher_exact to a relative tolerance of 1e-9 (pmf ties within
+    FISHER_RTOL are summed as in stats.fisher_exact), odds ratios exactly.
+
+    Parameters:
+        a (np.array): number of wells shared by the pair
+        Ov1 (np.array): number of wells of the first seed
+        Ov2 (np.array): number of wells of the second seed
+        Nwells (int): total number of wells
+        cache (dict): (a,Ov1,Ov2) -> (oddsratio,pvalue) memo for this Nwells, updated in place (default is None)
+
+    Returns:
+        (oddsratio,pvalue) tuple(np.array,np.array) :
+    """
+
+    a = np.asarray(a, dtype=np.int64)
+    Ov1 = np.asarray(Ov1, dtype=np.int64)
+    Ov2 = np.asarray(Ov2, dtype=np.int64)
+
+    #the test is symmetric in (Ov1,Ov2), canonical triples are (a, min, max)
+    lo = np.minimum(Ov1, Ov2)
+    hi = np.maximum(Ov1, Ov2)
+    base = np.int64(Nwells + 1)
+    keys = (lo * base + hi) * base + a
+    (ukeys, inverse) = np.unique(keys, return_inverse=True)
+    ulo = ukeys // (base * base)
+    uhi = (ukeys // base) % base
+    ua = ukeys % base
+
+    odds = np.empty(len(ukeys))
+    pvals = np.empty(len(ukeys))
+    todo = np.ones(len(ukeys), dtype=bool)
+    if cache:
+        for k,key in enumerate(zip(ua.tolist(), ulo.tolist(), uhi.tolist())):
+            if key in cache:
+                (odds[k], pvals[k]) = cache[key]
+                todo[k] = False
+
+    idx = np.flatnonzero(todo)
+    if len(idx):
+        (odds[idx], pvals[idx]) = _fisher_exact_margins(ua[idx], ulo[idx], uhi[idx], Nwells)
+        if cache is not None:
+            cache.update(zip(zip(ua[idx].tolist(), ulo[idx].tolist(), uhi[idx].tolist()),
+                             zip(odds[idx].tolist(), pvals[idx].tolist())))
+
+    inverse = inverse.reshape(-1)
+    return (odds[inverse], pvals[inverse])
+
+def _fisher_exact_margins(a, n1, n, Nwells):
+
+    """Fisher exact test for unique (a, n1, n) triples sorted by margins (n1, n)"""
+
+    b = n1 - a
+    c = n - a
+    d = Nwells - n1 - n + a
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        odds = np.where((b > 0) & (c > 0), (a * d).astype(float) / (b * c), np.inf)
+    pvals = np.ones(len(a))
+
+    #empty rows or columns -> (nan, 1.0) as in stats.fisher_exact
+    empty = (n1 == 0) | (n == 0) | (n1 == Nwells) | (n == Nwells)
+    odds[empty] = np.nan
+
+    logfact = gammaln(np.arange(Nwells + 1, dtype=float) + 1)
+    logtol = np.log1p(FISHER_RTOL)
+
+    #triples are sorted by (n1, n) so every margin is one contiguous block
+    margins = n1 * (Nwells + 1) + n
+    starts = np.flatnonzero(np.r_[True, margins[1:] != margins[:-1]])
+    ends = np.r_[starts[1:], len(a)]
+    for s,e in zip(starts, ends):
+        if empty[s]:
+            continue
+        (m1, m) = (n1[s], n[s])
+        xmin = max(0, m1 + m - Nwells)
+        x = np.arange(xmin, min(m1, m) + 1)
+        logpmf = (logfact[m1] - logfact[x] - logfact[m1 - x]
+                  + logfact[Nwells - m1] - logfact[m - x] - logfact[Nwells - m1 - m + x]
+                  - logfact[Nwells] + logfact[m] + logfact[Nwells - m])
+        order = np.sort(logpmf)
+        cum = np.logaddexp.accumulate(order)
+        thr = logpmf[a[s:e] - xmin] + logtol
+        pvals[s:e] = np.exp(cum[np.searchsorted(order, thr, side='right') - 1])
+
+    return (odds, np.minimum(pvals, 1.0))
+
 def makeFasta(headers,seqs,outputfile):
     headers =  ['>'+x if x[0] != '>' else x for x in headers]
     headers = [ x.replace('>>','>') for x in headers]
@@ -19,27 +122,145 @@ def makeFasta(headers,seqs,outputfile):
     for item in fastaList:
         fileHandle.write("%s\n" % item)   
 
-def execute(command,screen=False):
-    msg = ''
-    process = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-    # Poll process for new output until finished
-    while True:
-        nextline = process.stdout.readline()
-        if nextline == '' and process.poll() is not None:
-            break
-        
-        msg = msg + str(nextline)
-        
-        if screen:
-            sys.stdout.write(nextline)
-            sys.stdout.flush()
-
-    output = process.communicate()[0]
-    exitCode = process.returncode
-    if (exitCode == 0):
-        return msg
-    else:
-        print("%s --> exitcode: %s --> %s" % (command, exitCode, output))
+#lines of output kept from an external command (for error messages)
+COMMAND_TAIL_LINES = 50
+
+#bytes read from the output of an external command at once
+COMMAND_CHUNK = 65536
+
+#performance log and default timeout of the external commands of a run, set by configure_commands
+_COMMANDS = {'perf_log': None, 'timeout': None, 'lock': threading.Lock()}
+
+PERFORMANCE_COLUMNS = ['start', 'command', 'returncode', 'wall_s', 'cpu_user_s', 'cpu_sys_s', 'max_rss_mb', 'args']
+
+def configure_commands(perf_log=None, timeout=None):
+
+    """Set the performance log and the default timeout of the external commands of a run
+
+    Parameters:
+        perf_log (str): tab separated file receiving one PERFORMANCE_COLUMNS row per command (default is None, no log)
+        timeout (float) : seconds before an external command is killed (default is None, no timeout)
+
+    Returns:
+
+    """
+
+    _COMMANDS.update(perf_log=perf_log, timeout=timeout)
+
+def _record_command(row):
+
+    """Append the metrics of an external command to the performance log"""
+
+    if _COMMANDS['perf_log'] is None:
+        return
+    with _COMMANDS['lock']:
+        new = not os.path.isfile(_COMMANDS['perf_log'])
+        with open(_COMMANDS['perf_log'], 'a') as f:
+            if new:
+                f.write('\t'.join(PERFORMANCE_COLUMNS) + '\n')
+            f.write('\t'.join(str(row[k]) for k in PERFORMANCE_COLUMNS) + '\n')
+
+def run_command(command, screen=False, timeout=None, stdout_path=None):
+
+    """Run an external command without a shell
+
+    The output (stdout and stderr, or stderr alone when stdout goes to a file) is
+    read in COMMAND_CHUNK byte chunks, echoed when screen is set, and only its last
+    COMMAND_TAIL_LINES lines are kept. Wall time, CPU time and peak RSS of the
+    command are appended to the performance log set by configure_commands. The
+    command reads no standard input and runs in its own process group, killed as
+    a whole on timeout or error (wrappers such as bbmap.sh leave the work and the
+    output pipe to a child).
+
+    Parameters:
+        command (str or list): command line (split like a shell would, without expansions) or argument list
+        screen (bool) : echo the output (default is False)
+        timeout (float) : seconds before the command is killed (default is None, the configure_commands timeout)
+        stdout_path (str) : file receiving the standard output (default is None)
+
+    Returns:
+        output (str) : last lines of the output
+
+    Raises:
+        subprocess.TimeoutExpired: The command ran longer than timeout.
+        subprocess.CalledProcessError: The command exited with a non-zero code.
+    """
+
+    args = shlex.split(command) if isinstance(command, str) else [str(x) for x in command]
+    timeout = _COMMANDS['timeout'] if timeout is None else timeout
+
+    start = time.time()
+    stdout = open(stdout_path, 'wb') if stdout_path else None
+    try:
+        if stdout is None:
+            process = subprocess.Popen(args, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                       start_new_session=True)
+            stream = process.stdout
+        else:
+            process = subprocess.Popen(args, stdin=subprocess.DEVNULL, stdout=stdout, stderr=subprocess.PIPE,
+                                       start_new_session=True)
+            stream = process.stderr
+    finally:
+        if stdout is not None:
+            stdout.close()
+
+    (expired, reaped) = (threading.Event(), threading.Event())
+    def kill_group():
+        if not reaped.is_set():
+            try:
+                os.killpg(process.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+    def kill():
+        expired.set()
+        kill_group()
+    timer = threading.Timer(timeout, kill) if timeout else None
+    if timer is not None:
+        timer.daemon = True
+        timer.start()
+
+    #stream the output, keeping the last lines and at most one chunk of an unfinished line
+    tail = deque(maxlen=COMMAND_TAIL_LINES)
+    partial = b''
+    try:
+        while True:
+            chunk = os.read(stream.fileno(), COMMAND_CHUNK)
+            if not chunk:
+                break
+            if screen:
+                sys.stdout.write(chunk.decode('utf-8', 'replace'))
+                sys.stdout.flush()
+            lines = (partial + chunk).replace(b'\r', b'\n').split(b'\n')
+            partial = lines.pop()[-COMMAND_CHUNK:]
+            tail.extend(x.decode('utf-8', 'replace') for x in lines[-COMMAND_TAIL_LINES:])
+        if partial:
+            tail.append(partial.decode('utf-8', 'replace'))
+    except BaseException:
+        kill_group()
+        raise
+    finally:
+        stream.close()
+        #reap the command with its resource usage
+        (pid, status, usage) = os.wait4(process.pid, 0)
+        reaped.set()
+        process.returncode = os.waitstatus_to_exitcode(status)
+        if timer is not None:
+            timer.cancel()
+
+    #ru_maxrss is in KB on linux, in bytes on macOS (linux counts the memory inherited at fork)
+    max_rss_mb = usage.ru_maxrss / (1024.0 * 1024.0 if sys.platform == 'darwin' else 1024.0)
+    _record_command({'start': time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(start)), 'command': os.path.basename(args[0]),
+                     'returncode': process.returncode, 'wall_s': '%.3f' % (time.time() - start),
+                     'cpu_user_s': '%.3f' % usage.ru_utime, 'cpu_sys_s': '%.3f' % usage.ru_stime,
+                     'max_rss_mb': '%.1f' % max_rss_mb, 'args': ' '.join(args)})
+
+    output = '\n'.join(tail)
+    if expired.is_set():
+        raise subprocess.TimeoutExpired(args, timeout, output=output)
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, args, output=output)
+
+    return output
 
 def ensure_dir(file_path):
     directory = os.path.dirname(file_path)
@@ -55,7 +276,30 @@ def is_neighbour(pair):
     
 def int_to_well_position(well):
     well = (well-1)%384
-    col = (well / 16) + 1
+    col = (well // 16) + 1
     row = chr((well % 16)+65)
     return (row+str(col))
 
+
+def parse_wells(wells):
+
+    """Well set of a node as a sorted int32 array of unique well ids
+
+    Parameters:
+        wells (np.array, list or str): well ids, or their '_' joined string form
+
+    Returns:
+        wells (np.array) :
+    """
+
+    if isinstance(wells, str):
+        wells = wells.split('_') if wells else []
+    return np.unique(np.asarray(wells, dtype=np.int64)).astype(np.int32)
+
+def format_wells(wells):
+
+    """'_' joined string form of a well set, for GraphML and csv exports"""
+
+    if isinstance(wells, str):
+        return wells
+    return '_'.join(str(w) for w in np.asarray(wells).tolist())
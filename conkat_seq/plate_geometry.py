@@ -0,0 +1,101 @@
+import numpy as np
+
+#rows and columns of the supported plate formats
+PLATE_LAYOUTS = {96: (8, 12), 384: (16, 24), 1536: (32, 48)}
+
+#A plate geometry is a dict of lookup arrays indexed by well id (1 ... nwells,
+#index 0 is unused), wells are numbered down the columns of consecutive plates:
+#    wells_per_plate, nrows, ncols, nplates, nwells : layout
+#    plate, row, col : plate, row and column (0 based) of every well
+#    row_group, col_group : plate * nrows + row and plate * ncols + col of every well
+#    position : 'A1' style position of every well on its plate
+#    row_labels, col_labels : 'RA_P0' and 'C1_P0' style names of every row and column group
+
+def _row_name(row):
+
+    """Row letters of a 0 based row, A ... Z, AA, AB ... on 1536-well plates"""
+
+    name = chr(row % 26 + 65)
+    if row >= 26:
+        name = chr(row // 26 + 64) + name
+    return name
+
+def plate_geometry(wells_per_plate=384, nplates=6):
+
+    """Precompute the plate, row and column of every well id of a library
+
+    Parameters:
+        wells_per_plate (int): 96, 384 or 1536 (default is 384)
+        nplates (int) : number of plates (default is 6)
+
+    Returns:
+        geometry (dict) :
+
+    Raises:
+        ValueError: Unknown plate format.
+    """
+
+    if wells_per_plate not in PLATE_LAYOUTS:
+        raise ValueError('Unknown plate format -> %s wells (%s)' % (wells_per_plate, sorted(PLATE_LAYOUTS)))
+    (nrows, ncols) = PLATE_LAYOUTS[wells_per_plate]
+    nplates = int(nplates)
+    nwells = wells_per_plate * nplates
+
+    ids = np.arange(nwells + 1)
+    pos = (ids - 1) % wells_per_plate
+    plate = (ids - 1) // wells_per_plate
+    row = pos % nrows
+    col = pos // nrows
+    (plate[0], row[0], col[0]) = (-1, -1, -1)
+
+    row_names = np.array([_row_name(r) for r in range(nrows)], dtype=object)
+    position = row_names[row] + (col + 1).astype(str).astype(object)
+    position[0] = None
+
+    groups = np.arange(nplates)
+    row_labels = np.array(['R%s_P%s' % (row_names[r], p) for p in groups for r in range(nrows)], dtype=object)
+    col_labels = np.array(['C%s_P%s' % (c + 1, p) for p in groups for c in range(ncols)], dtype=object)
+
+    return {'wells_per_plate': wells_per_plate, 'nrows': nrows, 'ncols': ncols,
+            'nplates': nplates, 'nwells': nwells,
+            'plate': plate, 'row': row, 'col': col,
+            'row_group': np.where(ids > 0, plate * nrows + row, -1),
+            'col_group': np.where(ids > 0, plate * ncols + col, -1),
+            'position': position, 'row_labels': row_labels, 'col_labels': col_labels}
+
+def geometry_layout(geometry):
+
+    """Layout array (wells per plate, rows, columns, plates) identifying a geometry"""
+
+    return np.array([geometry['wells_per_plate'], geometry['nrows'], geometry['ncols'], geometry['nplates']])
+
+def plates_needed(wells, wells_per_plate=384):
+
+    """Number of plates holding the largest well id"""
+
+    wells = np.asarray(wells)
+    if len(wells) == 0:
+        return 1
+    return max(1, int(-(-int(wells.max()) // wells_per_plate)))
+
+def well_groups(geometry, wells):
+
+    """Plate row and plate column groups of well ids (an array lookup)
+
+    Parameters:
+        geometry (dict): from plate_geometry
+        wells (np.array) : well ids, 1 ... geometry['nwells']
+
+    Returns:
+        (rows,cols) tuple(np.array,np.array) : row and column groups of every well
+
+    Raises:
+        ValueError: Well ids outside of the plates.
+    """
+
+    wells = np.asarray(wells, dtype=np.int64)
+    if wells.size and ((wells.min() < 1) or (wells.max() > geometry['nwells'])):
+        raise ValueError('Well ids outside of %s plates of %s wells -> %s..%s' %
+                         (geometry['nplates'], geometry['wells_per_plate'], wells.min(), wells.max()))
+
+    return (geometry['row_group'][wells], geometry['col_group'][wells])
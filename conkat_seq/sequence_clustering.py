@@ -0,0 +1,165 @@
+import numpy as np
+from scipy import sparse
+
+#defaults of vsearch --cluster_fast
+WORDLENGTH = 8
+MINWORDMATCHES = 12
+MAXACCEPTS = 1
+MAXREJECTS = 32
+
+#largest offset of the k-mer windows looked for out of the gapless alignment, and number
+#of windows free of mismatches at one offset that tell an alignment with gaps may match
+MAXSHIFT = 8
+GAPPED_WORDS = 3
+
+#2 bit codes of the nucleotides, -1 for other characters
+_NUCLEOTIDE_CODES = np.full(256, -1, dtype=np.int64)
+for (k, nt) in enumerate('ACGT'):
+    _NUCLEOTIDE_CODES[ord(nt)] = k
+    _NUCLEOTIDE_CODES[ord(nt.lower())] = k
+
+def header_size(header):
+
+    """Abundance of a ';size=N;' annotated header as read by vsearch -sizein (1 when not annotated)"""
+
+    for field in header.split(';'):
+        if field.startswith('size='):
+            return int(field[len('size='):])
+    return 1
+
+def kmer_incidence(seqs, wordlength=WORDLENGTH):
+
+    """Sequence x k-mer incidence matrix of the unique k-mers of every sequence
+
+    Parameters:
+        seqs (list): nucleotide sequences
+        wordlength (int) : k-mer length (default is WORDLENGTH)
+
+    Returns:
+        S (sparse.csr_matrix) : len(seqs) x 4**wordlength 0/1 matrix, k-mers with other
+            characters than ACGT are skipped
+
+    """
+
+    weights = 4 ** np.arange(wordlength - 1, -1, -1, dtype=np.int64)
+    (rows, cols) = ([], [])
+    for (k, seq) in enumerate(seqs):
+        x = _NUCLEOTIDE_CODES[np.frombuffer(seq.encode('ascii'), dtype=np.uint8)]
+        if len(x) < wordlength:
+            continue
+        windows = np.lib.stride_tricks.sliding_window_view(x, wordlength)
+        words = np.unique(windows[(windows >= 0).all(axis=1)] @ weights)
+        rows.append(np.full(len(words), k, dtype=np.int64))
+        cols.append(words)
+
+    rows = np.concatenate(rows) if rows else np.zeros(0, dtype=np.int64)
+    cols = np.concatenate(cols) if cols else np.zeros(0, dtype=np.int64)
+
+    return sparse.csr_matrix((np.ones(len(rows), dtype=np.int32), (rows, cols)),
+                             shape=(len(seqs), 4 ** wordlength))
+
+def _shifted_windows(A, b, wordlength, maxshift=MAXSHIFT):
+
+    """Most k-mer windows free of mismatches of the rows of A shifted against b by up to maxshift positions
+
+    Parameters:
+        A (np.array): sequences x positions array of characters
+        b (np.array) : positions array of characters
+        wordlength (int) : k-mer length
+        maxshift (int) : largest offset, both ways (default is MAXSHIFT)
+
+    Returns:
+        windows (np.array) : for every row of A, windows free of mismatches at the best offset
+
+    """
+
+    windows = np.zeros(len(A), dtype=np.int64)
+    for shift in range(1, min(maxshift, A.shape[1] - wordlength) + 1):
+        for equal in (A[:,shift:] == b[:-shift], A[:,:-shift] == b[shift:]):
+            mismatches = np.c_[np.zeros(len(A), dtype=np.int64), np.cumsum(~equal, axis=1)]
+            windows = np.maximum(windows, ((mismatches[:,wordlength:] - mismatches[:,:-wordlength]) == 0).sum(axis=1))
+
+    return windows
+
+def cluster_fast(headers, seqs, cluster_id, wordlength=WORDLENGTH, minwordmatches=MINWORDMATCHES,
+                 maxaccepts=MAXACCEPTS, maxrejects=MAXREJECTS):
+
+    """Greedy centroid clustering of equal length sequences, in process
+
+    Follows vsearch --cluster_fast -sizein: sequences are taken by decreasing
+    abundance (input order on ties, all sequences have the same length) and
+    compared to the centroids sharing at least minwordmatches unique k-mers, most
+    shared k-mers first. A sequence joins the centroid of highest identity among
+    the first maxaccepts accepted candidates, the search stops after maxrejects
+    rejected candidates (0 for no limit), and a sequence without an accepted
+    candidate becomes a new centroid. Identity is the fraction of identical
+    positions of the gapless alignment of the two sequences, which misses
+    variants with indels: when a rejected candidate has GAPPED_WORDS k-mer
+    windows free of mismatches at one offset of up to MAXSHIFT positions, it
+    may align with gaps and the sequences are left to vsearch.
+
+    Parameters:
+        headers (list): sequence labels, ';size=N;' annotations are read as abundances
+        seqs (list) : nucleotide sequences of equal length
+        cluster_id (float) : minimal identity of a sequence to its centroid
+        wordlength (int) : k-mer length of the prefilter (default is WORDLENGTH)
+        minwordmatches (int) : minimal number of shared k-mers of a candidate (default is MINWORDMATCHES)
+        maxaccepts (int) : (default is MAXACCEPTS)
+        maxrejects (int) : (default is MAXREJECTS)
+
+    Returns:
+        merges (list) : (seed, node) pairs, node is merged into its cluster centroid seed,
+            ordered as parsed from a vsearch uc table, None when a candidate may align with gaps
+
+    Raises:
+        ValueError: Sequences of different lengths.
+    """
+
+    n = len(seqs)
+    if n == 0:
+        return []
+    if len(set(len(s) for s in seqs)) > 1:
+        raise ValueError('In process clustering needs sequences of equal length -> %s lengths' %
+                         len(set(len(s) for s in seqs)))
+
+    sizes = np.array([header_size(h) for h in headers], dtype=np.int64)
+    order = np.lexsort((np.arange(n), -sizes))
+    X = np.array([np.frombuffer(s.upper().encode('ascii'), dtype=np.uint8) for s in seqs])
+    S = kmer_incidence(seqs, wordlength)
+    nwords = np.diff(S.indptr)
+    length = max(X.shape[1], 1)
+
+    centroids = []
+    hit = np.arange(n)
+    for q in order:
+        if len(centroids):
+            cand = np.array(centroids)
+            shared = np.asarray((S[cand] @ S[q].T).todense()).ravel()
+            keep = shared >= min(minwordmatches, nwords[q])
+            ranked = cand[keep][np.argsort(-shared[keep], kind='stable')]
+            if maxrejects:
+                ranked = ranked[:maxaccepts + maxrejects]
+
+            identity = (X[ranked] == X[q]).sum(axis=1) / float(length)
+            accepted = identity >= cluster_id
+            #candidates examined before maxaccepts accepts or maxrejects rejects
+            examined = np.cumsum(accepted) <= maxaccepts
+            if maxrejects:
+                examined &= np.r_[0, np.cumsum(~accepted)[:-1]] < maxrejects
+            rejected = ranked[examined & ~accepted]
+            if len(rejected) and (_shifted_windows(X[rejected], X[q], wordlength) >= GAPPED_WORDS).any():
+                return None
+            accepted &= examined
+            if accepted.any():
+                hit[q] = ranked[accepted][np.argmax(identity[accepted])]
+                continue
+        centroids.append(q)
+
+    merges = []
+    rank = np.empty(n, dtype=np.int64)
+    rank[order] = np.arange(n)
+    for seed in sorted(set(hit[hit != np.arange(n)].tolist()), key=lambda k: headers[k]):
+        members = np.flatnonzero((hit == seed) & (np.arange(n) != seed))
+        merges.extend((headers[seed], headers[q]) for q in members[np.argsort(rank[members])])
+
+    return merges
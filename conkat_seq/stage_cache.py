@@ -0,0 +1,147 @@
+import os
+import json
+import time
+import hashlib
+
+from helpers import log
+
+#bump to invalidate every cached stage after a change of the stage outputs
+STAGE_CACHE_VERSION = 1
+MANIFEST_RUNS = 50
+
+def file_digest(fullpath, block_size=2**20):
+
+    """sha256 of the content of a file"""
+
+    h = hashlib.sha256()
+    with open(fullpath, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            h.update(block)
+    return h.hexdigest()
+
+def stage_key(stage, params, inputs):
+
+    """Content address of a stage: sha256 of its name, parameters and input digests/keys
+
+    Parameters:
+        stage (str): stage name
+        params (dict) : parameters that change the stage outputs
+        inputs (dict) : name -> file digest or upstream stage key
+
+    Returns:
+        key (str) :
+
+    """
+
+    blob = json.dumps({'version': STAGE_CACHE_VERSION, 'stage': stage, 'params': params, 'inputs': inputs},
+                      sort_keys=True, default=str)
+    return hashlib.sha256(blob.encode('utf-8')).hexdigest()
+
+def output_fingerprint(outputs):
+
+    """Size and modification time of every output file (files of directories included)"""
+
+    fingerprint = {}
+    for fullpath in outputs:
+        if os.path.isdir(fullpath):
+            for root, dirs, files in os.walk(fullpath):
+                for name in sorted(files):
+                    st = os.stat(os.path.join(root, name))
+                    fingerprint[os.path.join(root, name)] = [st.st_size, st.st_mtime_ns]
+        elif os.path.isfile(fullpath):
+            st = os.stat(fullpath)
+            fingerprint[fullpath] = [st.st_size, st.st_mtime_ns]
+        else:
+            fingerprint[fullpath] = None
+    return fingerprint
+
+def load_manifest(fullpath):
+
+    """Load a stage cache manifest, an empty one if fullpath does not exist"""
+
+    manifest = {'entries': {}, 'stages': {}, 'runs': []}
+    if os.path.isfile(fullpath):
+        try:
+            with open(fullpath) as f:
+                manifest.update(json.load(f))
+        except ValueError:
+            log('Unable to read manifest, starting a new one -> %s' % fullpath)
+    manifest['runs'].append({'started': time.strftime('%Y-%m-%d %H:%M:%S'), 'stages': []})
+    manifest['runs'] = manifest['runs'][-MANIFEST_RUNS:]
+    return manifest
+
+def save_manifest(manifest, fullpath):
+
+    """Write a stage cache manifest (atomic replace)"""
+
+    with open(fullpath + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.rename(fullpath + '.tmp', fullpath)
+
+def _describe_changes(previous, current):
+
+    """List the keys whose values differ between two dicts"""
+
+    changes = []
+    for k in sorted(set(previous) | set(current)):
+        if previous.get(k) != current.get(k):
+            changes.append('%s: %s -> %s' % (k, previous.get(k), current.get(k)))
+    return changes
+
+def check_stage(manifest, stage, params, inputs, outputs, override=False):
+
+    """Decide whether the cached outputs of a stage can be reused
+
+    Parameters:
+        manifest (dict): stage cache manifest
+        stage (str): stage id (stage name and output name)
+        params (dict) : parameters that change the stage outputs
+        inputs (dict) : name -> file digest or upstream stage key
+        outputs (list) : output files and directories of the stage
+        override (bool) : always recompute (default is False)
+
+    Returns:
+        (hit,key,reason) tuple(bool,str,str) :
+
+    """
+
+    key = stage_key(stage.split(':')[0], params, inputs)
+    entry = manifest['entries'].get(key)
+    previous = manifest['stages'].get(stage)
+
+    if override:
+        return (False, key, 'override')
+    if entry is not None:
+        if any(not os.path.exists(x) for x in entry['outputs']):
+            return (False, key, 'outputs missing')
+        if output_fingerprint(entry['outputs']) != entry['fingerprint']:
+            return (False, key, 'outputs modified since cached')
+        return (True, key, 'inputs and parameters unchanged')
+    if previous is None:
+        return (False, key, 'no cached run')
+
+    changes = _describe_changes(previous['params'], params)
+    if changes:
+        return (False, key, 'parameters changed (%s)' % ', '.join(changes))
+    changed = [k for k in sorted(set(previous['inputs']) | set(inputs)) if previous['inputs'].get(k) != inputs.get(k)]
+    if changed:
+        return (False, key, 'inputs changed (%s)' % ', '.join(changed))
+    return (False, key, 'not cached')
+
+def record_stage(manifest, stage, key, params, inputs, outputs, hit, reason):
+
+    """Record a stage hit or miss in the manifest (and the outputs of a miss under its key)"""
+
+    if not hit:
+        outputs = [x for x in outputs if os.path.exists(x)]
+        #entries of other keys pointing to the rewritten outputs are stale
+        for k in [k for k,e in manifest['entries'].items() if set(e['outputs']) & set(outputs)]:
+            del manifest['entries'][k]
+        manifest['entries'][key] = {'stage': stage, 'outputs': outputs,
+                                    'fingerprint': output_fingerprint(outputs)}
+    manifest['stages'][stage] = {'key': key, 'params': params, 'inputs': inputs,
+                                 'status': ('hit' if hit else 'miss'), 'reason': reason,
+                                 'time': time.strftime('%Y-%m-%d %H:%M:%S')}
+    manifest['runs'][-1]['stages'].append({'stage': stage, 'key': key,
+                                           'status': ('hit' if hit else 'miss'), 'reason': reason})
+    log('Stage %s --> %s (%s)' % (stage, ('cached' if hit else 'computed'), reason))
@@ -0,0 +1,131 @@
+import numpy as np
+import networkx as nx
+
+import compact_graph as cg
+from conkat_utils import _merge_node_attributes
+
+
+def contracted_nodes_2x(G, u, v):
+
+    """nx.contracted_nodes of networkx 2.x (undirected graphs, self loops kept)"""
+
+    H = G.copy()
+    new_edges = ((u, w if w != v else u, d) for x, w, d in G.edges(v, data=True))
+    v_data = H.nodes[v]
+    H.remove_node(v)
+    H.add_edges_from(new_edges)
+    H.nodes[u].setdefault('contraction', {})[v] = v_data
+    return H
+
+
+def make_graph(n, edges):
+
+    """Compact graph of nodes x0..xn-1, edge k has weight k"""
+
+    edges = np.array(edges, dtype=np.int64).reshape(-1, 2)
+    return cg.compact_graph(['x%d' % k for k in range(n)], edges[:,0], edges[:,1],
+                            node_attrs={'size': np.arange(n) + 10},
+                            edge_attrs={'weight': np.arange(len(edges))})
+
+
+def edge_weights(G):
+
+    if cg.is_compact_graph(G):
+        G = cg.to_networkx(G)
+    return dict((frozenset((u, v)), d['weight']) for u,v,d in G.edges(data=True))
+
+
+def check_contraction(n, edges, pairs):
+
+    CG = make_graph(n, edges)
+    T = cg.to_networkx(CG)
+    for (u,v) in pairs:
+        T = contracted_nodes_2x(T, 'x%d' % u, 'x%d' % v)
+    (C, contraction_df) = cg.contract_nodes(cg.copy_graph(CG), pairs)
+
+    assert C['nodes'].tolist() == list(T.nodes())
+    assert edge_weights(C) == edge_weights(T)
+    assert contraction_df.index.tolist() == [('x%d' % u, 'x%d' % v) for u,v in pairs]
+    assert contraction_df['size'].tolist() == [v + 10 for u,v in pairs]
+
+
+def test_contract_chain():
+
+    edges = [(k, k + 1) for k in range(9)] + [(0, 9), (2, 7)]
+    check_contraction(10, edges, [(k + 1, k) for k in range(9)])
+    check_contraction(10, edges, [(0, k + 1) for k in range(9)])
+    check_contraction(10, edges, [(0, 5), (0, 6), (1, 0), (9, 1)])
+
+
+def test_contract_collapsed_edges():
+
+    #x1 and x2 share the neighbours x3 and x4, their edges collapse onto x1
+    edges = [(1, 3), (1, 4), (2, 3), (2, 4), (2, 5), (0, 1), (0, 2)]
+    check_contraction(6, edges, [(1, 2)])
+    check_contraction(6, edges, [(2, 1)])
+    check_contraction(6, edges, [(1, 2), (3, 4), (0, 3)])
+    check_contraction(6, edges, [(3, 4), (1, 2), (3, 5)])
+
+
+def test_contract_self_loops():
+
+    #an edge between the merged nodes becomes a self loop
+    check_contraction(3, [(0, 1), (1, 2)], [(0, 1)])
+    #self loop of v moving onto u, and onto the self loop of u
+    check_contraction(3, [(1, 1), (1, 2)], [(0, 1)])
+    check_contraction(3, [(0, 0), (1, 1), (1, 2)], [(0, 1)])
+    #v with both a self loop and an edge to u, in either order
+    check_contraction(3, [(0, 1), (1, 1), (1, 2)], [(0, 1)])
+    check_contraction(3, [(1, 1), (0, 1), (1, 2)], [(0, 1)])
+    check_contraction(3, [(1, 1), (0, 1), (1, 2)], [(1, 0)])
+    check_contraction(4, [(0, 1), (1, 2), (2, 3), (3, 0), (1, 1)], [(2, 1), (2, 3), (0, 2)])
+
+
+def test_contract_random_graphs():
+
+    rng = np.random.default_rng(0)
+    for trial in range(200):
+        n = int(rng.integers(3, 30))
+        edges = np.unique(np.sort(rng.integers(0, n, (int(rng.integers(1, 80)), 2)), axis=1), axis=0)
+        rng.shuffle(edges)
+        (alive, pairs) = (list(range(n)), [])
+        for k in range(int(rng.integers(1, n))):
+            (u, v) = rng.choice(alive, 2, replace=False).tolist()
+            pairs.append((u, v))
+            alive.remove(v)
+        check_contraction(n, edges, pairs)
+
+
+def test_contraction_roots():
+
+    #the group of v keeps the name of u, whatever the group sizes
+    pairs = [(k + 1, k) for k in range(1000)] + [(2000, 1000)]
+    roots = cg.contraction_roots(2001, pairs)
+    assert (roots[:1001] == 2000).all()
+    assert (roots[1001:] == np.arange(1001, 2001)).all()
+    roots = cg.contraction_roots(5, [(0, 1), (2, 3), (3, 0)])
+    assert roots.tolist() == [2, 2, 2, 2, 4]
+
+
+def test_contract_long_chain():
+
+    n = 200000
+    CG = make_graph(n, [(k, k + 1) for k in range(n - 1)])
+    (C, contraction_df) = cg.contract_nodes(CG, [(k + 1, k) for k in range(n - 1)])
+    assert C['nodes'].tolist() == ['x%d' % (n - 1)]
+    #the self loop made by the first pair stays, it is added last to the node moved next
+    assert edge_weights(C) == {frozenset(['x%d' % (n - 1)]): 0}
+    assert len(contraction_df) == n - 1
+
+
+def test_merge_node_attributes():
+
+    #compressed counts go up by one for every pair a node is the seed of, as with
+    #one merge at a time, and the merged groups keep the union of their wells
+    CG = make_graph(5, [(0, 1), (1, 2), (3, 4)])
+    CG['node_attrs']['compressed'] = np.array([0, 2, 0, 1, 0])
+    CG['node_attrs']['well'] = cg._column([np.array([1]), np.array([2, 3]), np.array([3]), np.array([4]), np.array([5])])
+    CG = _merge_node_attributes(CG, [(0, 1), (0, 2), (3, 4)])
+    assert CG['node_attrs']['compressed'].tolist() == [2, 2, 0, 2, 0]
+    assert CG['node_attrs']['well'][0].tolist() == [1, 2, 3]
+    assert CG['node_attrs']['well'][3].tolist() == [4, 5]
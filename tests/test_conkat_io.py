@@ -0,0 +1,83 @@
+import numpy as np
+import networkx as nx
+import pytest
+
+import compact_graph as cg
+from conkat_io import read_network, read_network_meta, write_graphml, write_network
+
+
+def annotated_network(rng, n=30, m=60):
+
+    """Random networkx graph with numeric, string and well set attributes, some of them missing"""
+
+    G = nx.Graph()
+    for k in range(n):
+        attrs = {'clusterSize': int(rng.integers(1, 100)), 'domain': 'AD' if k % 2 else 'DBD',
+                 'well': np.unique(rng.integers(0, 384, rng.integers(1, 10))).astype(np.int32)}
+        if k % 5:
+            attrs['score'] = float(rng.random())
+        if k % 7:
+            attrs['seq'] = ''.join(rng.choice(list('ACGT'), 20))
+        G.add_node('seed%d;size=%d' % (k, attrs['clusterSize']), **attrs)
+    nodes = list(G.nodes())
+    for (u, v) in rng.integers(0, n, (m, 2)):
+        if u != v:
+            G.add_edge(nodes[u], nodes[v], weight=float(rng.random() * 10))
+    #a node without well set and a node without any attribute
+    del G.nodes[nodes[3]]['well']
+    G.add_node('lonely')
+    return G
+
+
+def same_attrs(a, b):
+
+    if sorted(a) != sorted(b):
+        return False
+    return all(np.array_equal(a[k], b[k]) if isinstance(a[k], np.ndarray) else a[k] == b[k] for k in a)
+
+
+def check_network(T, G):
+
+    assert list(T.nodes()) == list(G.nodes())
+    assert all(same_attrs(T.nodes[n], G.nodes[n]) for n in G.nodes())
+    assert sorted(map(sorted, T.edges())) == sorted(map(sorted, G.edges()))
+    assert all(T.edges[u, v] == d for u,v,d in G.edges(data=True))
+
+
+def test_network_round_trip(tmp_path):
+
+    G = annotated_network(np.random.default_rng(0))
+    for (k, H) in enumerate([G, cg.from_networkx(G)]):
+        fullpath = str(tmp_path / ('network%d' % k))
+        write_network(H, fullpath)
+        meta = read_network_meta(fullpath)
+        assert (meta['nnodes'], meta['nedges']) == (G.number_of_nodes(), G.number_of_edges())
+        assert meta['node_columns']['well'] == 'wells'
+        assert meta['edge_columns']['weight'] == 'numeric'
+
+        check_network(read_network(fullpath, backend='networkx'), G)
+        check_network(cg.to_networkx(read_network(fullpath, mmap=False)), G)
+
+    #lazy column loading
+    CG = read_network(fullpath, node_columns=['clusterSize'], edge_columns=[])
+    assert list(CG['node_attrs']) == ['clusterSize']
+    assert CG['edge_attrs'] == {}
+    assert CG['node_attrs']['clusterSize'].tolist() == [d.get('clusterSize') for n,d in G.nodes(data=True)]
+
+
+def test_network_not_a_directory(tmp_path):
+
+    with pytest.raises(IOError):
+        read_network(str(tmp_path))
+
+
+def test_graphml_export(tmp_path):
+
+    G = annotated_network(np.random.default_rng(1))
+    write_graphml(cg.from_networkx(G), str(tmp_path / 'network.graphml'))
+    T = nx.read_graphml(str(tmp_path / 'network.graphml'))
+
+    assert sorted(T.nodes()) == sorted(G.nodes())
+    assert T.number_of_edges() == G.number_of_edges()
+    #well sets are exported in their '_' joined string form
+    assert all(T.nodes[n]['well'] == '_'.join(map(str, d['well'])) for n,d in G.nodes(data=True) if 'well' in d)
@@ -0,0 +1,169 @@
+import random
+from collections import Counter
+from itertools import combinations
+
+import numpy as np
+import networkx as nx
+from scipy import stats
+
+from helpers import int_to_well_position, parse_wells
+from plate_geometry import plate_geometry
+from conkat_utils import _FLAG_SHARD, _init_flag_shard, _observe_flag_shard
+from conkat_utils import adaptive_looks, binomial_interval, exact_max_occupancy_sf, flag_barcode_swap_edges, load_null_table, max_group_occupancy
+from conkat_utils import null_distribution_table, null_occupancy_sf, save_null_table, simulate_max_occupancy
+
+
+def plate_groups(wells):
+
+    """Row and column groups of wells the way the pandas engine named them ('RA_P0', 'C1_P0')"""
+
+    rows = ['R%s_P%s' % (int_to_well_position(w)[0], (w - 1) // 384) for w in wells]
+    cols = ['C%s_P%s' % (int_to_well_position(w)[1:], (w - 1) // 384) for w in wells]
+    return (rows, cols)
+
+
+def biased_network(rng, nedges=40):
+
+    """Edges between nodes sharing random wells, every fourth edge sharing wells of a single plate row"""
+
+    G = nx.Graph()
+    for k in range(nedges):
+        if k % 4:
+            shared = rng.choice(np.arange(1, 384 * 6 + 1), rng.integers(3, 40), replace=False)
+        else:
+            #row B of plate 1, wells are numbered down the columns
+            shared = 384 + 2 + 16 * rng.choice(24, rng.integers(4, 12), replace=False)
+        (u, v) = ('u%d' % k, 'v%d' % k)
+        G.add_node(u, well='_'.join(map(str, np.r_[shared, rng.integers(1, 384 * 6 + 1, 5)])))
+        G.add_node(v, well='_'.join(map(str, np.r_[shared, rng.integers(1, 384 * 6 + 1, 5)])))
+        G.add_edge(u, v)
+    return G
+
+
+def test_max_group_occupancy():
+
+    rng = np.random.default_rng(0)
+    groups = rng.integers(0, 7, (50, 12))
+    assert max_group_occupancy(groups).tolist() == [max(Counter(g).values()) for g in groups.tolist()]
+    assert max_group_occupancy(np.zeros((3, 0), dtype=np.int64)).tolist() == [0, 0, 0]
+
+
+def test_observed_occupancy():
+
+    G = biased_network(np.random.default_rng(1))
+    edges = list(G.edges())
+    node_wells = dict((n, parse_wells(w)) for n,w in G.nodes(data='well'))
+    _init_flag_shard(edges, node_wells, null_distribution_table(), {})
+    try:
+        observed = _observe_flag_shard((0, len(edges)))
+    finally:
+        _FLAG_SHARD.clear()
+
+    for (k, (u, v)) in enumerate(edges):
+        wells = set(map(int, G.nodes[u]['well'].split('_'))) & set(map(int, G.nodes[v]['well'].split('_')))
+        (rows, cols) = [Counter(x) for x in plate_groups(wells)]
+        (Nwells, rowMax, rowidx, colMax, colidx) = [x[k] for x in observed]
+        assert Nwells == len(wells)
+        assert (rowMax, colMax) == (max(rows.values()), max(cols.values()))
+        #ties may name another group of the same occupancy
+        assert (rows[rowidx], cols[colidx]) == (rowMax, colMax)
+
+
+def test_simulated_occupancy():
+
+    #integer draws on precomputed coordinates against random.sample and well position strings
+    geometry = plate_geometry()
+    random.seed(0)
+    for nwells in [5, 20, 60]:
+        (rowMax, colMax) = simulate_max_occupancy(nwells, 3000, np.random.default_rng(nwells), geometry)
+        expected = [[max(Counter(x).values()) for x in plate_groups(random.sample(range(1, 384 * 6 + 1), nwells))]
+                    for k in range(3000)]
+        for (sim, ref) in [(rowMax, [x[0] for x in expected]), (colMax, [x[1] for x in expected])]:
+            sf = [np.mean(sim >= k) for k in range(1, 8)]
+            ref_sf = [np.mean(np.array(ref) >= k) for k in range(1, 8)]
+            np.testing.assert_allclose(sf, ref_sf, atol=0.04)
+
+
+def test_exact_max_occupancy_sf():
+
+    #every draw of a few wells out of 4 groups of 3
+    (group_size, ngroups) = (3, 4)
+    for nwells in range(group_size * ngroups + 1):
+        maxima = [max(Counter(w // group_size for w in draw).values(), default=0)
+                  for draw in combinations(range(group_size * ngroups), nwells)]
+        expected = [np.mean(np.array(maxima) >= k) for k in range(group_size + 1)]
+        np.testing.assert_allclose(exact_max_occupancy_sf(nwells, group_size, ngroups), expected, rtol=1e-12)
+
+
+def test_exact_null_against_monte_carlo():
+
+    rng = np.random.default_rng(2)
+    exact = null_distribution_table(exact_max=100)
+    simulated = null_distribution_table(exact_max=0)
+    for nwells in [3, 12, 40, 90]:
+        (row_sf, col_sf) = null_occupancy_sf(exact, nwells, rng)
+        (sim_row_sf, sim_col_sf) = null_occupancy_sf(simulated, nwells, rng, draws=20000)
+        assert (exact['source'][nwells], simulated['source'][nwells]) == (2, 1)
+        np.testing.assert_allclose(sim_row_sf, row_sf, atol=0.015)
+        np.testing.assert_allclose(sim_col_sf, col_sf, atol=0.015)
+
+
+def test_shared_null_table(tmp_path):
+
+    G = biased_network(np.random.default_rng(3))
+    null_table = null_distribution_table(N=200, exact_max=8)
+    (G, P, flag) = flag_barcode_swap_edges(G, N=200, random_seed=0, null_table=null_table)
+    computed = np.flatnonzero(null_table['source'])
+    assert null_table['draws'][computed].max() == 200
+
+    #a second network reuses the distributions of the first, also through their file
+    save_null_table(null_table, str(tmp_path / 'null.npz'))
+    for table in [null_table, load_null_table(str(tmp_path / 'null.npz'), N=200, exact_max=8)]:
+        (G2, P2, flag2) = flag_barcode_swap_edges(G.copy(), N=200, random_seed=1, null_table=table)
+        assert flag2.equals(flag)
+        np.testing.assert_array_equal(table['source'], null_table['source'])
+        np.testing.assert_array_equal(table['draws'], null_table['draws'])
+
+    #exact distributions are not kept above exact_max, nor any distribution of another plate layout
+    loaded = load_null_table(str(tmp_path / 'null.npz'), N=200, exact_max=4)
+    assert not loaded['source'][5:9].any()
+    loaded = load_null_table(str(tmp_path / 'null.npz'), N=200, exact_max=8, geometry=plate_geometry(96, 24))
+    assert not loaded['source'].any()
+
+
+def test_adaptive_looks():
+
+    #20, 40 ... 320, 500 draws, then 1000, 2000 for undecided edges
+    assert adaptive_looks(500, 500) == 6
+    assert adaptive_looks(500, 2000) == 8
+    assert adaptive_looks(10, 10) == 1
+
+
+def test_binomial_interval():
+
+    (x, n) = (np.array([0, 1, 7, 20, 20]), np.array([20, 20, 40, 20, 500]))
+    (lower, upper) = binomial_interval(x, n, 0.95)
+    expected = [stats.binomtest(int(a), int(b)).proportion_ci(0.95, method='exact') for a,b in zip(x, n)]
+    np.testing.assert_allclose(lower, [ci.low for ci in expected], rtol=1e-9, atol=1e-12)
+    np.testing.assert_allclose(upper, [ci.high for ci in expected], rtol=1e-9)
+
+
+def test_adaptive_flagging():
+
+    G = biased_network(np.random.default_rng(4), nedges=80)
+    (G, P, flag) = flag_barcode_swap_edges(G.copy(), N=2000, random_seed=0, exact_max=0)
+    (G, P, adaptive) = flag_barcode_swap_edges(G.copy(), N=2000, random_seed=0, exact_max=0, adaptive=True)
+
+    #the same edges are flagged, most of them after far fewer draws
+    assert len(flag) > 0
+    assert sorted(adaptive.index) == sorted(flag.index)
+    assert (flag['draws'] == 2000).all()
+    assert adaptive['draws'].mean() < 500
+    np.testing.assert_allclose(adaptive['min_p'], flag.loc[adaptive.index, 'min_p'], atol=0.03)
+    #every edge sharing wells of a single plate row is flagged
+    assert set(str(('u%d' % k, 'v%d' % k)) for k in range(0, 80, 4)) <= set(flag.index)
+
+    #undecided edges may go on past N, up to max_N
+    (G, P, extended) = flag_barcode_swap_edges(G.copy(), N=2000, max_N=8000, random_seed=0, exact_max=0, adaptive=True)
+    assert extended['draws'].max() <= 8000
+    assert sorted(extended.index) == sorted(flag.index)
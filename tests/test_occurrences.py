@@ -0,0 +1,174 @@
+import numpy as np
+import pandas as pd
+from scipy import stats
+from statsmodels.stats.multitest import multipletests
+
+from helpers import fisher_exact_batch
+from conkat_io import read_occurrences, read_occurrences_meta, write_occurrences
+from conkat_utils import calc_domain_occurances, load_occurrence_state, save_occurrence_state
+
+
+def random_margins(rng, n, Nwells):
+
+    """n random (a, Ov1, Ov2) co-occurrence tables over Nwells wells"""
+
+    Ov1 = rng.integers(1, Nwells + 1, n)
+    Ov2 = rng.integers(1, Nwells + 1, n)
+    lo = np.maximum(0, Ov1 + Ov2 - Nwells)
+    hi = np.minimum(Ov1, Ov2)
+    a = lo + (rng.random(n) * (hi - lo + 1)).astype(np.int64)
+    return (a, Ov1, Ov2)
+
+
+def clustering_table(rng, Nwells=96, nseeds=60, ngroups=8):
+
+    """Clustering table of seeds in random wells, plus groups of seeds sharing most of their wells"""
+
+    rows = []
+    for s in range(nseeds):
+        rows.extend(('s%03d' % s, w) for w in rng.choice(Nwells, rng.integers(2, 40), replace=False))
+    for g in range(ngroups):
+        wells = rng.choice(Nwells, rng.integers(4, 12), replace=False)
+        for k in range(rng.integers(2, 4)):
+            rows.extend(('g%02d_%d' % (g, k), w) for w in wells if rng.random() < 0.9)
+    #every well holds a seed
+    rows.extend(('s000', w) for w in range(Nwells))
+    return pd.DataFrame(rows, columns=['seed', 'well'])
+
+
+def pair_table(df):
+
+    """Occurrences table sorted by pair, with the columns all the engines fill alike"""
+
+    df = df[['V1', 'V2', 'Ov1', 'Ov2', 'count', 'odds', 'pvalue']].sort_values(['V1', 'V2'])
+    return df.reset_index(drop=True).astype({'Ov1': np.int64, 'Ov2': np.int64, 'count': np.int64})
+
+
+def rejected_pairs(df, alpha, method, ntests):
+
+    """Pair -> (corrected) p-value of the pairs build_graph keeps, pruned pairs count as p = 1.0"""
+
+    pvals = df['pvalue'].values.astype(np.float64)
+    if method == 'pvalue':
+        (reject, corrected) = (pvals < alpha, pvals)
+    else:
+        (reject, corrected) = multipletests(np.r_[pvals, np.ones(ntests - len(pvals))], alpha, method)[:2]
+    pairs = list(zip(df['V1'].values, df['V2'].values))
+    return dict((pair, p) for pair,p,r in zip(pairs, corrected, reject) if r)
+
+
+def test_fisher_exact_batch():
+
+    rng = np.random.default_rng(0)
+    for Nwells in [20, 96, 384]:
+        (a, Ov1, Ov2) = random_margins(rng, 300, Nwells)
+        #extreme tables: no shared well, full overlap, a seed in every well
+        a = np.r_[a, 0, 5, 5, 3]
+        Ov1 = np.r_[Ov1, 5, 5, Nwells, 3]
+        Ov2 = np.r_[Ov2, 5, 5, 5, Nwells]
+
+        (odds, pvals) = fisher_exact_batch(a, Ov1, Ov2, Nwells)
+        expected = [stats.fisher_exact([[x, y - x], [z - x, Nwells - y - z + x]]) for x,y,z in zip(a, Ov1, Ov2)]
+        np.testing.assert_array_equal(odds, [x[0] for x in expected])
+        np.testing.assert_allclose(pvals, [x[1] for x in expected], rtol=1e-9)
+
+
+def test_fisher_exact_batch_cache():
+
+    rng = np.random.default_rng(1)
+    (a, Ov1, Ov2) = random_margins(rng, 200, 96)
+    (odds, pvals) = fisher_exact_batch(a, Ov1, Ov2, 96)
+
+    #the test is symmetric in (Ov1, Ov2), a memo filled by one call serves the swapped tables
+    cache = {}
+    fisher_exact_batch(a[:100], Ov1[:100], Ov2[:100], 96, cache)
+    assert len(cache) > 0
+    (cached_odds, cached_pvals) = fisher_exact_batch(a, Ov2, Ov1, 96, cache)
+    np.testing.assert_array_equal(cached_odds, odds)
+    np.testing.assert_array_equal(cached_pvals, pvals)
+    assert len(cache) == len(set(zip(a.tolist(), np.minimum(Ov1, Ov2).tolist(), np.maximum(Ov1, Ov2).tolist())))
+
+
+def test_alpha_pruning():
+
+    table = clustering_table(np.random.default_rng(2))
+    for engine in ['sparse', 'loop']:
+        full = calc_domain_occurances(table, 3, engine=engine)
+        for (alpha, method) in [(0.01, 'pvalue'), (0.05, 'fdr_bh'), (0.05, 'fdr_tsbh'), (0.05, 'bonferroni')]:
+            pruned = calc_domain_occurances(table, 3, engine=engine, alpha=alpha, method=method)
+            assert pruned.attrs['pruned_pairs'] == pruned.attrs['ntests'] - len(pruned)
+            #pairs of pruned seeds are never counted, the raw p-value threshold needs no number of tests
+            if pruned.attrs['pruned_seeds'] == 0:
+                assert pruned.attrs['ntests'] == len(full)
+            #pruning skips pairs but leaves the network and its corrected p-values alone
+            expected = rejected_pairs(full, alpha, method, len(full))
+            kept = rejected_pairs(pruned, alpha, method, pruned.attrs['ntests'])
+            assert len(expected) > 0
+            assert sorted(kept) == sorted(expected)
+            np.testing.assert_allclose([kept[k] for k in sorted(kept)], [expected[k] for k in sorted(kept)], rtol=1e-12)
+        assert pruned.attrs['pruned_pairs'] > 0
+    assert calc_domain_occurances(table, 3, alpha=0.01).attrs['pruned_seeds'] > 0
+
+
+def test_incremental_occurrences(tmp_path):
+
+    rng = np.random.default_rng(3)
+    table = clustering_table(rng, Nwells=192)
+    #a second domain amplicon: new seeds in wells already sequenced
+    domain = clustering_table(rng, Nwells=192, nseeds=6, ngroups=3)
+    domain = domain[domain['seed'] != 's000'].assign(seed=lambda x: 'd_' + x['seed'])
+    steps = [table[table['well'] < 96], table, pd.concat([table, domain]),
+             pd.concat([table, domain[domain['well'] % 3 > 0]])]
+
+    state = {}
+    for (k, step) in enumerate(steps):
+        #the state goes through its file between runs
+        if k:
+            save_occurrence_state(state, str(tmp_path / 'state.npz'))
+            state = load_occurrence_state(str(tmp_path / 'state.npz'))
+        incremental = calc_domain_occurances(step, 3, state=state)
+        full = calc_domain_occurances(step, 3)
+        assert len(full) > 0
+        assert pair_table(incremental).equals(pair_table(full))
+        assert incremental['wells'].tolist() == full['wells'].tolist()
+
+
+def test_occurrence_engines(tmp_path):
+
+    table = clustering_table(np.random.default_rng(4))
+    loop = calc_domain_occurances(table, 3, engine='loop')
+    expected = pair_table(loop)
+    wells = dict(((v1, v2), sorted(w)) for v1,v2,w in zip(loop['V1'], loop['V2'], loop['wells']))
+    assert len(loop) > 0
+
+    #a tiny memory budget spreads the chunked engine over many seed blocks
+    for (engine, budget) in [('sparse', None), ('chunked', None), ('chunked', 0.01)]:
+        df = calc_domain_occurances(table, 3, engine=engine, memory_budget=budget, spill_dir=str(tmp_path))
+        assert pair_table(df).equals(expected)
+        assert dict(((v1, v2), w) for v1,v2,w in zip(df['V1'], df['V2'], df['wells'])) == wells
+
+        #streamed to a binary occurrences directory, block by block
+        output = str(tmp_path / ('%s_%s' % (engine, budget)))
+        calc_domain_occurances(table, 3, engine=engine, memory_budget=budget, spill_dir=str(tmp_path), output=output)
+        stored = read_occurrences(output)
+        assert read_occurrences_meta(output)['nrows'] == len(loop)
+        assert pair_table(stored).equals(expected)
+        assert dict(((v1, v2), w) for v1,v2,w in zip(stored['V1'], stored['V2'], stored['wells'])) == wells
+
+
+def test_occurrences_binary_format(tmp_path):
+
+    df = calc_domain_occurances(clustering_table(np.random.default_rng(5)), 3, alpha=0.05, method='fdr_bh')
+    output = str(tmp_path / 'occurrences')
+    write_occurrences(df, output, Nwells=96)
+
+    stored = read_occurrences(output, mmap=False)
+    assert pair_table(stored).equals(pair_table(df))
+    assert stored['wells'].tolist() == [list(w) for w in df['wells']]
+    assert stored.attrs == df.attrs
+    assert read_occurrences_meta(output)['Nwells'] == 96
+
+    #column selective, memory mapped load
+    pvals = read_occurrences(output, columns=['V1', 'pvalue'])
+    assert pvals.columns.tolist() == ['V1', 'pvalue']
+    np.testing.assert_array_equal(pvals['pvalue'].values, df['pvalue'].values)
@@ -0,0 +1,90 @@
+import io
+import shutil
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from sequence_clustering import cluster_fast
+from conkat_utils import _cluster_merges
+from conkat_utils import _vsearch_clusters
+
+A = ('TACGTTTTACGTACGGGATGAATTAATTGGTAATCAATCATCAGACGGAGC'
+     'TTTATACAAGTCAAATTGCTACTTATACATCTTTCTTATCTGCCCCCTT')
+D = ('GTGGCTTTGTAACTCCATGGAACATTTAATAGGGTTTCGTTCAATCAGGCG'
+     'CATTCGTCAACCCGAAGGGAGAGTGGACCGGCCTCGACAAGTCCTCATA')
+
+#uc table written by hand for the sequences of substituted_variants, as vsearch --cluster_fast
+#--id 0.9 -sizein lays it out: b and f are 97% and 95% identical to a, c is 85% identical to a
+#and a centroid of its own, e is 99% identical to d (checked against vsearch by test_cluster_fast_vsearch)
+UC = '''S\t0\t100\t*\t*\t*\t*\t*\ta;size=20\t*
+H\t0\t100\t97.0\t+\t0\t0\t100M\tb;size=10\ta;size=20
+S\t1\t100\t*\t*\t*\t*\t*\tc;size=8\t*
+S\t2\t100\t*\t*\t*\t*\t*\td;size=5\t*
+H\t2\t100\t99.0\t+\t0\t0\t100M\te;size=2\td;size=5
+H\t0\t100\t95.0\t+\t0\t0\t100M\tf;size=1\ta;size=20
+C\t0\t3\t*\t*\t*\t*\t*\ta;size=20\t*
+C\t1\t1\t*\t*\t*\t*\t*\tc;size=8\t*
+C\t2\t2\t*\t*\t*\t*\t*\td;size=5\t*
+'''
+
+
+def substitute(seq, sites):
+
+    bases = 'ACGT'
+    seq = list(seq)
+    for k in sites:
+        seq[k] = bases[(bases.index(seq[k]) + 1) % 4]
+    return ''.join(seq)
+
+
+def uc_merges(uc):
+
+    """Merges of a uc table, parsed as _vsearch_clusters does"""
+
+    otuDF = pd.read_csv(io.StringIO(uc), sep='\t', header=None)
+    otuDF.columns = ['type','cluster','length','ident','strand','','','align','q','h']
+    otuDF = otuDF[(otuDF.type == 'H') | (otuDF.type == 'S')]
+    seedsIndex = otuDF[otuDF['type'] == 'S'].index
+    otuDF.loc[seedsIndex,'h'] = otuDF.loc[seedsIndex,'q']
+    return _cluster_merges(otuDF)
+
+
+def substituted_variants():
+
+    """Labels and sequences of variants of A and D, in input order"""
+
+    return zip(('c;size=8', substitute(A, range(0, 90, 6))),
+               ('f;size=1', substitute(A, [20, 30, 60, 70, 80])),
+               ('a;size=20', A),
+               ('e;size=2', substitute(D, [40])),
+               ('b;size=10', substitute(A, [10, 50, 90])),
+               ('d;size=5', D))
+
+
+def test_cluster_fast_uc():
+
+    (headers, seqs) = substituted_variants()
+    merges = cluster_fast(list(headers), list(seqs), 0.9)
+    assert merges == uc_merges(UC)
+    assert merges == [('a;size=20', 'b;size=10'), ('a;size=20', 'f;size=1'), ('d;size=5', 'e;size=2')]
+
+
+@pytest.mark.skipif(shutil.which('vsearch') is None, reason='needs vsearch')
+def test_cluster_fast_vsearch():
+
+    (headers, seqs) = substituted_variants()
+    otuDF = _vsearch_clusters(list(headers), list(seqs), 0.9, 1)
+    assert otuDF is not None
+    assert set(cluster_fast(list(headers), list(seqs), 0.9)) == set(_cluster_merges(otuDF))
+
+
+def test_cluster_fast_indels():
+
+    #an insertion and a deletion 40 positions apart: gapless identity is far below
+    #the 98% identity of the alignment with gaps, the sequences are left to vsearch
+    g = A[:30] + 'G' + A[30:70] + A[71:]
+    assert len(g) == len(A)
+    assert np.mean([x == y for x,y in zip(A, g)]) < 0.9
+    assert cluster_fast(['a;size=20', 'g;size=3', 'd;size=5'], [A, g, D], 0.9) is None
+    assert cluster_fast(['a;size=20', 'd;size=5'], [A, D], 0.9) == []